@@ -2,29 +2,34 @@ import streamlit as st
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from modules.capital_com_api import CapitalComAPI
+from modules.backfill import backfill
+from modules.decoder import decode_prices, decode_many
 from modules.predictors import AutoGluonTrainer
-from modules.assistant import Assistant
+from modules.simulator import simulate
+from modules.risk import RiskEngine, QuantileSampler, BootstrapSampler, positions_from_api
+from modules.execution import ExecutionEngine, net_basket
+from modules.paper_broker import PaperBroker
+from modules import app_resources as resources
 
 from dotenv import load_dotenv
 import os
+import time
 
 # Load environment variables
 load_dotenv()
 
-# Get API credentials from environment variables
-API_KEY = os.getenv('CAPITAL_COM_API_KEY')
-IDENTIFIER = os.getenv('CAPITAL_COM_IDENTIFIER')
-PASSWORD = os.getenv('CAPITAL_COM_API_PASSWORD')
 OPENAI_ASSISTANT_ID = os.getenv('OPENAI_ASSISTANT_ID')
 
-# Initialize the CapitalComAPI client
-api_client = CapitalComAPI(
-    api_key=API_KEY,
-    identifier=IDENTIFIER,
-    password=PASSWORD,
-    demo=False  # Set to False for live trading
-)
+# Clients, models and schedulers are created once per server process and shared by every
+# session, so reruns don't log in again (see modules/app_resources.py)
+model_registry = resources.get_model_registry()
+job_queue = resources.get_job_queue()
+indicator_engine = resources.get_indicator_engine()
+api_client = resources.get_api_client()
+
+# Optionally load the most recent predictors into memory up front
+if os.getenv('WARM_UP_PREDICTORS', '').lower() in ('1', 'true', 'yes'):
+    resources.warm_up_predictors()
 
 # Initialize session state for storing data
 if 'data' not in st.session_state:
@@ -33,9 +38,10 @@ if 'data' not in st.session_state:
 st.title("AI Investing Application")
 
 # Use tabs to organize the UI
-tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
     "Market Data",
     "Model Training & Prediction",
+    "Investment Simulation",
     "Account Info",
     "Positions & Orders",
     "Place Order",
@@ -46,6 +52,18 @@ tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
 with tab1:
     st.header("Market Data")
 
+    market_catalog = resources.get_market_catalog()
+    market_query = st.text_input("Find a market by name or symbol")
+    if market_query:
+        # Searched locally in the market catalog, without a request per keystroke
+        matches = market_catalog.search(market_query, limit=10)
+        if matches:
+            st.dataframe(pd.DataFrame(matches)[['epic', 'name', 'type', 'path', 'score']], hide_index=True)
+        elif not len(market_catalog.index):
+            st.info("The market catalog is still being built; try again in a few minutes.")
+        else:
+            st.info("No matching markets found.")
+
     epic = st.text_input("Enter Market EPIC (e.g., GOLD, AAPL)", "US100")
     resolution = st.selectbox("Select Time Resolution", [
         "MINUTE", "MINUTE_5", "MINUTE_15", "MINUTE_30", "HOUR", "DAY", "WEEK"
@@ -55,38 +73,63 @@ with tab1:
 
     if st.button("Fetch Historical Data"):
         with st.spinner("Fetching historical data..."):
-            historical_prices = api_client.get_historical_prices(
-                epic=epic, resolution=resolution, max=num_data_points)
+            historical_prices = resources.historical_prices(epic, resolution, num_data_points)
 
             if 'prices' not in historical_prices or not historical_prices['prices']:
                 st.error("No data found for the given stock and interval.")
             else:
                 st.success("Data fetched successfully!")
-                data = pd.DataFrame([
-                    {
-                        "item_id": epic,  # Each row has the same 'item_id'
-                        "timestamp": pd.to_datetime(price['snapshotTimeUTC']),
-                        "target": price['closePrice']['bid']
-                    }
-                    for price in historical_prices['prices']
-                ])
+                frame = decode_prices(historical_prices, epic, mid=True, spread=True)
+                # Train on the closing bid, as before; the full frame is shown below
+                data = frame[['item_id', 'timestamp', 'target']]
                 st.session_state.data = data  # Store data in session state
-                st.write(data)
+                st.write(frame)
 
                 # Plot the data
                 st.line_chart(data.set_index('timestamp')['target'])
 
+    indicators = indicator_engine.frame(resolution)
+    if len(indicators):
+        st.subheader(f"Latest Indicators ({resolution})")
+        st.dataframe(indicators)
+
+    with st.expander("Bulk Backfill"):
+        backfill_epics = st.text_input("EPICs (comma separated)", epic)
+        backfill_from = st.date_input("Backfill From")
+        backfill_to = st.date_input("Backfill To")
+        if st.button("Backfill History"):
+            progress_bar = st.progress(0.0)
+            report = backfill(
+                api_client,
+                [e.strip() for e in backfill_epics.split(',') if e.strip()],
+                resolution,
+                backfill_from.isoformat(),
+                backfill_to.isoformat(),
+                progress=lambda done, total: progress_bar.progress(done / total)
+            )
+            st.write(report)
+
     st.subheader("Ask a Question")
     question = st.text_input("Enter your question about the market data")
     if st.button("Get Answer"):
         if question:
             with st.spinner("Processing your question..."):
-                # Initialize the Assistant with the existing api_client
-                assistant = Assistant(capital_api_client=api_client)
+                assistant = resources.get_assistant()
                 assistant_id = OPENAI_ASSISTANT_ID
-                answer = assistant.chat_with_assistant(assistant_id, question)
                 st.write("Assistant's Response:")
-                st.write(answer)
+                # Show the answer while it is being written
+                response_area = st.empty()
+                parts = []
+
+                def show_delta(text):
+                    parts.append(text)
+                    response_area.markdown(''.join(parts))
+
+                answer = assistant.chat_with_assistant(assistant_id, question, on_delta=show_delta)
+                if answer is None:
+                    st.error("The assistant could not answer the question.")
+                else:
+                    response_area.markdown(answer)
         else:
             st.error("Please enter a question.")
 
@@ -95,6 +138,9 @@ with tab2:
     st.header("Model Training & Prediction")
     prediction_length = st.number_input(
         "Prediction Length", min_value=1, max_value=50, value=10)
+    context_length = st.number_input(
+        "Context Length (0 = all history)", min_value=0, max_value=10000, value=0)
+    job_owner = st.text_input("Job owner", os.getenv("USER", "default"))
     train_model_button = st.button("Train Model")
 
     if train_model_button:
@@ -103,16 +149,9 @@ with tab2:
                 "No data available for training. Please fetch historical data first.")
         else:
             data = st.session_state.data
-            trainer = AutoGluonTrainer(
-                epic=epic,
-                resolution=resolution,
-                data_points=num_data_points,
-                prediction_length=prediction_length
-            )
-            with st.spinner(f"Training AutoGluon model for {epic} with {resolution} interval..."):
-                predictor = trainer.train_model(data, "target")
-                st.success(
-                    f"Model trained and saved to {trainer.model_path}")
+            # Fits run in the background, so the app stays usable while training
+            job_id = job_queue.submit(job_owner, epic, resolution, data, prediction_length=prediction_length)
+            st.success(f"Training job {job_id} for {epic} with {resolution} interval submitted")
 
     if st.button("Make Prediction"):
         if st.session_state.data is None:
@@ -124,39 +163,199 @@ with tab2:
                 epic=epic,
                 resolution=resolution,
                 data_points=num_data_points,
-                prediction_length=prediction_length
+                prediction_length=prediction_length,
+                registry=model_registry
             )
-            future_predictions = trainer.make_predictions(data)
+            future_predictions = trainer.make_predictions(data, context_length=context_length)
             st.write("Future Predictions:")
             st.write(future_predictions)
 
             # Plot predictions
             st.line_chart(future_predictions['mean'])
 
-# ---------------- Account Info Tab -----------------
+    st.subheader("Watchlist Models")
+    watchlist_epics = st.text_input("EPICs (comma separated)", epic)
+    watchlist_name = st.text_input("Global model name", "watchlist")
+    use_global_model = st.checkbox("Use the global model for the watchlist forecast", value=False)
+    training_budget = st.number_input("Training time budget in seconds (0 = unlimited)", min_value=0, value=0)
+    epics = [e.strip() for e in watchlist_epics.split(',') if e.strip()]
+
+    def fetch_watchlist_histories():
+        histories = decode_many({
+            e: resources.historical_prices(e, resolution, num_data_points)
+            for e in epics
+        })
+        return histories[['item_id', 'timestamp', 'target']]
+
+    if st.button("Train Global Model"):
+        with st.spinner(f"Fetching {len(epics)} markets..."):
+            job_id = job_queue.submit(
+                job_owner, watchlist_name, resolution, fetch_watchlist_histories(),
+                prediction_length=prediction_length, time_limit=training_budget or None, global_model=True)
+            st.success(f"Training job {job_id} submitted")
+
+    if st.button("Train Per-EPIC Models in Parallel"):
+        with st.spinner(f"Fetching {len(epics)} markets..."):
+            histories = fetch_watchlist_histories()
+            # The job queue runs as many of these at once as the machine has workers for
+            job_ids = [
+                job_queue.submit(job_owner, e, resolution, frame,
+                                 prediction_length=prediction_length, time_limit=training_budget or None)
+                for e, frame in histories.groupby('item_id', sort=False)
+            ]
+            st.success(f"Training jobs {', '.join(map(str, job_ids))} submitted")
+
+    if st.button("Forecast Watchlist"):
+        with st.spinner(f"Forecasting {len(epics)} markets..."):
+            histories = fetch_watchlist_histories()
+            if use_global_model:
+                trainer = AutoGluonTrainer.global_trainer(
+                    watchlist_name, resolution, prediction_length=prediction_length, registry=model_registry)
+                forecasts = trainer.predict_batch(histories, context_length=context_length)
+            else:
+                # Each EPIC is forecast by its own registered model
+                forecasts = {}
+                for forecast_epic, frame in histories.groupby('item_id', sort=False):
+                    trainer = AutoGluonTrainer(
+                        epic=forecast_epic,
+                        resolution=resolution,
+                        data_points=num_data_points,
+                        prediction_length=prediction_length,
+                        registry=model_registry
+                    )
+                    try:
+                        forecasts.update(trainer.predict_batch(frame, context_length=context_length))
+                    except FileNotFoundError:
+                        st.warning(f"No model trained for {forecast_epic} yet; train the per-EPIC models first.")
+            for forecast_epic, forecast in forecasts.items():
+                st.write(f"{forecast_epic}:")
+                st.write(forecast)
+
+    with st.expander("Walk-Forward Backtest"):
+        st.write("Trains a model per fold on the stored history of the watchlist and trades its forecasts. "
+                 "Fold models are cached, so a longer history only trains the new folds.")
+        backtest_train_size = st.number_input("Training bars per fold", min_value=20, max_value=10000, value=500)
+        backtest_threshold = st.number_input("Minimum forecast move to trade (%)", min_value=0.0, value=0.0)
+        if st.button("Run Backtest"):
+            with st.spinner(f"Fetching {len(epics)} markets..."):
+                # Make sure the requested history is in the candle store
+                fetch_watchlist_histories()
+                # The folds are trained in a job, so the app stays responsive; follow it under Training Jobs
+                job_id = job_queue.submit_backtest(
+                    job_owner, epics, resolution, api_client.candle_store,
+                    train_size=backtest_train_size,
+                    prediction_length=prediction_length,
+                    time_limit=training_budget or None,
+                    threshold=backtest_threshold / 100
+                )
+                st.success(f"Backtest job {job_id} submitted; show its result under Training Jobs when it is done")
+
+    st.subheader("Training Jobs")
+
+    @st.fragment(run_every=5)
+    def show_training_jobs():
+        # Re-runs on its own every few seconds to poll the job table
+        jobs = job_queue.jobs(owner=job_owner)
+        if not jobs:
+            st.write("No training jobs yet.")
+            return
+        st.dataframe(pd.DataFrame(jobs)[['id', 'name', 'status', 'progress', 'message', 'error']], hide_index=True)
+        job_id = st.selectbox("Job", [job['id'] for job in jobs])
+        cancel_column, leaderboard_column, backtest_column = st.columns(3)
+        if cancel_column.button("Cancel Job"):
+            if job_queue.cancel(job_id):
+                st.success(f"Job {job_id} cancelled")
+            else:
+                st.error(f"Job {job_id} has already finished")
+        if leaderboard_column.button("Show Leaderboard"):
+            leaderboard = job_queue.leaderboard(job_id)
+            if leaderboard is None:
+                st.error(f"Job {job_id} has no trained models yet")
+            else:
+                st.write(leaderboard)
+        if backtest_column.button("Show Backtest Result"):
+            backtest_result = job_queue.backtest_result(job_id)
+            if backtest_result is None:
+                st.error(f"Job {job_id} is not a finished backtest")
+            else:
+                st.write(backtest_result['summary'])
+                st.write(backtest_result['trades'])
+
+    show_training_jobs()
+
+# ------------ Investment Simulation Tab ------------
 with tab3:
+    st.header("Investment Simulation")
+    st.write(f"Simulates a leveraged long position in {epic} over the {num_data_points} most recent {resolution} bars. "
+             "Enter several comma-separated values to compare every combination.")
+
+    def parse_values(text):
+        return [float(value) for value in text.split(',') if value.strip()]
+
+    initial_capitals = st.text_input("Initial Capital", "10000")
+    monthly_investments = st.text_input("Monthly Investment", "0, 500")
+    leverages = st.text_input("Leverage", "1, 2, 5, 10")
+    stop_losses = st.text_input("Stop-Loss % (0 = none)", "0, 5, 10, 20")
+
+    if st.button("Run Simulation"):
+        with st.spinner("Simulating..."):
+            historical_prices = resources.historical_prices(epic, resolution, num_data_points)
+            try:
+                result = simulate(
+                    historical_prices,
+                    parse_values(initial_capitals),
+                    parse_values(monthly_investments),
+                    parse_values(leverages),
+                    parse_values(stop_losses)
+                )
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                stats = result.stats.sort_values('final_equity', ascending=False)
+                st.write(stats)
+                # Plot the equity of the five best configurations
+                best = stats.index[:5]
+                st.line_chart(pd.DataFrame({
+                    f"{row.leverage:g}x, stop {row.stop_loss:g}%, +{row.monthly_investment:g}/month": result.equity_curve(i)
+                    for i, row in stats.loc[best].iterrows()
+                }))
+
+# ---------------- Account Info Tab -----------------
+with tab4:
     st.header("Account Information")
     if st.button("Get Account Details"):
         with st.spinner("Fetching account details..."):
-            accounts = api_client.get_accounts()
+            accounts = resources.accounts()
             st.write(accounts)
 
     if st.button("Get Account Preferences"):
         with st.spinner("Fetching account preferences..."):
-            preferences = api_client.get_account_preferences()
+            preferences = resources.account_preferences()
             st.write(preferences)
 
 # ----------- Positions & Orders Tab ----------------
-with tab4:
+with tab5:
     st.header("Open Positions & Orders")
+    portfolio_sync = resources.get_portfolio_sync()
+    snapshot = portfolio_sync.snapshot
+    if snapshot is not None:
+        st.caption(f"Synced {time.time() - snapshot.updated:.0f}s ago (version {snapshot.version}); "
+                   f"next poll within {portfolio_sync.interval:.0f}s")
+    if portfolio_sync.recent_changes:
+        with st.expander("Recent Changes"):
+            st.dataframe(pd.DataFrame([
+                {'time': pd.to_datetime(change['time'], unit='s'), 'version': change['version'],
+                 'kind': change['kind'], 'change': change['change'], 'deal_id': change['deal_id']}
+                for change in reversed(portfolio_sync.recent_changes)
+            ]), hide_index=True)
     if st.button("Get Open Positions"):
         with st.spinner("Fetching open positions..."):
-            positions = api_client.get_open_positions()
+            positions = resources.open_positions()
             st.write(positions)
 
     if st.button("Get Open Orders"):
         with st.spinner("Fetching open orders..."):
-            orders = api_client.get_open_orders()
+            orders = resources.open_orders()
             st.write(orders)
 
     # Option to close a position
@@ -166,12 +365,43 @@ with tab4:
         if deal_id_to_close:
             with st.spinner(f"Closing position {deal_id_to_close}..."):
                 response = api_client.close_position(deal_id_to_close)
+                resources.invalidate_after_trade()
                 st.write(response)
         else:
             st.error("Please enter a Deal ID to close.")
 
+    st.subheader("Position Risk")
+    risk_source = st.selectbox("Price paths from", ["Historical returns", "Model forecast quantiles"])
+    risk_steps = st.number_input(f"Horizon in {resolution} bars (historical returns)", min_value=1, max_value=1000, value=24)
+    risk_paths = st.number_input("Simulated paths", min_value=1000, max_value=5_000_000, value=1_000_000, step=100_000)
+    if st.button("Simulate Position Risk"):
+        with st.spinner("Simulating open positions..."):
+            positions = positions_from_api(resources.open_positions(), resources.account_preferences())
+            if not positions:
+                st.error("There are no open positions.")
+            else:
+                position_epics = sorted({position['epic'] for position in positions})
+                histories = {
+                    e: resources.historical_prices(e, resolution, num_data_points)
+                    for e in position_epics
+                }
+                if risk_source == "Historical returns":
+                    sampler = BootstrapSampler(histories, risk_steps)
+                else:
+                    # Forecasts of each EPIC's latest registered model, over its prediction length
+                    sampler = QuantileSampler({
+                        e: AutoGluonTrainer(
+                            e, resolution, num_data_points, prediction_length, registry=model_registry
+                        ).make_predictions(decode_prices(histories[e], e)[['item_id', 'timestamp', 'target']]).loc[e]
+                        for e in position_epics
+                    })
+                report = RiskEngine(n_paths=risk_paths).run(positions, sampler)
+                st.write("Portfolio:")
+                st.write(report['portfolio'])
+                st.write(report['positions'])
+
 # --------------- Place Order Tab -------------------
-with tab5:
+with tab6:
     st.header("Place a New Order")
     order_type = st.selectbox("Order Type", ["Market Order", "Working Order"])
     direction = st.selectbox("Direction", ["BUY", "SELL"])
@@ -191,6 +421,7 @@ with tab5:
                     stop_level=stop_level if stop_level > 0 else None,
                     profit_level=profit_level if profit_level > 0 else None
                 )
+                resources.invalidate_after_trade()
                 st.write(response)
     else:
         level = st.number_input("Order Level", value=0.0)
@@ -208,21 +439,101 @@ with tab5:
                     profit_level=profit_level if profit_level > 0 else None,
                     good_till_date=good_till_date.isoformat() if good_till_date else None
                 )
+                resources.invalidate_after_order()
                 st.write(response)
 
+    st.subheader("Rebalance a Basket")
+    basket_text = st.text_area("Target net sizes, one 'EPIC, size' per line (negative for short, 0 to close)")
+    dry_run = st.checkbox("Dry run against a paper broker", value=True)
+    min_trade_size = st.number_input("Smallest size worth trading", min_value=0.0, value=0.0)
+
+    def parse_basket(text):
+        targets = {}
+        for line in text.splitlines():
+            if line.strip():
+                basket_epic, basket_size = line.split(',')
+                targets[basket_epic.strip()] = float(basket_size)
+        return targets
+
+    if st.button("Preview Rebalance"):
+        try:
+            st.write(net_basket(parse_basket(basket_text), resources.open_positions(), min_trade_size))
+        except ValueError:
+            st.error("Every line must read 'EPIC, size'.")
+
+    if st.button("Execute Rebalance"):
+        try:
+            targets = parse_basket(basket_text)
+        except ValueError:
+            st.error("Every line must read 'EPIC, size'.")
+            targets = {}
+        if targets:
+            if dry_run:
+                # The paper broker starts from the real positions and orders, so the plan is the real one
+                broker = PaperBroker(
+                    open_positions=resources.open_positions(),
+                    open_orders=resources.open_orders(),
+                    hedging=resources.account_preferences().get('hedgingMode', True)
+                )
+            else:
+                broker = api_client
+            with st.spinner("Executing rebalance..."):
+                results = ExecutionEngine(broker).rebalance(targets, min_trade_size)
+            if not dry_run:
+                resources.invalidate_after_trade()
+            if results:
+                rows = []
+                for result in results:
+                    order = result['order'] or {}
+                    rows.append({
+                        'action': order.get('action'), 'epic': order.get('epic'),
+                        'direction': order.get('direction'), 'size': order.get('size'),
+                        'status': result['status'], 'deal_id': result.get('deal_id'), 'level': result.get('level'),
+                        'reason': result.get('reason') or result.get('error'),
+                        'attempts': result.get('attempts'), 'seconds': result.get('seconds')
+                    })
+                st.dataframe(pd.DataFrame(rows), hide_index=True)
+            else:
+                st.info("The open positions already match the basket.")
+
 # ----------- Transaction History Tab ---------------
-with tab6:
+with tab7:
     st.header("Transaction History")
     from_date = st.date_input("From Date")
     to_date = st.date_input("To Date")
     transaction_type = st.selectbox("Transaction Type (optional)", [
         "ALL", "DEPOSIT", "WITHDRAWAL", "TRADE", "FEE", "OTHER"])
 
+    history_store = resources.get_history_store()
+    # The whole of the last day is included
+    history_end = pd.Timestamp(to_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+    def sync_history():
+        # Only records newer than the last sync are downloaded; the first sync reaches back to from_date
+        progress_bar = st.progress(0.0)
+        report = history_store.sync(
+            api_client, start=pd.Timestamp(from_date).isoformat(),
+            progress=lambda done, total: progress_bar.progress(done / total))
+        for kind, result in report.items():
+            if result['error'] is not None:
+                st.error(f"Syncing {kind} failed: {result['error'].get('errorCode')}")
+
     if st.button("Get Transaction History"):
-        with st.spinner("Fetching transaction history..."):
-            response = api_client.get_transaction_history(
-                from_date=from_date.isoformat(),
-                to_date=to_date.isoformat(),
-                transaction_type=None if transaction_type == "ALL" else transaction_type
+        with st.spinner("Syncing transaction history..."):
+            sync_history()
+            response = history_store.transactions(
+                from_date.isoformat(),
+                history_end.isoformat(),
+                None if transaction_type == "ALL" else transaction_type
             )
             st.write(response)
+
+    st.subheader("PnL Report")
+    report_grouping = st.selectbox("Group by", ["day", "month", "epic"])
+    if st.button("Build PnL Report"):
+        with st.spinner("Syncing transaction history..."):
+            sync_history()
+        report = history_store.pnl_report(from_date.isoformat(), history_end.isoformat(), by=report_grouping)
+        st.write(report)
+        if report_grouping != "epic" and len(report):
+            st.line_chart(report['total'].cumsum())
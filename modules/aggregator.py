@@ -0,0 +1,136 @@
+import numpy as np
+from modules.candle_store import CANDLE_DTYPE, RESOLUTION_SECONDS
+
+# The resolutions AutoGluonTrainer._get_frequency knows about, finest first
+AGGREGATE_RESOLUTIONS = ["MINUTE", "MINUTE_5", "MINUTE_15", "MINUTE_30", "HOUR", "DAY", "WEEK"]
+
+# 1970-01-01 was a Thursday; weeks start on Monday 1970-01-05
+_WEEK_OFFSET = 4 * 86400
+
+# Positions in a streaming bar: start, then the CANDLE_DTYPE price columns, then volume
+_START, _OPEN_BID, _OPEN_ASK, _HIGH_BID, _HIGH_ASK, _LOW_BID, _LOW_ASK, _CLOSE_BID, _CLOSE_ASK, _VOLUME = range(10)
+
+
+def bucket_start(timestamps, resolution):
+    """Return the start (epoch seconds) of the bar each timestamp falls into; works on arrays."""
+    period = RESOLUTION_SECONDS[resolution]
+    offset = _WEEK_OFFSET if resolution == "WEEK" else 0
+    return (timestamps - offset) // period * period + offset
+
+
+def aggregate(candles, resolution):
+    """
+    Aggregate finer candles into bars of a coarser resolution in one vectorized pass.
+
+    Bars are aligned to UTC (weeks start on Monday), which can differ from the broker's
+    session-aligned DAY and WEEK bars.
+
+    Parameters:
+    - candles (np.ndarray): Candles in CANDLE_DTYPE, sorted by timestamp.
+    - resolution (str): The target resolution.
+
+    Returns:
+    - bars (np.ndarray): The aggregated candles in CANDLE_DTYPE.
+    """
+    if not len(candles):
+        return np.empty(0, dtype=CANDLE_DTYPE)
+    keys = bucket_start(candles['timestamp'], resolution)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    ends = np.concatenate((starts[1:], [len(candles)])) - 1
+
+    bars = np.empty(len(starts), dtype=CANDLE_DTYPE)
+    bars['timestamp'] = keys[starts]
+    for side in ('bid', 'ask'):
+        bars[f'open_{side}'] = candles[f'open_{side}'][starts]
+        bars[f'close_{side}'] = candles[f'close_{side}'][ends]
+        bars[f'high_{side}'] = np.fmax.reduceat(candles[f'high_{side}'], starts)
+        bars[f'low_{side}'] = np.fmin.reduceat(candles[f'low_{side}'], starts)
+    bars['volume'] = np.add.reduceat(np.nan_to_num(candles['volume']), starts)
+    return bars
+
+
+def aggregate_all(candles, resolutions=AGGREGATE_RESOLUTIONS):
+    """Aggregate finer candles into every given resolution; returns {resolution: bars}."""
+    return {resolution: aggregate(candles, resolution) for resolution in resolutions}
+
+
+class CandleAggregator:
+    def __init__(self, resolutions=AGGREGATE_RESOLUTIONS, on_bar=None):
+        """
+        Initialize the CandleAggregator class.
+
+        Keeps the forming bar of every (epic, resolution) up to date from MINUTE bars or
+        ticks in O(1) per update. A MINUTE bar sent again with the same timestamp (the
+        API revises the forming bar) replaces the earlier version instead of being
+        counted twice.
+
+        Parameters:
+        - resolutions (list): The resolutions to maintain.
+        - on_bar (callable): Called as on_bar(epic, resolution, bar) with every completed bar.
+        """
+        self.resolutions = list(resolutions)
+        self.on_bar = on_bar
+        self._bars = {}
+        # (epic, resolution) -> (bar before the last MINUTE bar was merged, that bar's timestamp)
+        self._before_last = {}
+
+    def seed(self, epic, candles):
+        """Start from existing history: the newest bar of each resolution becomes the forming bar."""
+        for resolution, bars in aggregate_all(candles, self.resolutions).items():
+            if len(bars):
+                self._bars[(epic, resolution)] = [bars[-1]['timestamp']] + [float(bars[-1][name]) for name in CANDLE_DTYPE.names[1:]]
+
+    def update_bar(self, epic, candle):
+        """Merge one MINUTE candle (a CANDLE_DTYPE record) into every resolution."""
+        timestamp = int(candle['timestamp'])
+        values = [float(candle[name]) for name in CANDLE_DTYPE.names[1:]]
+        for resolution in self.resolutions:
+            key = (epic, resolution)
+            before, last_timestamp = self._before_last.get(key, (None, None))
+            if last_timestamp == timestamp:
+                # A revised version of the previous MINUTE bar: restore the state it was merged into
+                self._bars[key] = list(before) if before is not None else None
+            else:
+                current = self._bars.get(key)
+                same_bar = current is not None and current[_START] == bucket_start(timestamp, resolution)
+                self._before_last[key] = (list(current) if same_bar else None, timestamp)
+            self._merge(key, resolution, timestamp, values)
+
+    def update_tick(self, epic, tick):
+        """Merge one tick (a TICK_DTYPE record from the quote stream) into every resolution."""
+        timestamp = int(tick['timestamp']) // 1000
+        bid, ask = float(tick['bid']), float(tick['ask'])
+        values = [bid, ask, bid, ask, bid, ask, bid, ask, 1.0]
+        for resolution in self.resolutions:
+            self._merge((epic, resolution), resolution, timestamp, values)
+
+    def on_tick(self, epic, tick):
+        """QuoteStream listener: stream.add_listener(aggregator.on_tick)."""
+        self.update_tick(epic, tick)
+
+    def _merge(self, key, resolution, timestamp, values):
+        start = bucket_start(timestamp, resolution)
+        bar = self._bars.get(key)
+        if bar is not None and start < bar[_START]:
+            return  # older than the forming bar
+        if bar is None or start > bar[_START]:
+            if bar is not None and self.on_bar is not None:
+                self.on_bar(key[0], resolution, self._to_record(bar))
+            self._bars[key] = [start] + values
+            return
+        bar[_HIGH_BID] = max(bar[_HIGH_BID], values[_HIGH_BID - 1])
+        bar[_HIGH_ASK] = max(bar[_HIGH_ASK], values[_HIGH_ASK - 1])
+        bar[_LOW_BID] = min(bar[_LOW_BID], values[_LOW_BID - 1])
+        bar[_LOW_ASK] = min(bar[_LOW_ASK], values[_LOW_ASK - 1])
+        bar[_CLOSE_BID] = values[_CLOSE_BID - 1]
+        bar[_CLOSE_ASK] = values[_CLOSE_ASK - 1]
+        bar[_VOLUME] += values[_VOLUME - 1]
+
+    def current(self, epic, resolution):
+        """Return the forming bar of a resolution as a CANDLE_DTYPE record, or None."""
+        bar = self._bars.get((epic, resolution))
+        return self._to_record(bar) if bar is not None else None
+
+    @staticmethod
+    def _to_record(bar):
+        return np.array(tuple(bar), dtype=CANDLE_DTYPE)[()]
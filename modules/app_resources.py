@@ -0,0 +1,199 @@
+import os
+import streamlit as st
+from dotenv import load_dotenv
+from modules.capital_com_api import CapitalComAPI
+from modules.candle_store import CandleStore
+from modules.model_registry import ModelRegistry
+from modules.jobs import JobQueue
+from modules.incremental_indicators import IndicatorEngine
+from modules.portfolio_sync import PortfolioSynchronizer
+from modules.history_store import HistoryStore
+from modules.market_catalog import MarketCatalog
+from modules.predictors import predictor_cache
+from modules.assistant import Assistant
+
+# Seconds each kind of data is reused before it is fetched again
+PRICES_TTL = 60
+ACCOUNTS_TTL = 30
+PREFERENCES_TTL = 300
+POSITIONS_TTL = 15
+
+# Ping the broker while the shared session is idle, so it never has to log in again
+KEEPALIVE_INTERVAL = 300
+# Seconds between background refreshes of the market catalog; stale nodes are re-read daily
+CATALOG_REFRESH_INTERVAL = 3600
+
+load_dotenv()
+
+
+class _ErrorResponse(Exception):
+    """Raised inside a cached fetch so st.cache_data does not keep an error response."""
+
+    def __init__(self, response):
+        super().__init__(response.get('errorCode'))
+        self.response = response
+
+
+def _checked(response):
+    if isinstance(response, dict) and 'errorCode' in response:
+        raise _ErrorResponse(response)
+    return response
+
+
+def _uncached_errors(fetch, *args):
+    try:
+        return fetch(*args)
+    except _ErrorResponse as e:
+        return e.response
+
+
+# ---------------- Shared resources ----------------
+# st.cache_resource objects live once per server process and are shared by every session and rerun
+
+@st.cache_resource
+def get_model_registry():
+    # Version models by their training data so unchanged data is never retrained
+    return ModelRegistry("models")
+
+
+@st.cache_resource
+def get_job_queue():
+    # One job scheduler per server process; it runs model fits in worker processes
+    queue = JobQueue("data/jobs.sqlite", model_dir="models", registry=get_model_registry())
+    queue.start()
+    return queue
+
+
+@st.cache_resource
+def get_indicator_engine():
+    # Indicator states of every EPIC fetched so far, updated with each new closed bar
+    return IndicatorEngine()
+
+
+@st.cache_resource
+def get_api_client():
+    """The one logged-in Capital.com client of the app, kept alive by background pings."""
+    client = CapitalComAPI(
+        api_key=os.getenv('CAPITAL_COM_API_KEY'),
+        identifier=os.getenv('CAPITAL_COM_IDENTIFIER'),
+        password=os.getenv('CAPITAL_COM_API_PASSWORD'),
+        demo=False,  # Set to False for live trading
+        # Serve repeat price requests from disk and build intraday bars from stored MINUTE bars
+        candle_store=CandleStore("data/candles", derive_resolutions=("MINUTE_5", "MINUTE_15", "MINUTE_30", "HOUR")),
+        keepalive_interval=KEEPALIVE_INTERVAL
+    )
+    client.add_candle_listener(get_indicator_engine().on_candles)
+    return client
+
+
+@st.cache_resource
+def get_portfolio_sync():
+    """One background poller of accounts, positions and orders, however many dashboards are open."""
+    synchronizer = PortfolioSynchronizer(get_api_client())
+    synchronizer.start()
+    return synchronizer
+
+
+@st.cache_resource
+def get_history_store():
+    # Transactions and activities are synced into SQLite and reports query them locally
+    return HistoryStore("data/history.sqlite")
+
+
+@st.cache_resource
+def get_market_catalog():
+    """The local market catalog, searched without requests and refreshed in the background."""
+    catalog = MarketCatalog("data/markets.json")
+    catalog.start_background_refresh(get_api_client(), CATALOG_REFRESH_INTERVAL)
+    return catalog
+
+
+@st.cache_resource
+def get_assistant():
+    # Assistants keep no per-question state, so sessions can share one and its OpenAI client
+    return Assistant(capital_api_client=get_api_client(), market_catalog=get_market_catalog())
+
+
+@st.cache_resource
+def warm_up_predictors():
+    """Load the most recent predictors into the process-wide predictor cache, once per process."""
+    predictor_cache.warm_up("models")
+    return True
+
+
+# ---------------- Cached data ----------------
+# st.cache_data results are shared by every session until their TTL runs out; error
+# responses are returned but not kept
+
+@st.cache_data(ttl=PRICES_TTL, show_spinner=False)
+def _historical_prices(epic, resolution, max):
+    return _checked(get_api_client().get_historical_prices(epic=epic, resolution=resolution, max=max))
+
+
+def historical_prices(epic, resolution, max):
+    return _uncached_errors(_historical_prices, epic, resolution, max)
+
+
+@st.cache_data(ttl=ACCOUNTS_TTL, show_spinner=False)
+def _accounts():
+    return _checked(get_api_client().get_accounts())
+
+
+def accounts():
+    # Served from the synchronizer's snapshot once it has one
+    snapshot = get_portfolio_sync().snapshot
+    if snapshot is not None:
+        return snapshot.accounts
+    return _uncached_errors(_accounts)
+
+
+@st.cache_data(ttl=PREFERENCES_TTL, show_spinner=False)
+def _account_preferences():
+    return _checked(get_api_client().get_account_preferences())
+
+
+def account_preferences():
+    return _uncached_errors(_account_preferences)
+
+
+@st.cache_data(ttl=POSITIONS_TTL, show_spinner=False)
+def _open_positions():
+    return _checked(get_api_client().get_open_positions())
+
+
+def open_positions():
+    # Served from the synchronizer's snapshot once it has one
+    snapshot = get_portfolio_sync().snapshot
+    if snapshot is not None:
+        return snapshot.open_positions()
+    return _uncached_errors(_open_positions)
+
+
+@st.cache_data(ttl=POSITIONS_TTL, show_spinner=False)
+def _open_orders():
+    return _checked(get_api_client().get_open_orders())
+
+
+def open_orders():
+    # Served from the synchronizer's snapshot once it has one
+    snapshot = get_portfolio_sync().snapshot
+    if snapshot is not None:
+        return snapshot.open_orders()
+    return _uncached_errors(_open_orders)
+
+
+# ---------------- Invalidation ----------------
+
+def invalidate_after_trade():
+    """A position was opened or closed: positions, orders, balances and transactions changed."""
+    get_portfolio_sync().poke()
+    _open_positions.clear()
+    _open_orders.clear()
+    _accounts.clear()
+    get_history_store().expire()
+
+
+def invalidate_after_order():
+    """A working order was placed: only the open orders changed until it fills."""
+    get_portfolio_sync().poke()
+    _open_orders.clear()
@@ -1,83 +1,238 @@
 import json
 import time
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from modules.capital_com_api import CapitalComAPI
+from modules.candle_store import prices_to_array
+from modules.tool_outputs import tool_cache, encode_prices, DEFAULT_MAX_CHARS, format_time
+from modules.tool_registry import ToolRegistry
+from modules.indicators import INDICATORS, latest_indicators, correlation, volatility, mid_prices
+from modules.market_catalog import MarketCatalog
 from dotenv import load_dotenv
 from openai import OpenAI
 import os
 from datetime import datetime
 
+# Events that end a run without an answer
+RUN_FAILED_EVENTS = ('thread.run.failed', 'thread.run.cancelled', 'thread.run.expired', 'thread.run.incomplete')
+
+
+class ToolPool:
+    def __init__(self, max_workers=8):
+        """
+        Initialize the ToolPool class.
+
+        Runs tool calls on at most `max_workers` threads. A call that timed out can be
+        abandoned: it keeps running on its thread, but no longer counts against the limit,
+        so hung tools cannot starve the calls queued behind them.
+
+        Parameters:
+        - max_workers (int): The most calls run at the same time, not counting abandoned ones.
+        """
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._workers = 0
+        # Future of each running call -> whether it still counts against max_workers
+        self._running = {}
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) and return its Future."""
+        future = Future()
+        with self._lock:
+            self._queue.append((future, fn, args))
+            self._start_worker()
+        return future
+
+    def abandon(self, future):
+        """Give up on a call: cancel it if it has not started, else stop counting its thread."""
+        if future.cancel():
+            return
+        with self._lock:
+            if self._running.get(future):
+                self._running[future] = False
+                self._workers -= 1
+                self._start_worker()
+
+    def _start_worker(self):
+        if self._queue and self._workers < self.max_workers:
+            self._workers += 1
+            threading.Thread(target=self._work, name='assistant-tool', daemon=True).start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._workers -= 1
+                    return
+                future, fn, args = self._queue.popleft()
+                self._running[future] = True
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            with self._lock:
+                if not self._running.pop(future):
+                    # Abandoned: another worker has already taken this thread's place
+                    return
+
+
+# Tool calls of all Assistants run on this pool, so a burst of questions cannot start unbounded threads
+_tool_pool = ToolPool(max_workers=8)
+
+
 class Assistant:
-    def __init__(self, capital_api_client):
+    def __init__(self, capital_api_client, tool_output_chars=DEFAULT_MAX_CHARS, openai_client=None, tool_timeout=30, tool_timeouts=None,
+                 market_catalog=None):
         load_dotenv()
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # Pass a client with its own base_url to run against a local stand-in of the Assistants API
+        self.openai_client = openai_client or OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
         self.capital_api_client = capital_api_client
+        # Size budget of each tool output sent to the model
+        self.tool_output_chars = tool_output_chars
+        # Seconds a tool call may take before the model is told it timed out, overridable per tool
+        self.tool_timeout = tool_timeout
+        self.tool_timeouts = tool_timeouts or {}
+        # Market lookups are answered from the local catalog, never from the API
+        self.market_catalog = market_catalog or MarketCatalog()
+        # The tools in the functions folder, each run by the method of the same name
+        self.tools = ToolRegistry(self)
 
     def get_current_datetime(self):
         """Get the current UTC date and time in ISO format."""
         return datetime.utcnow().isoformat()
 
-    def handle_requires_action(self, run_id, thread_id):
-        initial_interval = 1
-        max_interval = 3
-        interval = initial_interval
+    def get_stock_data(self, epic, resolution, max=10, from_date=None, to_date=None):
+        """Get compact price data for the model, shared for a while by every Assistant."""
+        key = ('get_stock_data', epic, resolution, max, from_date, to_date, self.tool_output_chars)
+        output = tool_cache.lookup(key)
+        if output is None:
+            response = self.capital_api_client.get_historical_prices(epic, resolution, max, from_date, to_date)
+            output = encode_prices(response, epic, resolution, self.tool_output_chars)
+            # Errors are not cached, so the next question tries again
+            if 'errorCode' not in response:
+                tool_cache.put(key, output)
+        return output
 
-        while True:
-            run = self.openai_client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-            status = run.status
-
-            if status == 'completed':
-                messages = self.openai_client.beta.threads.messages.list(thread_id=thread_id)
-                assistant_message = next(
-                    (msg.content for msg in messages if msg.role == 'assistant'),
-                    None
-                )
-                return assistant_message[0].text.value
-            elif status in ['cancelled', 'failed', 'incomplete']:
-                return None
-            elif status == 'requires_action':
-                tool_calls = run.required_action.submit_tool_outputs.tool_calls
-                tool_outputs = self.handle_tool_calls(tool_calls)
-                self.openai_client.beta.threads.runs.submit_tool_outputs(thread_id=thread_id, run_id=run_id, tool_outputs=tool_outputs)
-
-                return self.handle_requires_action(run_id, thread_id)
-
-            time.sleep(interval)
-            interval = min(interval * 2, max_interval)
+    def get_indicators(self, epic, resolution, indicators=None, max=200, window=20, period=14):
+        """Compute technical indicators locally and return only their latest values."""
+        candles = self._candles(epic, resolution, max)
+        values = latest_indicators(candles, indicators or INDICATORS, window, period)
+        return dict({'epic': epic, 'resolution': resolution, 'bars': len(candles), 'time': format_time(candles['timestamp'][-1])}, **values)
 
-    def handle_tool_calls(self, tool_calls):
-        tool_outputs = []
+    def get_correlation(self, epics, resolution, max=200):
+        """Correlate the returns of several epics locally and return the pairwise correlations."""
+        candles = {epic: self._candles(epic, resolution, max) for epic in dict.fromkeys(epics)}
+        if len(candles) < 2:
+            raise ValueError("get_correlation needs at least two different epics")
+        matrix, bars = correlation(candles)
+        names = list(candles)
+        return {
+            'resolution': resolution,
+            'bars': bars,
+            'pairs': [[first, second, _rounded(matrix.loc[first, second], 3)] for i, first in enumerate(names) for second in names[i + 1:]],
+            'volatility': {epic: _rounded(volatility(mid_prices(array), array['timestamp']), 4) for epic, array in candles.items()}
+        }
 
-        for tool in tool_calls:
-            args = json.loads(tool.function.arguments)
+    def find_markets(self, query, limit=5, market_type=None):
+        """Look up epics by name, symbol or part of an epic in the local market catalog."""
+        if not len(self.market_catalog.index):
+            return {'query': query, 'matches': [], 'note': 'The market catalog has not been built yet'}
+        matches = self.market_catalog.search(query, min(limit, 20), market_type)
+        return {
+            'query': query,
+            'matches': [[match['epic'], match.get('name'), match.get('type'), match.get('currency')] for match in matches],
+            'columns': ['epic', 'name', 'type', 'currency']
+        }
 
-            tool_name = tool.function.name
-            output = None
+    def _candles(self, epic, resolution, max):
+        """The latest candles of an epic as a CANDLE_DTYPE array, shared for a while by every Assistant."""
+        key = ('candles', epic, resolution, max)
+        candles = tool_cache.lookup(key)
+        if candles is None:
+            response = self.capital_api_client.get_historical_prices(epic, resolution, max)
+            if 'prices' not in response:
+                raise ValueError(f"No prices for {epic}: {response.get('errorCode', 'unknown error')}")
+            candles = prices_to_array(response['prices'])
+            if not len(candles):
+                raise ValueError(f"No prices for {epic}")
+            tool_cache.put(key, candles)
+        return candles
 
-            if tool_name == 'get_current_datetime':
-                try:
-                    output = self.get_current_datetime()
-                except Exception as e:
-                    output = str(e)
-            elif tool_name == 'get_stock_data':
-                try:
-                    epic = args['epic']
-                    resolution= args['resolution']
-                    max= args['max']
-
-                    output = self.capital_api_client.get_historical_prices(
-                        epic,
-                        resolution,
-                        max
-                    )
-                    output = json.dumps(output, indent=4)
-                except Exception as e:
-                    print(f"Error retrieving stock data: {str(e)}")
-                    output = "error retrieving stock data"
+    def handle_run_stream(self, stream, on_delta=None):
+        """
+        Follow a streamed run to its answer, answering tool calls as they are required.
+
+        Each submit_tool_outputs continues the run as a new stream, which this loop
+        follows in turn.
+
+        Parameters:
+        - stream: The event stream of a run, from create_and_run, runs.create or submit_tool_outputs with stream=True.
+        - on_delta (callable): Called with every piece of answer text as it arrives.
+
+        Returns:
+        - answer (str): The text of the run's last message, or None if the run failed.
+        """
+        answer = None
+        while stream is not None:
+            required = None
+            with stream:
+                for event in stream:
+                    if event.event == 'thread.message.delta' and on_delta:
+                        for block in event.data.delta.content or []:
+                            if block.type == 'text' and block.text.value:
+                                on_delta(block.text.value)
+                    elif event.event == 'thread.message.completed':
+                        answer = ''.join(block.text.value for block in event.data.content if block.type == 'text')
+                    elif event.event == 'thread.run.requires_action':
+                        required = event.data
+                    elif event.event in RUN_FAILED_EVENTS:
+                        print(f"Assistant run ended with {event.event}")
+                        return None
+            stream = None
+            if required is not None:
+                tool_outputs = self.handle_tool_calls(required.required_action.submit_tool_outputs.tool_calls)
+                stream = self.openai_client.beta.threads.runs.submit_tool_outputs(
+                    thread_id=required.thread_id, run_id=required.id, tool_outputs=tool_outputs, stream=True)
+        return answer
+
+    def run_tool(self, tool_name, args):
+        """Run one tool call and return its output."""
+        return self.tools.call(tool_name, args)
+
+    def _run_tool_call(self, tool_name, arguments):
+        # Parsed in the worker, so malformed arguments come back as this call's error output
+        return self.run_tool(tool_name, json.loads(arguments or '{}'))
+
+    def handle_tool_calls(self, tool_calls):
+        """Run the tool calls of a run at the same time and collect their outputs in order."""
+        started = time.monotonic()
+        futures = [
+            (tool, _tool_pool.submit(self._run_tool_call, tool.function.name, tool.function.arguments))
+            for tool in tool_calls
+        ]
+        tool_outputs = []
+        for tool, future in futures:
+            tool_name = tool.function.name
+            timeout = self.tool_timeouts.get(tool_name, self.tool_timeout)
+            try:
+                output = future.result(timeout=max(0, started + timeout - time.monotonic()))
+            except FutureTimeoutError:
+                # Not waited for any more, so it must not hold a slot other Assistants' calls need
+                _tool_pool.abandon(future)
+                print(f"Tool {tool_name} timed out after {timeout}s")
+                output = f"{tool_name} timed out"
+            except Exception as e:
+                print(f"Error running {tool_name}: {str(e)}")
+                # The reason lets the model correct its arguments
+                output = f"error running {tool_name}: {str(e)}"
 
             if output is not None:
                 tool_outputs.append({
                     'tool_call_id': tool.id,
-                    'output': json.dumps(output)
+                    'output': output if isinstance(output, str) else json.dumps(output, separators=(',', ':'))
                 })
             else:
                 tool_outputs.append({
@@ -87,7 +242,7 @@ class Assistant:
 
         return tool_outputs
 
-    def chat_with_assistant(self, assistant_id, question, thread_id=None):
+    def chat_with_assistant(self, assistant_id, question, thread_id=None, on_delta=None):
         thread_id = 'skip'
 
         if thread_id and thread_id != 'skip':
@@ -111,15 +266,19 @@ class Assistant:
 
             # Create a new message in the thread and start a new run
             self.openai_client.beta.threads.messages.create(thread_id=thread_id, role='user', content=question)
-            run = self.openai_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
-            run_id = run.id
+            stream = self.openai_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id, stream=True)
         else:
             # Create a new thread and run if no thread exists
-            response = self.openai_client.beta.threads.create_and_run(
+            stream = self.openai_client.beta.threads.create_and_run(
                 assistant_id=assistant_id,
-                thread={"messages": [{"role": "user", "content": question}]}
+                thread={"messages": [{"role": "user", "content": question}]},
+                stream=True
             )
-            run_id = response.id
-            thread_id = response.thread_id
 
-        return self.handle_requires_action(run_id, thread_id)
+        return self.handle_run_stream(stream, on_delta)
+
+
+def _rounded(value, digits):
+    """A float rounded for a tool output, or None when it is NaN."""
+    value = float(value)
+    return None if value != value else round(value, digits)
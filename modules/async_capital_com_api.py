@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+import aiohttp
+from modules.capital_com_api import CapitalComAPI, ServerError, RETRY_STATUSES, IDEMPOTENT_METHODS
+from modules.rate_limiter import RateLimiter
+from modules.candle_store import prices_to_array
+
+
+class AsyncCapitalComAPI(CapitalComAPI):
+    def __init__(self, api_key, identifier, password, base_url='https://api-capital.backend-capital.com/', demo=False, candle_store=None, rate_limiter=None,
+                 pool_size=100, max_retries=3, backoff_factor=0.5, timeout=30):
+        """
+        Initialize the AsyncCapitalComAPI class.
+
+        Every CapitalComAPI method is available as a coroutine. Requests share one pooled
+        aiohttp session and the same rate limiter as the blocking client, so many requests
+        can be in flight at once without exceeding the broker's budget. Use it as an async
+        context manager, which starts and closes the session:
+
+            async with AsyncCapitalComAPI(api_key, identifier, password) as api:
+                prices = await api.get_historical_prices('GOLD', 'HOUR', 100)
+
+        Parameters:
+        - pool_size (int): The maximum number of simultaneous connections.
+        """
+        self.api_key = api_key
+        self.identifier = identifier
+        self.password = password
+        self.session_token = None
+        self.security_token = None
+        self.base_url = base_url if not demo else 'https://demo-api-capital.backend-capital.com/'
+        self.headers = {
+            'X-CAP-API-KEY': self.api_key,
+            'Content-Type': 'application/json'
+        }
+        self.rate_limiter = rate_limiter or RateLimiter(directory=os.path.join(
+            tempfile.gettempdir(), 'capital_com_rate_limits', hashlib.sha256((api_key or '').encode()).hexdigest()[:16]))
+        self.candle_store = candle_store
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.http = None
+        self._session_lock = None
+        self._keepalive_task = None
+        self._candle_listeners = []
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        """Create the pooled HTTP session and log in."""
+        if self.http is None:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._session_lock = asyncio.Lock()
+        await self.start_session()
+
+    async def close(self):
+        """Stop the keep-alive task and close the HTTP session."""
+        self.stop_keepalive()
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def _make_request(self, method, url, priority=None, **kwargs):
+        """Make an HTTP request with rate limiting, re-authentication and retries; the body is read."""
+        is_session_request = url == self.base_url + 'api/v1/session'
+        reauthenticated = False
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_for_async(method, url, priority)
+            session_token = self.session_token
+            try:
+                async with self.http.request(method, url, headers=self.headers, **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                await self._backoff(attempt)
+                attempt += 1
+                continue
+
+            if response.status == 401 and not is_session_request and not reauthenticated:
+                await self._refresh_session(session_token)
+                reauthenticated = True
+                continue
+
+            retryable = response.status == 429 or (
+                response.status in RETRY_STATUSES and method.upper() in IDEMPOTENT_METHODS)
+            if not retryable or attempt >= self.max_retries:
+                return response
+            if response.status == 429:
+                self.rate_limiter.drain_for(method, url)
+            await self._backoff(attempt, response)
+            attempt += 1
+
+    async def _request_json(self, method, url, priority=None, **kwargs):
+        """Make a request and decode its JSON body; raise ServerError for a POST answered with a 5xx."""
+        response = await self._make_request(method, url, priority=priority, **kwargs)
+        if response.status >= 500 and method.upper() not in IDEMPOTENT_METHODS:
+            raise ServerError(f"{response.status} from {method} {url}", response=response)
+        return await response.json(content_type=None)
+
+    async def _backoff(self, attempt, response=None):
+        """Sleep before a retry: honour Retry-After, else exponential backoff with full jitter."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                await asyncio.sleep(float(retry_after))
+                return
+            except ValueError:
+                pass
+        await asyncio.sleep(random.uniform(0, self.backoff_factor * (2 ** attempt)))
+
+    async def _refresh_session(self, expired_token):
+        """Start a new session unless another task already replaced `expired_token`."""
+        async with self._session_lock:
+            if self.session_token == expired_token:
+                await self.start_session()
+
+    async def start_session(self):
+        """Start a new session and obtain session tokens"""
+        url = self.base_url + 'api/v1/session'
+        payload = {
+            "identifier": self.identifier,
+            "password": self.password,
+            "encryptedPassword": False
+        }
+        response = await self._make_request('POST', url, json=payload)
+        if response.status == 200:
+            self.session_token = response.headers['CST']
+            self.security_token = response.headers['X-SECURITY-TOKEN']
+            self.headers.update({
+                'CST': self.session_token,
+                'X-SECURITY-TOKEN': self.security_token
+            })
+        else:
+            raise Exception(f"Failed to start session: {await response.text()}")
+
+    def start_keepalive(self, interval=300):
+        """Ping from a background task every `interval` seconds."""
+        self.stop_keepalive()
+
+        async def keepalive():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.ping()
+                except Exception as e:
+                    print(f"Keep-alive ping failed: {str(e)}")
+
+        self._keepalive_task = asyncio.get_running_loop().create_task(keepalive())
+
+    def stop_keepalive(self):
+        """Cancel the background keep-alive task."""
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+
+    async def get_historical_prices(self, epic, resolution='MINUTE', max=10, from_date=None, to_date=None):
+        """Retrieve historical prices for a specific market, from the candle store when one is set"""
+        if self.candle_store is None:
+            response = await self._fetch_historical_prices(epic, resolution, max, from_date, to_date)
+        else:
+            # The store does blocking file I/O, so run it in a thread and hand its fetches back to this loop
+            loop = asyncio.get_running_loop()
+
+            def fetch(*args, **kwargs):
+                return asyncio.run_coroutine_threadsafe(self._fetch_historical_prices(*args, **kwargs), loop).result()
+
+            response = await asyncio.to_thread(
+                self.candle_store.get_historical_prices, fetch, epic, resolution, max, from_date, to_date)
+        if self._candle_listeners and response.get('prices'):
+            self._notify_candles(epic, resolution, prices_to_array(response['prices']))
+        return response
@@ -0,0 +1,115 @@
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modules.rate_limiter import PRIORITY_LOW
+from modules.candle_store import (
+    CandleStore, RESOLUTION_SECONDS, MAX_BARS_PER_REQUEST, parse_api_time, split_window
+)
+
+
+class Backfiller:
+    def __init__(self, api_client, candle_store=None, max_workers=4, bars_per_window=MAX_BARS_PER_REQUEST):
+        """
+        Initialize the Backfiller class.
+
+        The candle store's record of fetched windows doubles as the checkpoint, so an
+        interrupted backfill resumes with the windows that are still missing.
+
+        Parameters:
+        - api_client (CapitalComAPI): The client whose rate limit all requests share.
+        - candle_store (CandleStore): Where to keep the bars; defaults to the client's store.
+        - max_workers (int): The number of windows kept in flight at once.
+        - bars_per_window (int): The number of bars requested per window (at most 1000).
+        """
+        self.api_client = api_client
+        self.candle_store = candle_store or api_client.candle_store or CandleStore()
+        self.max_workers = max_workers
+        self.bars_per_window = min(bars_per_window, MAX_BARS_PER_REQUEST)
+
+    def plan(self, epics, resolution, start, end):
+        """
+        Split [start, end] into request windows for every epic, skipping windows already stored.
+
+        Windows are interleaved round-robin across epics so every instrument makes progress
+        at the same pace.
+
+        Returns:
+        - windows (list): (epic, window_start, window_end) tuples in epoch seconds.
+        """
+        period = RESOLUTION_SECONDS[resolution]
+        start, end = _to_epoch(start), _to_epoch(end)
+        per_epic = []
+        for epic in epics:
+            windows = []
+            for missing_start, missing_end in self.candle_store.missing_windows(epic, resolution, start, end):
+                windows.extend(split_window(missing_start, missing_end, period, self.bars_per_window))
+            per_epic.append([(epic, window_start, window_end) for window_start, window_end in windows])
+
+        planned = []
+        for round_windows in _round_robin(per_epic):
+            planned.extend(round_windows)
+        return planned
+
+    def run(self, epics, resolution, start, end, progress=None):
+        """
+        Download every missing window of [start, end] for the given epics into the candle store.
+
+        Parameters:
+        - progress (callable): Optional progress(done, total) callback.
+
+        Returns:
+        - report (dict): Per epic, the number of stored bars in the range and any error responses.
+        """
+        windows = self.plan(epics, resolution, start, end)
+        # Bulk downloads queue behind interactive requests and orders
+        fetch = partial(self.api_client._fetch_historical_prices, priority=PRIORITY_LOW)
+        errors = {epic: [] for epic in epics}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.candle_store.fetch_window, fetch, epic, resolution,
+                    window_start, window_end, self.bars_per_window
+                ): epic
+                for epic, window_start, window_end in windows
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                epic = futures[future]
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = {'errorCode': str(e)}
+                if error is not None:
+                    errors[epic].append(error)
+                if progress:
+                    progress(done, len(windows))
+
+        start, end = _to_epoch(start), _to_epoch(end)
+        return {
+            epic: {
+                'bars': len(self.candle_store.read(epic, resolution, start, end)),
+                'errors': errors[epic]
+            }
+            for epic in epics
+        }
+
+
+def backfill(api_client, epics, resolution, start, end, max_workers=4, progress=None):
+    """Download [start, end] of history for many epics into the client's candle store."""
+    return Backfiller(api_client, max_workers=max_workers).run(epics, resolution, start, end, progress)
+
+
+def _to_epoch(value):
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value is None:
+        return int(time.time())
+    if not isinstance(value, str):
+        value = value.isoformat()
+    return parse_api_time(value)
+
+
+def _round_robin(lists):
+    """Yield one item from each non-empty list per round."""
+    for i in range(max((len(items) for items in lists), default=0)):
+        yield [items[i] for items in lists if i < len(items)]
@@ -0,0 +1,204 @@
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from modules.candle_store import CandleStore, RESOLUTION_SECONDS, parse_api_time
+from modules.decoder import candles_to_frame
+from modules.model_registry import ModelRegistry
+from modules.predictors import AutoGluonTrainer, predictor_cache
+from modules.worker_limits import limit_worker_cpus
+
+
+class WalkForwardBacktest:
+    def __init__(self, candle_store=None, resolution="HOUR", train_size=500, prediction_length=10, step=None,
+                 registry=None, max_workers=None, cpus_per_worker=1, time_limit=None, threshold=0.0, size=1.0):
+        """
+        Initialize the WalkForwardBacktest class.
+
+        Slices the stored history of every epic into rolling folds: a model is trained on
+        train_size bars and forecasts the next prediction_length bars. Fold boundaries fall
+        on the first bar of each step-bar time block, counted from the epoch, so the folds
+        of a range stay the same when it is extended and earlier folds are not retrained.
+        Fold models are versioned in a registry and their forecasts cached next to it.
+
+        A fold's forecast becomes a trade: long when the forecast close at the end of the
+        horizon is more than `threshold` above the last close, short when it is as far
+        below. Trades open at the last training bar and close at the end of the horizon,
+        buying at the ask and selling at the bid.
+
+        Parameters:
+        - candle_store (CandleStore): Where the history is read from.
+        - resolution (str): The bar resolution to test.
+        - train_size (int): Bars of history each fold model is trained on.
+        - prediction_length (int): Bars forecast and held per fold.
+        - step (int): Bars between fold boundaries (default: prediction_length, so trades don't overlap).
+        - registry (ModelRegistry): Where fold models are kept (default: models/backtests).
+        - max_workers (int): The number of folds trained at once (default: CPUs / cpus_per_worker).
+        - cpus_per_worker (int): The CPU cores each worker's numeric libraries may use.
+        - time_limit (float): Seconds each fold's fit may take.
+        - threshold (float): The fractional forecast move needed to trade.
+        - size (float): The position size of every trade.
+        """
+        self.candle_store = candle_store or CandleStore()
+        self.resolution = resolution
+        self.train_size = train_size
+        self.prediction_length = prediction_length
+        self.step = step or prediction_length
+        # Fold models get their own registry so they never push production models out of the disk quota
+        self.registry = registry or ModelRegistry(os.path.join("models", "backtests"), max_versions=1)
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 1) // cpus_per_worker)
+        self.cpus_per_worker = cpus_per_worker
+        self.time_limit = time_limit
+        self.threshold = threshold
+        self.size = size
+
+    def folds(self, candles):
+        """
+        Return the fold boundaries of a candle series: the index of the first test bar of
+        every fold that has a full training window and a full horizon after it.
+        """
+        block = RESOLUTION_SECONDS[self.resolution] * self.step
+        blocks = candles['timestamp'] // block
+        boundaries = np.flatnonzero(np.diff(blocks)) + 1
+        return boundaries[(boundaries >= self.train_size) & (boundaries + self.prediction_length <= len(candles))]
+
+    def _fold_tasks(self, epic, candles):
+        tasks = []
+        params = {'prediction_length': self.prediction_length, 'resolution': self.resolution}
+        for boundary in self.folds(candles):
+            train = candles_to_frame(candles[boundary - self.train_size:boundary], epic)[['item_id', 'timestamp', 'target']]
+            fingerprint, _ = self.registry.fingerprint(train, params)
+            tasks.append({
+                'epic': epic,
+                'boundary': int(boundary),
+                'data': train,
+                'model_path': os.path.join(
+                    self.registry.model_dir, f"{epic}_{self.resolution}_{int(candles['timestamp'][boundary])}"),
+                'forecast_path': os.path.join(self.registry.model_dir, 'forecasts', f"{fingerprint[:32]}.pkl")
+            })
+        return tasks
+
+    def run(self, epics, start=None, end=None, progress=None):
+        """
+        Backtest the given epics over their stored history in [start, end].
+
+        Parameters:
+        - epics (list): The epics to test; their history must be in the candle store (see backfill).
+        - start, end (str or int): The range, as API times or epoch seconds (default: everything stored).
+        - progress (callable): Optional progress(done, total) callback, called per fold.
+
+        Returns:
+        - result (dict): 'trades', one row per fold, and 'summary', one row per epic with
+          folds, trades, hit_rate, pnl, total_return, max_drawdown and forecast mae.
+        """
+        start, end = _to_epoch(start), _to_epoch(end)
+        candles = {epic: np.array(self.candle_store.read(epic, self.resolution, start, end)) for epic in epics}
+        tasks = [task for epic in epics for task in self._fold_tasks(epic, candles[epic])]
+
+        forecasts = {}
+        cached = [task for task in tasks if os.path.exists(task['forecast_path'])]
+        for task in cached:
+            forecasts[(task['epic'], task['boundary'])] = pd.read_pickle(task['forecast_path'])
+        pending = [task for task in tasks if (task['epic'], task['boundary']) not in forecasts]
+        done = len(cached)
+        if progress and tasks:
+            progress(done, len(tasks))
+
+        if pending:
+            # Spawned, not forked: the app's threads may hold locks, and the limits must be set before the libraries load
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=limit_worker_cpus, initargs=(self.cpus_per_worker,)) as executor:
+                futures = {
+                    executor.submit(
+                        _run_fold, task['epic'], self.resolution, self.prediction_length, task['data'],
+                        task['model_path'], task['forecast_path'], self.registry, self.time_limit
+                    ): task
+                    for task in pending
+                }
+                for future in as_completed(futures):
+                    task = futures[future]
+                    try:
+                        forecasts[(task['epic'], task['boundary'])] = future.result()
+                    except Exception as e:
+                        print(f"Backtest fold {task['epic']} at bar {task['boundary']} failed: {str(e)}")
+                    done += 1
+                    if progress:
+                        progress(done, len(tasks))
+
+        trades = pd.DataFrame(
+            [self._trade(task, candles[task['epic']], forecasts[(task['epic'], task['boundary'])])
+             for task in tasks if (task['epic'], task['boundary']) in forecasts],
+            columns=['epic', 'entry_time', 'exit_time', 'forecast', 'last_close', 'actual_close',
+                     'direction', 'entry_price', 'exit_price', 'pnl', 'return'])
+        return {'trades': trades, 'summary': summarize(trades, epics)}
+
+    def _trade(self, task, candles, forecast):
+        boundary = task['boundary']
+        entry, exit = candles[boundary - 1], candles[boundary + self.prediction_length - 1]
+        predicted = float(forecast['mean'].iloc[self.prediction_length - 1])
+        last_close = float(entry['close_bid'])
+        move = (predicted - last_close) / last_close
+        direction = 1 if move > self.threshold else -1 if move < -self.threshold else 0
+        if direction > 0:
+            entry_price, exit_price = float(entry['close_ask']), float(exit['close_bid'])
+        elif direction < 0:
+            entry_price, exit_price = float(entry['close_bid']), float(exit['close_ask'])
+        else:
+            entry_price = exit_price = np.nan
+        pnl = direction * (exit_price - entry_price) * self.size if direction else 0.0
+        return {
+            'epic': task['epic'],
+            'entry_time': pd.to_datetime(int(entry['timestamp']), unit='s'),
+            'exit_time': pd.to_datetime(int(exit['timestamp']), unit='s'),
+            'forecast': predicted,
+            'last_close': last_close,
+            'actual_close': float(exit['close_bid']),
+            'direction': direction,
+            'entry_price': entry_price,
+            'exit_price': exit_price,
+            'pnl': pnl,
+            'return': direction * (exit_price - entry_price) / entry_price if direction else 0.0
+        }
+
+
+def summarize(trades, epics=None):
+    """Per epic: folds, trades taken, hit rate, total PnL, summed return, max PnL drawdown and forecast MAE."""
+    rows = []
+    for epic in epics if epics is not None else trades['epic'].unique():
+        folds = trades[trades['epic'] == epic].sort_values('entry_time')
+        taken = folds[folds['direction'] != 0]
+        cumulative = np.concatenate(([0.0], taken['pnl'].cumsum().to_numpy()))
+        rows.append({
+            'epic': epic,
+            'folds': len(folds),
+            'trades': len(taken),
+            'hit_rate': (taken['pnl'] > 0).mean() if len(taken) else np.nan,
+            'pnl': taken['pnl'].sum(),
+            'total_return': taken['return'].sum(),
+            'max_drawdown': (np.maximum.accumulate(cumulative) - cumulative).max(),
+            'mae': (folds['forecast'] - folds['actual_close']).abs().mean() if len(folds) else np.nan
+        })
+    return pd.DataFrame(rows)
+
+
+def _run_fold(epic, resolution, prediction_length, data, model_path, forecast_path, registry, time_limit):
+    """Worker process: train (or reuse) one fold's model and cache its forecast."""
+    trainer = AutoGluonTrainer(epic, resolution, None, prediction_length, model_path=model_path, registry=registry)
+    trainer.train_model(data, "target", time_limit=time_limit)
+    forecast = trainer.make_predictions(data).loc[epic]
+    os.makedirs(os.path.dirname(forecast_path), exist_ok=True)
+    tmp_path = forecast_path + f".{os.getpid()}.tmp"
+    forecast.to_pickle(tmp_path)
+    os.replace(tmp_path, forecast_path)
+    # Workers only train; keeping the predictor would just hold memory in this process
+    predictor_cache.invalidate(trainer.model_path)
+    return forecast
+
+
+def _to_epoch(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, str):
+        value = value.isoformat()
+    return parse_api_time(value)
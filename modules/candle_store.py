@@ -0,0 +1,412 @@
+import os
+import re
+import json
+import time
+import itertools
+import threading
+from datetime import datetime, timezone
+import numpy as np
+
+# Length of one bar in seconds for every resolution the prices endpoint accepts
+RESOLUTION_SECONDS = {
+    "MINUTE": 60,
+    "MINUTE_5": 300,
+    "MINUTE_15": 900,
+    "MINUTE_30": 1800,
+    "HOUR": 3600,
+    "HOUR_4": 14400,
+    "DAY": 86400,
+    "WEEK": 604800
+}
+
+# Largest 'max' the prices endpoint accepts in a single request
+MAX_BARS_PER_REQUEST = 1000
+
+CANDLE_DTYPE = np.dtype([
+    ('timestamp', 'i8'),
+    ('open_bid', 'f8'),
+    ('open_ask', 'f8'),
+    ('high_bid', 'f8'),
+    ('high_ask', 'f8'),
+    ('low_bid', 'f8'),
+    ('low_ask', 'f8'),
+    ('close_bid', 'f8'),
+    ('close_ask', 'f8'),
+    ('volume', 'f8')
+])
+
+# Payload field -> (bid column, ask column)
+_PRICE_FIELDS = {
+    'openPrice': ('open_bid', 'open_ask'),
+    'highPrice': ('high_bid', 'high_ask'),
+    'lowPrice': ('low_bid', 'low_ask'),
+    'closePrice': ('close_bid', 'close_ask')
+}
+
+# Consecutive empty windows after which we assume there is no older history
+_MAX_EMPTY_WINDOWS = 5
+
+
+def _chunk_dir(data_path):
+    """The directory of a key's merged windows that are not yet folded into its main file."""
+    return data_path[:-len('.npy')] + '.chunks'
+
+
+def parse_api_time(value):
+    """Convert an API date string (YYYY-MM-DDTHH:MM:SS, UTC) to epoch seconds."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def format_api_time(timestamp):
+    """Convert epoch seconds to the API date format (YYYY-MM-DDTHH:MM:SS, UTC)."""
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def prices_to_array(prices):
+    """Convert the 'prices' list of a price response into a CANDLE_DTYPE array."""
+    candles = np.empty(len(prices), dtype=CANDLE_DTYPE)
+    if not prices:
+        return candles
+    candles['timestamp'] = np.array(
+        [price['snapshotTimeUTC'] for price in prices], dtype='datetime64[s]').astype('i8')
+    for field, (bid_column, ask_column) in _PRICE_FIELDS.items():
+        candles[bid_column] = [_side(price, field, 'bid') for price in prices]
+        candles[ask_column] = [_side(price, field, 'ask') for price in prices]
+    candles['volume'] = [price.get('lastTradedVolume', np.nan) for price in prices]
+    return candles
+
+
+def array_to_prices(candles):
+    """Convert a CANDLE_DTYPE array back into the 'prices' list of a price response."""
+    prices = []
+    times = candles['timestamp'].astype('datetime64[s]').astype(str)
+    for i in range(len(candles)):
+        row = candles[i]
+        price = {
+            'snapshotTime': times[i],
+            'snapshotTimeUTC': times[i]
+        }
+        for field, (bid_column, ask_column) in _PRICE_FIELDS.items():
+            price[field] = {'bid': _number(row[bid_column]), 'ask': _number(row[ask_column])}
+        price['lastTradedVolume'] = _number(row['volume'])
+        prices.append(price)
+    return prices
+
+
+def _side(price, field, side):
+    value = (price.get(field) or {}).get(side)
+    return np.nan if value is None else value
+
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+
+class CandleStore:
+    def __init__(self, root="data/candles", derive_resolutions=()):
+        """
+        Initialize the CandleStore class.
+
+        Candles are kept as one memory-mapped NumPy file per (epic, resolution),
+        next to a small JSON file recording which time windows have already been
+        fetched from the API. Merged windows are first written as small chunk files
+        and folded into the main file once, on the next read (or compact()), so a
+        backfill of many windows does not rewrite the whole history for every one.
+
+        Parameters:
+        - root (str): The directory to keep the candle files in.
+        - derive_resolutions (tuple): Resolutions answered by aggregating stored MINUTE
+          bars whenever those cover the request, instead of downloading them.
+        """
+        self.root = root
+        self.derive_resolutions = tuple(derive_resolutions)
+        self._lock = threading.RLock()
+        self._key_locks = {}  # data path -> lock of that key's files
+        self._cache = {}
+        self._chunk_ids = itertools.count()
+
+    def _paths(self, epic, resolution):
+        safe_epic = re.sub(r'[^A-Za-z0-9._-]', '_', epic)
+        directory = os.path.join(self.root, safe_epic)
+        return os.path.join(directory, f"{resolution}.npy"), os.path.join(directory, f"{resolution}.json")
+
+    def _key_lock(self, data_path):
+        with self._lock:
+            return self._key_locks.setdefault(data_path, threading.RLock())
+
+    def read_meta(self, epic, resolution):
+        """Return the stored metadata (coverage and instrument info) for a key."""
+        _, meta_path = self._paths(epic, resolution)
+        if not os.path.exists(meta_path):
+            return {'coverage': [], 'info': {}}
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+
+    def _write_meta(self, epic, resolution, meta):
+        _, meta_path = self._paths(epic, resolution)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, meta_path)
+
+    def load(self, epic, resolution):
+        """Return all stored candles for a key as a read-only memory-mapped array."""
+        data_path, _ = self._paths(epic, resolution)
+        if os.path.isdir(_chunk_dir(data_path)):
+            self.compact(epic, resolution)
+        if not os.path.exists(data_path):
+            return np.empty(0, dtype=CANDLE_DTYPE)
+        mtime = os.stat(data_path).st_mtime_ns
+        cached = self._cache.get(data_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, np.load(data_path, mmap_mode='r'))
+            self._cache[data_path] = cached
+        return cached[1]
+
+    def read(self, epic, resolution, start=None, end=None):
+        """Return the stored candles with start <= timestamp <= end (epoch seconds)."""
+        candles = self.load(epic, resolution)
+        timestamps = candles['timestamp']
+        lo = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+        hi = len(candles) if end is None else np.searchsorted(timestamps, end, side='right')
+        return candles[lo:hi]
+
+    def merge(self, epic, resolution, candles, window=None, info=None):
+        """
+        Merge candles into the store and mark a window as fetched.
+
+        Parameters:
+        - candles (np.ndarray): Candles in CANDLE_DTYPE; newer values win on duplicate timestamps.
+        - window (tuple): The (start, end) epoch-second window the candles were fetched for.
+        - info (dict): Non-price fields of the response (e.g. instrumentType) to keep.
+        """
+        data_path, _ = self._paths(epic, resolution)
+        with self._key_lock(data_path):
+            if len(candles):
+                # Only the new window is written now; load() folds the chunks into the main file
+                chunk_dir = _chunk_dir(data_path)
+                os.makedirs(chunk_dir, exist_ok=True)
+                name = f"{time.time_ns():020d}-{os.getpid()}-{next(self._chunk_ids):06d}"
+                tmp_path = os.path.join(chunk_dir, name + '.tmp.npy')
+                np.save(tmp_path, np.sort(candles, order='timestamp'))
+                os.replace(tmp_path, os.path.join(chunk_dir, name + '.npy'))
+
+            meta = self.read_meta(epic, resolution)
+            if window is not None:
+                meta['coverage'] = _add_interval(meta['coverage'], window)
+            if info:
+                meta['info'] = info
+            self._write_meta(epic, resolution, meta)
+
+    def compact(self, epic, resolution):
+        """Fold a key's pending chunk files into its main file in one sort; newer chunks win on duplicate timestamps."""
+        data_path, _ = self._paths(epic, resolution)
+        chunk_dir = _chunk_dir(data_path)
+        with self._key_lock(data_path):
+            try:
+                names = sorted(name for name in os.listdir(chunk_dir) if not name.endswith('.tmp.npy'))
+            except FileNotFoundError:
+                return
+            chunks = []
+            for name in reversed(names):
+                try:
+                    chunks.append(np.load(os.path.join(chunk_dir, name)))
+                except FileNotFoundError:
+                    pass  # folded in by another process meanwhile
+            if chunks:
+                if os.path.exists(data_path):
+                    chunks.append(np.load(data_path))
+                combined = np.concatenate(chunks)
+                # np.unique keeps the first occurrence, so the newest chunk wins
+                _, index = np.unique(combined['timestamp'], return_index=True)
+                tmp_path = data_path + f".{os.getpid()}.tmp.npy"
+                np.save(tmp_path, combined[index])
+                os.replace(tmp_path, data_path)
+                self._cache.pop(data_path, None)
+            for name in names:
+                try:
+                    os.remove(os.path.join(chunk_dir, name))
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(chunk_dir)
+            except OSError:
+                pass  # another chunk arrived meanwhile
+
+    def missing_windows(self, epic, resolution, start, end):
+        """Return the parts of [start, end] that have not been fetched yet."""
+        missing = []
+        cursor = start
+        for covered_start, covered_end in self.read_meta(epic, resolution)['coverage']:
+            if covered_end < cursor:
+                continue
+            if covered_start > end:
+                break
+            if covered_start > cursor:
+                missing.append((cursor, covered_start))
+            cursor = max(cursor, covered_end)
+        if cursor < end:
+            missing.append((cursor, end))
+        return missing
+
+    def fill(self, fetch, epic, resolution, start, end, max_bars=MAX_BARS_PER_REQUEST):
+        """
+        Fetch every missing part of [start, end] from the API and merge it into the store.
+
+        Parameters:
+        - fetch (callable): fetch(epic, resolution, max, from_date, to_date) returning a price response.
+        - max_bars (int): The number of bars to request per window.
+
+        Returns:
+        - error (dict): The first error response from the API, or None.
+        """
+        period = RESOLUTION_SECONDS[resolution]
+        for window_start, window_end in self.missing_windows(epic, resolution, start, end):
+            for chunk_start, chunk_end in split_window(window_start, window_end, period, max_bars):
+                error = self.fetch_window(fetch, epic, resolution, chunk_start, chunk_end, max_bars)
+                if error is not None:
+                    return error
+        return None
+
+    def fetch_window(self, fetch, epic, resolution, start, end, max_bars=MAX_BARS_PER_REQUEST):
+        """Fetch a single window from the API and merge it; return the error response if any."""
+        response = fetch(epic, resolution, max_bars, format_api_time(start), format_api_time(end))
+        if 'prices' in response:
+            candles = prices_to_array(response['prices'])
+            info = {key: value for key, value in response.items() if key != 'prices'}
+        elif response.get('errorCode') == 'error.prices.not-found':
+            candles, info = np.empty(0, dtype=CANDLE_DTYPE), None
+        else:
+            return response
+
+        # Never mark the bar that is still forming as fetched, so it is refreshed next time
+        period = RESOLUTION_SECONDS[resolution]
+        end = min(end, int(time.time()) // period * period)
+        if len(candles) >= max_bars:
+            # The window held more bars than one response carries
+            end = min(end, int(candles['timestamp'].max()))
+        self.merge(epic, resolution, candles, window=(start, end) if end > start else None, info=info)
+        return None
+
+    def get_historical_prices(self, fetch, epic, resolution='MINUTE', max=10, from_date=None, to_date=None):
+        """
+        Answer a historical prices request from the store, fetching only what is missing.
+
+        With from_date the first `max` bars of [from_date, to_date] are returned, otherwise
+        the last `max` bars up to to_date (or now). Without to_date the newest bar may be up
+        to one bar old. The response has the same shape as the prices endpoint, with
+        snapshotTime reported in UTC.
+        """
+        if resolution not in RESOLUTION_SECONDS:
+            return fetch(epic, resolution, max, from_date, to_date)
+
+        period = RESOLUTION_SECONDS[resolution]
+        end = parse_api_time(to_date) if to_date else int(time.time())
+        # Open-ended requests accept the bar that is still forming as fresh enough
+        fresh_until = end if to_date else end - period
+
+        if resolution in self.derive_resolutions:
+            derived = self._derive(epic, resolution, max, from_date and parse_api_time(from_date), end, not to_date)
+            if derived is not None:
+                return dict(self.read_meta(epic, 'MINUTE').get('info', {}), prices=array_to_prices(derived))
+
+        error = None
+        if from_date:
+            start = parse_api_time(from_date)
+            if self.missing_windows(epic, resolution, start, fresh_until):
+                error = self.fill(fetch, epic, resolution, start, end)
+            candles = self.read(epic, resolution, start, end)[:max]
+        else:
+            error = self._fill_latest(fetch, epic, resolution, max, end, fresh_until)
+            candles = self.read(epic, resolution, None, end)[-max:]
+
+        if error is not None and not len(candles):
+            return error
+        return dict(self.read_meta(epic, resolution).get('info', {}), prices=array_to_prices(candles))
+
+    def _derive(self, epic, resolution, max, start, end, open_ended):
+        """Aggregate stored MINUTE bars into `resolution`, or return None if they don't cover the request."""
+        # Imported here because the aggregator builds on this module
+        from modules.aggregator import aggregate, bucket_start
+
+        minute, period = RESOLUTION_SECONDS['MINUTE'], RESOLUTION_SECONDS[resolution]
+        # The last coarse bar needs its minutes up to its own end, or up to now while it is forming
+        needed_until = min(int(bucket_start(end, resolution)) + period - minute, end - minute if open_ended else end)
+        coverage = self.read_meta(epic, 'MINUTE')['coverage']
+        covering = [interval for interval in coverage if interval[0] <= needed_until <= interval[1]]
+        if not covering:
+            return None
+        covered_from = covering[0][0]
+
+        if start is not None:
+            first = int(bucket_start(start, resolution))
+            if first < covered_from:
+                return None
+            bars = aggregate(self.read(epic, 'MINUTE', first, int(bucket_start(end, resolution)) + period - 1), resolution)
+            return bars[(bars['timestamp'] >= start) & (bars['timestamp'] <= end)][:max]
+
+        bars = aggregate(self.read(epic, 'MINUTE', covered_from, int(bucket_start(end, resolution)) + period - 1), resolution)
+        # The first bar is incomplete unless the covered minutes start on its boundary
+        bars = bars[(bars['timestamp'] >= covered_from) & (bars['timestamp'] <= end)]
+        return bars[-max:] if len(bars) >= max else None
+
+    def _fill_latest(self, fetch, epic, resolution, max, end, fresh_until):
+        """Make sure the `max` bars before `end` are stored, paging backwards as needed."""
+        period = RESOLUTION_SECONDS[resolution]
+        coverage = self.read_meta(epic, resolution)['coverage']
+        reaching = [interval for interval in coverage if interval[0] <= fresh_until <= interval[1]]
+        if reaching:
+            start = reaching[0][0]
+        else:
+            # Close the gap after the newest fetched window, or fetch a fresh window before `end`
+            window = period * min(max, MAX_BARS_PER_REQUEST - 1)
+            earlier = [interval[1] for interval in coverage if interval[1] < end]
+            if earlier and end - earlier[-1] <= window * 10:
+                start = earlier[-1]
+            else:
+                start = end - window
+            error = self.fill(fetch, epic, resolution, start, end)
+            if error is not None:
+                return error
+            coverage = self.read_meta(epic, resolution)['coverage']
+            start = min([interval[0] for interval in coverage if interval[0] <= start <= interval[1]], default=start)
+
+        step = period * (MAX_BARS_PER_REQUEST - 1)
+        stored = len(self.read(epic, resolution, start, None))
+        empty_windows = 0
+        while stored < max and empty_windows < _MAX_EMPTY_WINDOWS:
+            error = self.fill(fetch, epic, resolution, start - step, start)
+            if error is not None:
+                return error
+            start -= step
+            fetched = len(self.read(epic, resolution, start, None))
+            empty_windows = empty_windows + 1 if fetched == stored else 0
+            stored = fetched
+        return None
+
+
+def split_window(start, end, period, max_bars=MAX_BARS_PER_REQUEST):
+    """Split [start, end] into windows holding at most max_bars bars, sharing their edges."""
+    span = period * max(max_bars - 1, 1)
+    windows = []
+    while True:
+        window_end = min(start + span, end)
+        windows.append((start, window_end))
+        if window_end >= end:
+            return windows
+        start = window_end
+
+
+def _add_interval(intervals, window):
+    """Insert a [start, end] window into a sorted list of intervals, merging overlaps."""
+    merged = []
+    for interval in sorted([list(interval) for interval in intervals] + [list(window)]):
+        if merged and interval[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], interval[1])
+        else:
+            merged.append(interval)
+    return merged
@@ -1,58 +1,145 @@
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
 import hmac
 import base64
 import time
-import portalocker
-import json
+import os
+import random
+import tempfile
+import threading
+from modules.rate_limiter import RateLimiter
+from modules.candle_store import prices_to_array
+
+# Statuses worth retrying: throttled, or a transient server/gateway failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Methods that are safe to resend after a server error; POSTs are only resent after a 429
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE'}
+
+
+class ServerError(requests.HTTPError):
+    """A server error answered a request that is not resent (a POST), so whether it took effect is unknown."""
+
 
 class CapitalComAPI:
-    def __init__(self, api_key, identifier, password, base_url='https://api-capital.backend-capital.com/', demo=False):
+    def __init__(self, api_key, identifier, password, base_url='https://api-capital.backend-capital.com/', demo=False, candle_store=None, rate_limiter=None,
+                 pool_size=10, max_retries=3, backoff_factor=0.5, timeout=30, keepalive_interval=None):
         self.api_key = api_key
         self.identifier = identifier
         self.password = password
         self.session_token = None
         self.security_token = None
-        self.rate_limit_file = 'rate_limit.json'
         self.base_url = base_url if not demo else 'https://demo-api-capital.backend-capital.com/'
         self.headers = {
             'X-CAP-API-KEY': self.api_key,
             'Content-Type': 'application/json'
         }
-        self.last_request_time = None  # Initialize the last request time
-        self.rate_limit = 1.0  # Rate limit in seconds (1 request per second)
+        # Token buckets shared by every process using the same API key
+        self.rate_limiter = rate_limiter or RateLimiter(directory=os.path.join(
+            tempfile.gettempdir(), 'capital_com_rate_limits', hashlib.sha256((api_key or '').encode()).hexdigest()[:16]))
+        self.candle_store = candle_store  # Optional CandleStore answering price requests locally
+
+        # One pooled keep-alive session, so requests reuse TCP+TLS connections
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._session_lock = threading.Lock()
+        self._last_request_time = time.monotonic()
+        self._keepalive_stop = None
+        self._candle_listeners = []
+
         self.start_session()
+        if keepalive_interval:
+            self.start_keepalive(keepalive_interval)
+
+    def _rate_limit(self, method='GET', url='', priority=None):
+        """Wait for the rate limiter; order requests are served before queued data requests."""
+        self.rate_limiter.acquire_for(method, url, priority)
+
+    def _make_request(self, method, url, priority=None, **kwargs):
+        """Helper method to make HTTP requests with rate limiting, re-authentication and retries."""
+        is_session_request = url == self.base_url + 'api/v1/session'
+        reauthenticated = False
+        attempt = 0
+        while True:
+            self._rate_limit(method, url, priority)
+            session_token = self.session_token
+            try:
+                response = self.http.request(method, url, headers=self.headers, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                self._backoff(attempt)
+                attempt += 1
+                continue
+            self._last_request_time = time.monotonic()
+
+            if response.status_code == 401 and not is_session_request and not reauthenticated:
+                # The CST/X-SECURITY-TOKEN pair expired; log in again and resend once
+                self._refresh_session(session_token)
+                reauthenticated = True
+                continue
+
+            retryable = response.status_code == 429 or (
+                response.status_code in RETRY_STATUSES and method.upper() in IDEMPOTENT_METHODS)
+            if not retryable or attempt >= self.max_retries:
+                return response
+            if response.status_code == 429:
+                # Throttled: slow every caller sharing the buckets, not just this one
+                self.rate_limiter.drain_for(method, url)
+            self._backoff(attempt, response)
+            attempt += 1
+
+    def _request_json(self, method, url, priority=None, **kwargs):
+        """Make a request and decode its JSON body; raise ServerError for a POST answered with a 5xx."""
+        response = self._make_request(method, url, priority=priority, **kwargs)
+        if response.status_code >= 500 and method.upper() not in IDEMPOTENT_METHODS:
+            raise ServerError(f"{response.status_code} from {method} {url}", response=response)
+        return response.json()
 
-    def _rate_limit(self):
-        """Ensure that we don't exceed the rate limit of 1 request per second."""
-        current_time = time.time()
-        with portalocker.Lock(self.rate_limit_file, 'a+', timeout=5) as lock_file:
-            lock_file.seek(0)
-            content = lock_file.read()
-            if content:
-                data = json.loads(content)
-                last_request_time = data.get('last_request_time', 0)
-            else:
-                last_request_time = 0
-
-            elapsed = current_time - last_request_time
-            if elapsed < self.rate_limit:
-                time_to_wait = self.rate_limit - elapsed
-                time.sleep(time_to_wait)
-                current_time = time.time()  # Update current time after sleep
-
-            # Update the last request time in the file
-            lock_file.seek(0)
-            lock_file.truncate()
-            lock_file.write(json.dumps({'last_request_time': current_time}))
-            lock_file.flush()
-
-
-    def _make_request(self, method, url, **kwargs):
-        """Helper method to make HTTP requests with rate limiting."""
-        self._rate_limit()
-        response = requests.request(method, url, headers=self.headers, **kwargs)
-        return response
+    def _backoff(self, attempt, response=None):
+        """Sleep before a retry: honour Retry-After, else exponential backoff with full jitter."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                time.sleep(float(retry_after))
+                return
+            except ValueError:
+                pass
+        time.sleep(random.uniform(0, self.backoff_factor * (2 ** attempt)))
+
+    def _refresh_session(self, expired_token):
+        """Start a new session unless another thread already replaced `expired_token`."""
+        with self._session_lock:
+            if self.session_token == expired_token:
+                self.start_session()
+
+    def start_keepalive(self, interval=300):
+        """Ping in a background thread whenever the session has been idle for `interval` seconds."""
+        self.stop_keepalive()
+        stop = threading.Event()
+        self._keepalive_stop = stop
+
+        def keepalive():
+            while not stop.wait(interval / 10):
+                if time.monotonic() - self._last_request_time >= interval:
+                    try:
+                        self.ping()
+                    except Exception as e:
+                        print(f"Keep-alive ping failed: {str(e)}")
+                        self._last_request_time = time.monotonic()
+
+        threading.Thread(target=keepalive, name='capital-com-keepalive', daemon=True).start()
+
+    def stop_keepalive(self):
+        """Stop the background keep-alive pings."""
+        if self._keepalive_stop is not None:
+            self._keepalive_stop.set()
+            self._keepalive_stop = None
 
     def start_session(self):
         """Start a new session and obtain session tokens"""
@@ -77,26 +164,23 @@ class CapitalComAPI:
     def ping(self):
         """Ping the service to keep the session alive"""
         url = self.base_url + 'api/v1/ping'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def end_session(self):
         """End the current session"""
+        self.stop_keepalive()
         url = self.base_url + 'api/v1/session'
-        response = self._make_request('DELETE', url)
-        return response.json()
+        return self._request_json('DELETE', url)
 
     def get_accounts(self):
         """Retrieve all accounts associated with the current session"""
         url = self.base_url + 'api/v1/accounts'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def get_account_preferences(self):
         """Retrieve account preferences like leverage settings and trading mode"""
         url = self.base_url + 'api/v1/accounts/preferences'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def update_account_preferences(self, leverages=None, hedging_mode=None):
         """Update account preferences such as leverage settings and trading mode"""
@@ -106,22 +190,19 @@ class CapitalComAPI:
             payload['leverages'] = leverages
         if hedging_mode is not None:
             payload['hedgingMode'] = hedging_mode
-        response = self._make_request('PUT', url, json=payload)
-        return response.json()
+        return self._request_json('PUT', url, json=payload)
 
-    def get_market_categories(self):
+    def get_market_categories(self, priority=None):
         """Retrieve all top-level market categories"""
         url = self.base_url + 'api/v1/marketnavigation'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url, priority=priority)
 
-    def get_category_markets(self, node_id, limit=500):
+    def get_category_markets(self, node_id, limit=500, priority=None):
         """Retrieve all sub-markets for a given market category"""
         url = f"{self.base_url}api/v1/marketnavigation/{node_id}?limit={limit}"
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url, priority=priority)
 
-    def search_markets(self, search_term=None, epics=None):
+    def search_markets(self, search_term=None, epics=None, priority=None):
         """Search for markets by term or by EPIC"""
         url = self.base_url + 'api/v1/markets'
         params = {}
@@ -129,17 +210,41 @@ class CapitalComAPI:
             params['searchTerm'] = search_term
         if epics:
             params['epics'] = ','.join(epics)
-        response = self._make_request('GET', url, params=params)
-        return response.json()
+        return self._request_json('GET', url, priority=priority, params=params)
 
     def get_market_details(self, epic):
         """Retrieve detailed information for a specific market"""
         url = f"{self.base_url}api/v1/markets/{epic}"
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def get_historical_prices(self, epic, resolution='MINUTE', max=10, from_date=None, to_date=None):
-        """Retrieve historical prices for a specific market"""
+        """Retrieve historical prices for a specific market, from the candle store when one is set"""
+        if self.candle_store is not None:
+            response = self.candle_store.get_historical_prices(
+                self._fetch_historical_prices, epic, resolution, max, from_date, to_date)
+        else:
+            response = self._fetch_historical_prices(epic, resolution, max, from_date, to_date)
+        if self._candle_listeners and response.get('prices'):
+            self._notify_candles(epic, resolution, prices_to_array(response['prices']))
+        return response
+
+    def add_candle_listener(self, callback):
+        """Call callback(epic, resolution, candles) with the CANDLE_DTYPE candles of every price response."""
+        self._candle_listeners.append(callback)
+
+    def remove_candle_listener(self, callback):
+        if callback in self._candle_listeners:
+            self._candle_listeners.remove(callback)
+
+    def _notify_candles(self, epic, resolution, candles):
+        for callback in list(self._candle_listeners):
+            try:
+                callback(epic, resolution, candles)
+            except Exception as e:
+                print(f"Candle listener failed for {epic} {resolution}: {str(e)}")
+
+    def _fetch_historical_prices(self, epic, resolution='MINUTE', max=10, from_date=None, to_date=None, priority=None):
+        """Retrieve historical prices for a specific market from the API"""
         url = f"{self.base_url}api/v1/prices/{epic}"
         params = {
             'resolution': resolution,
@@ -149,8 +254,7 @@ class CapitalComAPI:
             params['from'] = from_date
         if to_date:
             params['to'] = to_date
-        response = self._make_request('GET', url, params=params)
-        return response.json()
+        return self._request_json('GET', url, priority=priority, params=params)
 
     def get_client_sentiment(self, market_ids):
         """Retrieve client sentiment for specific markets"""
@@ -158,8 +262,7 @@ class CapitalComAPI:
         params = {
             'marketIds': ','.join(market_ids)
         }
-        response = self._make_request('GET', url, params=params)
-        return response.json()
+        return self._request_json('GET', url, params=params)
 
     def create_position(self, epic, direction, size, guaranteed_stop=False, stop_level=None, profit_level=None):
         """Create a new trading position"""
@@ -174,14 +277,12 @@ class CapitalComAPI:
             payload['stopLevel'] = stop_level
         if profit_level:
             payload['profitLevel'] = profit_level
-        response = self._make_request('POST', url, json=payload)
-        return response.json()
+        return self._request_json('POST', url, json=payload)
 
     def close_position(self, deal_id):
         """Close an open trading position"""
         url = f"{self.base_url}api/v1/positions/{deal_id}"
-        response = self._make_request('DELETE', url)
-        return response.json()
+        return self._request_json('DELETE', url)
 
     def create_working_order(self, epic, direction, size, level, order_type='LIMIT', guaranteed_stop=False, stop_level=None, profit_level=None, good_till_date=None):
         """Create a new working order"""
@@ -200,8 +301,7 @@ class CapitalComAPI:
             payload['profitLevel'] = profit_level
         if good_till_date:
             payload['goodTillDate'] = good_till_date
-        response = self._make_request('POST', url, json=payload)
-        return response.json()
+        return self._request_json('POST', url, json=payload)
 
     def update_working_order(self, deal_id, level=None, good_till_date=None, guaranteed_stop=None, stop_level=None, profit_level=None):
         """Update an existing working order"""
@@ -217,40 +317,39 @@ class CapitalComAPI:
             payload['stopLevel'] = stop_level
         if profit_level:
             payload['profitLevel'] = profit_level
-        response = self._make_request('PUT', url, json=payload)
-        return response.json()
+        return self._request_json('PUT', url, json=payload)
 
     def delete_working_order(self, deal_id):
         """Delete an existing working order"""
         url = f"{self.base_url}api/v1/workingorders/{deal_id}"
-        response = self._make_request('DELETE', url)
-        return response.json()
+        return self._request_json('DELETE', url)
+
+    def get_deal_confirmation(self, deal_reference, priority=None):
+        """Retrieve the confirmation (accepted or rejected, deal id and level) of an order by its deal reference"""
+        url = f"{self.base_url}api/v1/confirms/{deal_reference}"
+        return self._request_json('GET', url, priority=priority)
 
-    def get_open_positions(self):
+    def get_open_positions(self, priority=None):
         """Retrieve all open positions for the active account"""
         url = self.base_url + 'api/v1/positions'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url, priority=priority)
 
-    def get_open_orders(self):
+    def get_open_orders(self, priority=None):
         """Retrieve all open working orders for the active account"""
         url = self.base_url + 'api/v1/workingorders'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url, priority=priority)
 
     def get_position(self, deal_id):
         """Retrieve details of a specific open position"""
         url = f"{self.base_url}api/v1/positions/{deal_id}"
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def get_order(self, deal_id):
         """Retrieve details of a specific open working order"""
         url = f"{self.base_url}api/v1/workingorders/{deal_id}"
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
-    def get_account_activity(self, from_date=None, to_date=None, last_period=600, detailed=False, deal_id=None, filter=None):
+    def get_account_activity(self, from_date=None, to_date=None, last_period=600, detailed=False, deal_id=None, filter=None, priority=None):
         """Retrieve account activity history"""
         url = f"{self.base_url}api/v1/history/activity"
         params = {
@@ -265,10 +364,9 @@ class CapitalComAPI:
             params['dealId'] = deal_id
         if filter:
             params['filter'] = filter
-        response = self._make_request('GET', url, params=params)
-        return response.json()
+        return self._request_json('GET', url, priority=priority, params=params)
 
-    def get_transaction_history(self, from_date=None, to_date=None, last_period=600, transaction_type=None):
+    def get_transaction_history(self, from_date=None, to_date=None, last_period=600, transaction_type=None, priority=None):
         """Retrieve transaction history"""
         url = f"{self.base_url}api/v1/history/transactions"
         params = {
@@ -280,8 +378,7 @@ class CapitalComAPI:
             params['to'] = to_date
         if transaction_type:
             params['type'] = transaction_type
-        response = self._make_request('GET', url, params=params)
-        return response.json()
+        return self._request_json('GET', url, priority=priority, params=params)
 
     def adjust_demo_balance(self, amount):
         """Adjust the balance of the current Demo account"""
@@ -289,14 +386,12 @@ class CapitalComAPI:
         payload = {
             'amount': amount
         }
-        response = self._make_request('POST', url, json=payload)
-        return response.json()
+        return self._request_json('POST', url, json=payload)
 
     def get_watchlists(self):
         """Retrieve all watchlists belonging to the current user"""
         url = self.base_url + 'api/v1/watchlists'
-        response = self._make_request('GET', url)
-        return response.json()
+        return self._request_json('GET', url)
 
     def create_watchlist(self, name, epics=None):
         """Create a new watchlist"""
@@ -306,14 +401,12 @@ class CapitalComAPI:
         }
         if epics:
             payload['epics'] = epics
-        response = self._make_request('POST', url, json=payload)
-        return response.json()
+        return self._request_json('POST', url, json=payload)
 
     def delete_watchlist(self, watchlist_id):
         """Delete an existing watchlist"""
         url = f"{self.base_url}api/v1/watchlists/{watchlist_id}"
-        response = self._make_request('DELETE', url)
-        return response.json()
+        return self._request_json('DELETE', url)
 
     def add_market_to_watchlist(self, watchlist_id, epic):
         """Add a market to a watchlist"""
@@ -321,11 +414,9 @@ class CapitalComAPI:
         payload = {
             "epic": epic
         }
-        response = self._make_request('PUT', url, json=payload)
-        return response.json()
+        return self._request_json('PUT', url, json=payload)
 
     def remove_market_from_watchlist(self, watchlist_id, epic):
         """Remove a market from a watchlist"""
         url = f"{self.base_url}api/v1/watchlists/{watchlist_id}/{epic}"
-        response = self._make_request('DELETE', url)
-        return response.json()
+        return self._request_json('DELETE', url)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from modules.candle_store import CANDLE_DTYPE, prices_to_array
+
+# The bid/ask OHLC columns of a decoded frame
+PRICE_COLUMNS = [name for name in CANDLE_DTYPE.names if name not in ('timestamp', 'volume')]
+
+
+def candles_to_frame(candles, item_ids, dtype=np.float64, mid=False, spread=False, target='close_bid'):
+    """
+    Turn CANDLE_DTYPE candles into a typed columnar DataFrame without per-row work.
+
+    Parameters:
+    - candles (np.ndarray): Candles in CANDLE_DTYPE.
+    - item_ids (str or np.ndarray): The epic of all rows, or one epic per row.
+    - dtype (np.dtype): The price dtype, e.g. np.float32 to halve memory.
+    - mid (bool): Add open/high/low/close_mid columns.
+    - spread (bool): Add the closing spread (close_ask - close_bid).
+    - target (str): The column copied into 'target' for AutoGluon, or None.
+
+    Returns:
+    - frame (pd.DataFrame): item_id, timestamp (int64-backed datetime64), prices, volume.
+    """
+    if isinstance(item_ids, str):
+        item_ids = np.full(len(candles), item_ids, dtype=object)
+    columns = {
+        'item_id': item_ids,
+        'timestamp': pd.to_datetime(candles['timestamp'], unit='s')
+    }
+    for name in PRICE_COLUMNS:
+        columns[name] = candles[name].astype(dtype)
+    columns['volume'] = candles['volume'].astype(dtype)
+    if mid:
+        for field in ('open', 'high', 'low', 'close'):
+            columns[f'{field}_mid'] = ((candles[f'{field}_bid'] + candles[f'{field}_ask']) / 2).astype(dtype)
+    if spread:
+        columns['spread'] = (candles['close_ask'] - candles['close_bid']).astype(dtype)
+    if target:
+        columns['target'] = columns[target]
+    return pd.DataFrame(columns)
+
+
+def decode_prices(response, epic, **kwargs):
+    """Decode one historical prices response into a columnar frame (see candles_to_frame)."""
+    return candles_to_frame(prices_to_array(response.get('prices') or []), epic, **kwargs)
+
+
+def decode_many(responses, **kwargs):
+    """
+    Decode the responses of many epics into one frame.
+
+    The candle arrays are concatenated once and item_id is built with np.repeat, so no
+    work is done per row.
+
+    Parameters:
+    - responses (dict): Epic -> historical prices response.
+    """
+    epics = list(responses)
+    arrays = [prices_to_array(responses[epic].get('prices') or []) for epic in epics]
+    candles = np.concatenate(arrays) if arrays else np.empty(0, dtype=CANDLE_DTYPE)
+    item_ids = np.repeat(np.array(epics, dtype=object), [len(array) for array in arrays])
+    return candles_to_frame(candles, item_ids, **kwargs)
+
+
+def to_timeseries_frame(frame, columns=('target',)):
+    """Convert a decoded frame into an AutoGluon TimeSeriesDataFrame keeping the given columns."""
+    # AutoGluon is heavy to import, so only do it when a frame is actually converted
+    from autogluon.timeseries import TimeSeriesDataFrame
+    return TimeSeriesDataFrame.from_data_frame(
+        frame[['item_id', 'timestamp', *columns]], id_column='item_id', timestamp_column='timestamp')
@@ -0,0 +1,336 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from modules.rate_limiter import PRIORITY_HIGH, PRIORITY_NORMAL
+
+# Order actions understood by ExecutionEngine
+ACTIONS = ('open', 'close', 'working')
+# Per-order result statuses
+ACCEPTED = 'ACCEPTED'        # the broker confirmed the deal
+REJECTED = 'REJECTED'        # the broker refused the order or its confirmation says REJECTED
+FAILED = 'FAILED'            # the order could not be sent, even after retries
+UNCONFIRMED = 'UNCONFIRMED'  # the order was sent but no confirmation arrived in time
+# Error codes of a confirmation that is not available yet
+PENDING_CONFIRMATION = ('error.not-found.dealReference',)
+
+
+def _signed(direction, size):
+    return size if direction == 'BUY' else -size
+
+
+def _same_deal(order, other):
+    """Whether two orders would open deals that reconciliation cannot tell apart."""
+    return (order['action'] == other['action'] != 'close' and order['epic'] == other['epic']
+            and order['direction'] == other['direction'] and abs(float(order['size']) - float(other['size'])) < 1e-9)
+
+
+def net_basket(targets, open_positions, min_size=0.0):
+    """
+    Turn target net sizes into the orders that reach them from the open positions.
+
+    Per EPIC the difference between the target and the current net size is covered by
+    closing whole positions on the opposite side, largest first, while each still fits in
+    the remaining difference, and one market order for what is left. The result is the
+    same whether the account nets or hedges opposite deals.
+
+    Parameters:
+    - targets (dict): EPIC -> target net size, positive long and negative short; EPICs left out are kept as they are.
+    - open_positions (dict): A get_open_positions response.
+    - min_size (float): Differences smaller than this are not traded.
+
+    Returns:
+    - orders (list): Order dicts for ExecutionEngine.execute, closes before opens per EPIC.
+    """
+    positions = {}
+    for item in open_positions.get('positions', []):
+        position = item['position']
+        positions.setdefault(item['market']['epic'], []).append(
+            (position['dealId'], _signed(position['direction'], float(position['size']))))
+
+    orders = []
+    for epic, target in targets.items():
+        held = positions.get(epic, [])
+        remaining = float(target) - sum(size for _, size in held)
+        if abs(remaining) < max(min_size, 1e-9):
+            continue
+        for deal_id, size in sorted(held, key=lambda deal: -abs(deal[1])):
+            # Closing a long moves the net size down, closing a short moves it up
+            if size * remaining < 0 and abs(size) <= abs(remaining) + 1e-9:
+                orders.append({'action': 'close', 'epic': epic, 'deal_id': deal_id,
+                               'direction': 'SELL' if size > 0 else 'BUY', 'size': abs(size)})
+                remaining += size
+        if abs(remaining) >= max(min_size, 1e-9):
+            orders.append({'action': 'open', 'epic': epic, 'direction': 'BUY' if remaining > 0 else 'SELL',
+                           'size': round(abs(remaining), 10)})
+    return orders
+
+
+class ExecutionEngine:
+    def __init__(self, api_client, dispatch_workers=4, confirm_workers=4, max_retries=2, confirm_timeout=10.0, poll_interval=0.2,
+                 reconcile_grace=5.0, reconcile_interval=1.0):
+        """
+        Initialize the ExecutionEngine class.
+
+        Sends a batch of orders as fast as the broker's order rate limit allows and tracks
+        each to its confirmation. Orders go out from a pool of dispatch threads, in list
+        order per EPIC and different EPICs in parallel, at PRIORITY_HIGH, so they are served
+        ahead of queued data requests and only wait for the trading bucket. Each accepted
+        dispatch hands its deal reference to a separate pool that looks up confirmations at
+        PRIORITY_NORMAL, so confirmations of earlier orders overlap with sending later ones
+        instead of holding them up.
+
+        Retries are idempotent: when sending an order fails without an answer (a dropped
+        connection, an unreadable response or a server error), the order may still have been
+        executed, so the open positions and orders are checked for it for reconcile_grace
+        seconds before it is sent again. Deals confirmed for other orders are never taken for
+        it, and while an earlier equal order of the batch is unconfirmed, the order is
+        reported UNCONFIRMED rather than risk sending it twice.
+
+        Parameters:
+        - api_client (CapitalComAPI): The client to trade with, or a PaperBroker for a dry run.
+        - dispatch_workers (int): Orders in flight at once.
+        - confirm_workers (int): Confirmation lookups in flight at once.
+        - max_retries (int): Resends of an order whose outcome was unknown.
+        - confirm_timeout (float): Seconds to wait for a confirmation before reporting UNCONFIRMED.
+        - poll_interval (float): Seconds between lookups of a confirmation that is not available yet.
+        - reconcile_grace (float): Seconds an unanswered order is looked for among the open deals before it is resent.
+        - reconcile_interval (float): Seconds between those lookups.
+        """
+        self.api_client = api_client
+        self.dispatch_workers = dispatch_workers
+        self.confirm_workers = confirm_workers
+        self.max_retries = max_retries
+        self.confirm_timeout = confirm_timeout
+        self.poll_interval = poll_interval
+        self.reconcile_grace = reconcile_grace
+        self.reconcile_interval = reconcile_interval
+        # Deal ids confirmed for or reconciled with an order, so two equal orders never claim the same deal
+        self._claimed = set()
+        self._claim_lock = threading.Lock()
+
+    def rebalance(self, targets, min_size=0.0, progress=None):
+        """
+        Net target sizes against the open positions and execute the difference.
+
+        Returns:
+        - results (list): As execute(); empty if nothing needs trading.
+        """
+        open_positions = self.api_client.get_open_positions()
+        if 'errorCode' in open_positions:
+            return [{'order': None, 'status': FAILED, 'error': open_positions['errorCode']}]
+        return self.execute(net_basket(targets, open_positions, min_size), progress)
+
+    def execute(self, orders, progress=None):
+        """
+        Send a list of orders and wait for their confirmations.
+
+        Parameters:
+        - orders (list): Order dicts with 'action' ('open' for a market order, 'close' or
+          'working'), 'epic', 'direction' and 'size'; 'deal_id' for closes, 'level' and
+          optionally 'order_type' ('LIMIT' or 'STOP') and 'good_till_date' for working orders,
+          and optionally 'stop_level', 'profit_level' and 'guaranteed_stop'.
+        - progress (callable): Optional progress(done, total) callback, called per confirmed order.
+
+        Returns:
+        - results (list): One dict per order, in order: the order, status (ACCEPTED,
+          REJECTED, FAILED or UNCONFIRMED), deal_reference, deal_id, level, reason, error,
+          attempts and seconds from the start of the batch to its confirmation.
+        """
+        if not orders:
+            return []
+        for order in orders:
+            if order.get('action') not in ACTIONS:
+                raise ValueError(f"Unknown order action: {order.get('action')}")
+
+        started = time.monotonic()
+        results = [{'order': order, 'status': None, 'deal_reference': None, 'deal_id': None, 'level': None,
+                    'reason': None, 'error': None, 'attempts': 0, 'seconds': None} for order in orders]
+        known = self._open_deal_ids()
+        finished = {id(result): threading.Event() for result in results}
+        done = []
+        done_lock = threading.Lock()
+
+        def finish(result):
+            result['seconds'] = round(time.monotonic() - started, 3)
+            with done_lock:
+                done.append(result)
+                count = len(done)
+            finished[id(result)].set()
+            if progress:
+                progress(count, len(orders))
+
+        with ThreadPoolExecutor(self.confirm_workers, thread_name_prefix='confirm') as confirm_pool:
+            def dispatch(chain):
+                for i, result in enumerate(chain):
+                    try:
+                        self._dispatch(result, known, [(earlier, finished[id(earlier)]) for earlier in chain[:i]])
+                    except Exception as e:
+                        result.update(status=FAILED, error=str(e))
+                    if result['status'] is None and result['deal_reference']:
+                        confirm_pool.submit(confirm, result)
+                    else:
+                        finish(result)
+
+            def confirm(result):
+                try:
+                    self._confirm(result)
+                except Exception as e:
+                    result.update(status=UNCONFIRMED, error=str(e))
+                finish(result)
+
+            # Orders of one EPIC are sent one after another, so a netting account never nets an
+            # open against a position that a close in the same batch is about to remove
+            chains = {}
+            for result in results:
+                chains.setdefault(result['order']['epic'], []).append(result)
+            with ThreadPoolExecutor(self.dispatch_workers, thread_name_prefix='dispatch') as dispatch_pool:
+                for chain in chains.values():
+                    dispatch_pool.submit(dispatch, chain)
+            # Leaving the confirm pool's block waits for the confirmations still running
+        return results
+
+    def _send(self, order):
+        action = order['action']
+        if action == 'close':
+            return self.api_client.close_position(order['deal_id'])
+        if action == 'open':
+            return self.api_client.create_position(
+                epic=order['epic'],
+                direction=order['direction'],
+                size=order['size'],
+                guaranteed_stop=order.get('guaranteed_stop', False),
+                stop_level=order.get('stop_level'),
+                profit_level=order.get('profit_level')
+            )
+        return self.api_client.create_working_order(
+            epic=order['epic'],
+            direction=order['direction'],
+            size=order['size'],
+            level=order['level'],
+            order_type=order.get('order_type', 'LIMIT'),
+            guaranteed_stop=order.get('guaranteed_stop', False),
+            stop_level=order.get('stop_level'),
+            profit_level=order.get('profit_level'),
+            good_till_date=order.get('good_till_date')
+        )
+
+    def _dispatch(self, result, known, earlier):
+        """
+        Send one order, resending it only once reconciliation shows it was not executed.
+
+        Parameters:
+        - known (set): Deal ids open before the batch.
+        - earlier (list): (result, finished event) of the orders of the same EPIC sent before this one.
+        """
+        order = result['order']
+        while True:
+            result['attempts'] += 1
+            try:
+                response = self._send(order)
+            except (requests.RequestException, ValueError) as e:
+                # No readable answer, or a server error: the order may or may not have reached the broker
+                error = str(e)
+            else:
+                if 'dealReference' in response:
+                    result['deal_reference'] = response['dealReference']
+                    return
+                error = response.get('errorCode', str(response))
+                if order['action'] == 'close' and self._reconcile(order, known):
+                    # An earlier, unanswered attempt (or a resent DELETE) already closed it
+                    result.update(status=ACCEPTED, deal_id=order['deal_id'], reason='reconciled')
+                    return
+                result.update(status=REJECTED, reason=error)
+                return
+
+            # A deal of an earlier equal order could be taken for this one until that order's deal is known
+            for other, finished in earlier:
+                if _same_deal(other['order'], order) and (
+                        not finished.wait(self.confirm_timeout + self.reconcile_grace) or other['status'] in (UNCONFIRMED, FAILED)):
+                    result.update(status=UNCONFIRMED, error=f"{error}; an earlier equal order is unconfirmed, so this one is not resent")
+                    return
+            deal_id = self._reconcile_within_grace(order, known)
+            if deal_id:
+                result.update(status=ACCEPTED, deal_id=deal_id, reason='reconciled', error=error)
+                return
+            if result['attempts'] > self.max_retries:
+                result.update(status=FAILED, error=error)
+                return
+            print(f"Order {order['action']} {order['epic']} got no answer ({error}); sending it again")
+
+    def _confirm(self, result):
+        """Look up the deal confirmation until it is available or confirm_timeout passes."""
+        deadline = time.monotonic() + self.confirm_timeout
+        while True:
+            confirmation = self.api_client.get_deal_confirmation(result['deal_reference'], priority=PRIORITY_NORMAL)
+            if 'dealStatus' in confirmation:
+                accepted = confirmation['dealStatus'] == 'ACCEPTED'
+                affected = confirmation.get('affectedDeals') or []
+                deal_id = affected[0]['dealId'] if affected else confirmation.get('dealId')
+                if accepted and deal_id:
+                    with self._claim_lock:
+                        self._claimed.add(deal_id)
+                result.update(
+                    status=ACCEPTED if accepted else REJECTED,
+                    deal_id=deal_id,
+                    level=confirmation.get('level'),
+                    reason=confirmation.get('reason') if not accepted else None
+                )
+                return
+            error = confirmation.get('errorCode')
+            if error not in PENDING_CONFIRMATION or time.monotonic() >= deadline:
+                result.update(status=UNCONFIRMED, error=error)
+                return
+            time.sleep(self.poll_interval)
+
+    def _open_deal_ids(self):
+        positions = self.api_client.get_open_positions()
+        orders = self.api_client.get_open_orders()
+        return ({item['position']['dealId'] for item in positions.get('positions', [])}
+                | {item['workingOrderData']['dealId'] for item in orders.get('workingOrders', [])})
+
+    def _reconcile_within_grace(self, order, known):
+        """Reconcile until the order's deal shows up or reconcile_grace passes, as a deal can take a moment to be listed."""
+        deadline = time.monotonic() + self.reconcile_grace
+        while True:
+            deal_id = self._reconcile(order, known)
+            if deal_id or time.monotonic() >= deadline:
+                return deal_id
+            time.sleep(self.reconcile_interval)
+
+    def _reconcile(self, order, known):
+        """
+        Check whether an order whose outcome is unknown was executed.
+
+        A close was executed when its deal was open before the batch and no longer is; an
+        open or working order when a deal of its EPIC, direction and size exists that was
+        not open before the batch and is not matched to another order yet.
+
+        Returns:
+        - deal_id (str): The executed deal's id, or None.
+        """
+        if order['action'] == 'close':
+            if order['deal_id'] not in known:
+                return None
+            positions = self.api_client.get_open_positions(priority=PRIORITY_HIGH)
+            if 'errorCode' in positions:
+                return None
+            open_ids = {item['position']['dealId'] for item in positions.get('positions', [])}
+            return order['deal_id'] if order['deal_id'] not in open_ids else None
+
+        if order['action'] == 'open':
+            response = self.api_client.get_open_positions(priority=PRIORITY_HIGH)
+            deals = [(item['market']['epic'], item['position']) for item in response.get('positions', [])]
+            size_field = 'size'
+        else:
+            response = self.api_client.get_open_orders(priority=PRIORITY_HIGH)
+            deals = [(item['workingOrderData']['epic'], item['workingOrderData']) for item in response.get('workingOrders', [])]
+            size_field = 'orderSize'
+        with self._claim_lock:
+            for epic, deal in deals:
+                if (epic == order['epic'] and deal.get('direction') == order['direction']
+                        and abs(float(deal.get(size_field, 0)) - float(order['size'])) < 1e-9
+                        and deal['dealId'] not in known and deal['dealId'] not in self._claimed):
+                    self._claimed.add(deal['dealId'])
+                    return deal['dealId']
+        return None
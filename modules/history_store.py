@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+import pandas as pd
+from modules.candle_store import parse_api_time, format_api_time
+from modules.rate_limiter import PRIORITY_LOW
+
+# Seconds covered by one history request; the activity endpoint accepts at most one day
+WINDOW_SECONDS = 86400
+# Seconds before the last sync that are fetched again, to pick up late or updated records
+OVERLAP_SECONDS = 3600
+# How far back the first sync goes unless told otherwise
+DEFAULT_HISTORY_SECONDS = 365 * 86400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    date INTEGER NOT NULL,
+    type TEXT,
+    epic TEXT,
+    instrument_name TEXT,
+    deal_id TEXT,
+    size REAL,
+    currency TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS transactions_type ON transactions (type, date);
+CREATE INDEX IF NOT EXISTS transactions_epic ON transactions (epic, date);
+CREATE INDEX IF NOT EXISTS transactions_deal_id ON transactions (deal_id);
+CREATE TABLE IF NOT EXISTS activities (
+    id TEXT PRIMARY KEY,
+    date INTEGER NOT NULL,
+    type TEXT,
+    epic TEXT,
+    deal_id TEXT,
+    status TEXT,
+    source TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activities_date ON activities (date);
+CREATE INDEX IF NOT EXISTS activities_type ON activities (type, date);
+CREATE INDEX IF NOT EXISTS activities_epic ON activities (epic, date);
+CREATE INDEX IF NOT EXISTS activities_deal_id ON activities (deal_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    kind TEXT PRIMARY KEY,
+    synced_from INTEGER NOT NULL,
+    synced_until INTEGER NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+# Output grouping of pnl_report -> SQL expression of the group
+_GROUPS = {
+    'day': "strftime('%Y-%m-%d', date, 'unixepoch')",
+    'month': "strftime('%Y-%m', date, 'unixepoch')",
+    'epic': "COALESCE(epic, instrument_name)"
+}
+
+
+def _connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def _record_id(*values):
+    """A stable id for a record from the fields that identify it, so re-fetched records replace themselves."""
+    return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+
+def _time(record, *fields):
+    for field in fields:
+        if record.get(field):
+            return parse_api_time(record[field])
+    return None
+
+
+def _transaction_row(record):
+    date = _time(record, 'dateUtc', 'dateUTC', 'date')
+    key = (record.get('dateUtc') or record.get('date'), record.get('transactionType'), record.get('reference'),
+           record.get('instrumentName'), record.get('size'), record.get('note'))
+    return (_record_id(*key), date, record.get('transactionType'), record.get('epic'), record.get('instrumentName'),
+            record.get('reference'), _float(record.get('size')), record.get('currency'), record.get('status'),
+            json.dumps(record))
+
+
+def _activity_row(record):
+    date = _time(record, 'dateUTC', 'dateUtc', 'date')
+    key = (record.get('dateUTC') or record.get('date'), record.get('dealId'), record.get('type'), record.get('source'),
+           record.get('epic'))
+    return (_record_id(*key), date, record.get('type'), record.get('epic'), record.get('dealId'), record.get('status'),
+            record.get('source'), json.dumps(record))
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# kind -> (API method, response key, row builder, insert statement)
+_KINDS = {
+    'transactions': ('get_transaction_history', 'transactions', _transaction_row,
+                     "INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"),
+    'activities': ('get_account_activity', 'activities', _activity_row,
+                   "INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+}
+
+
+class HistoryStore:
+    def __init__(self, db_path="data/history.sqlite", min_sync_interval=60):
+        """
+        Initialize the HistoryStore class.
+
+        Keeps the account's transaction and activity history in an indexed SQLite file.
+        The first sync pages through the requested range one day at a time; later syncs
+        only fetch what is new since the last one (plus an hour of overlap for records
+        that arrive late or change status), so reports query local data instead of
+        downloading the whole range again.
+
+        Parameters:
+        - db_path (str): The SQLite file.
+        - min_sync_interval (float): Seconds within which sync() returns without asking the API again.
+        """
+        self.db_path = db_path
+        self.min_sync_interval = min_sync_interval
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(_connect(db_path)) as connection:
+            connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def sync_state(self, kind):
+        """Return {'synced_from', 'synced_until', 'synced_at'} of 'transactions' or 'activities', or None."""
+        with closing(_connect(self.db_path)) as connection:
+            row = connection.execute("SELECT * FROM sync_state WHERE kind = ?", (kind,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def expire(self):
+        """Make the next sync ask the API whatever min_sync_interval says, e.g. after a trade."""
+        with closing(_connect(self.db_path)) as connection:
+            connection.execute("UPDATE sync_state SET synced_at = 0")
+
+    def sync(self, api_client, start=None, now=None, force=False, progress=None):
+        """
+        Bring the local history up to date.
+
+        Parameters:
+        - api_client (CapitalComAPI): The client to fetch with.
+        - start (str or int): How far back the history should reach, as an API time or epoch
+          seconds (default: a year, or what is already stored). Earlier ranges are fetched once.
+        - now (int): The end of the sync, epoch seconds (default: the current time).
+        - force (bool): Fetch new records even if the last sync was less than min_sync_interval ago.
+        - progress (callable): Optional progress(done, total) callback, called per request.
+
+        Returns:
+        - report (dict): kind -> {'fetched': records, 'requests': count, 'error': first error response or None}.
+        """
+        now = int(time.time()) if now is None else int(now)
+        start = _epoch(start) if start is not None else None
+        # One sync at a time per process; concurrent callers would only fetch the same windows
+        with self._lock:
+            plans = {}
+            for kind in _KINDS:
+                state = self.sync_state(kind)
+                if state is None:
+                    plans[kind] = [(start if start is not None else now - DEFAULT_HISTORY_SECONDS, now)]
+                    continue
+                ranges = []
+                if start is not None and start < state['synced_from']:
+                    ranges.append((start, state['synced_from']))
+                # Within min_sync_interval only a backfill before the stored history is fetched
+                if force or time.time() - state['synced_at'] >= self.min_sync_interval:
+                    ranges.append((max(state['synced_from'], state['synced_until'] - OVERLAP_SECONDS), now))
+                plans[kind] = ranges
+
+            windows = {}
+            for kind, ranges in plans.items():
+                windows[kind] = []
+                for range_start, range_end in ranges:
+                    range_windows = [(window_start, min(window_start + WINDOW_SECONDS, range_end))
+                                     for window_start in range(range_start, range_end, WINDOW_SECONDS)]
+                    # Ranges before the stored history are fetched newest first, so they stay contiguous with it
+                    state = self.sync_state(kind)
+                    if state is not None and range_end <= state['synced_from']:
+                        range_windows.reverse()
+                    windows[kind].extend(range_windows)
+            total = sum(len(kind_windows) for kind_windows in windows.values())
+            done = 0
+            report = {}
+            for kind, kind_windows in windows.items():
+                report[kind] = {'fetched': 0, 'requests': 0, 'error': None}
+                method, key, build_row, insert = _KINDS[kind]
+                state = self.sync_state(kind)
+                synced_from = state['synced_from'] if state else None
+                synced_until = state['synced_until'] if state else None
+                synced_at = state['synced_at'] if state else 0
+                for window_start, window_end in kind_windows:
+                    response = getattr(api_client, method)(
+                        from_date=format_api_time(window_start), to_date=format_api_time(window_end),
+                        last_period=None, priority=PRIORITY_LOW)
+                    report[kind]['requests'] += 1
+                    done += 1
+                    if progress:
+                        progress(done, total)
+                    if 'errorCode' in response and 'not-found' not in response['errorCode']:
+                        print(f"History sync of {kind} failed at {format_api_time(window_start)}: {response['errorCode']}")
+                        report[kind]['error'] = response
+                        break
+                    rows = [build_row(record) for record in response.get(key, [])]
+                    with closing(_connect(self.db_path)) as connection:
+                        connection.execute('BEGIN')
+                        connection.executemany(insert, [row for row in rows if row[1] is not None])
+                        # Only contiguous progress is recorded, so a failed window is fetched again next time
+                        if synced_until is None or (window_start <= synced_until and window_end >= synced_from):
+                            synced_from = window_start if synced_from is None else min(synced_from, window_start)
+                            synced_until = window_end if synced_until is None else max(synced_until, window_end)
+                            if window_end == now:
+                                # Caught up; a backfill alone does not restart the min_sync_interval
+                                synced_at = time.time()
+                        connection.execute(
+                            "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                            (kind, synced_from, synced_until, synced_at))
+                        connection.execute('COMMIT')
+                    report[kind]['fetched'] += len(rows)
+
+            with closing(_connect(self.db_path)) as connection:
+                # Transactions carry no epic; take it from the activity with the same deal id
+                connection.execute(
+                    "UPDATE transactions SET epic = (SELECT epic FROM activities WHERE activities.deal_id = transactions.deal_id "
+                    "AND activities.epic IS NOT NULL LIMIT 1) WHERE epic IS NULL AND deal_id IS NOT NULL")
+        return report
+
+    def _query(self, table, columns, start, end, filters, limit):
+        where, params = _where(start, end, filters)
+        sql = f"SELECT {columns} FROM {table}{where} ORDER BY date DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with closing(_connect(self.db_path)) as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def transactions(self, start=None, end=None, transaction_type=None, epic=None, deal_id=None, limit=None):
+        """Return stored transactions, newest first, in the shape of a get_transaction_history response."""
+        rows = self._query('transactions', 'data', start, end,
+                           {'type': transaction_type, 'epic': epic, 'deal_id': deal_id}, limit)
+        return {'transactions': [json.loads(row['data']) for row in rows]}
+
+    def activities(self, start=None, end=None, activity_type=None, epic=None, deal_id=None, limit=None):
+        """Return stored activities, newest first, in the shape of a get_account_activity response."""
+        rows = self._query('activities', 'data', start, end,
+                           {'type': activity_type, 'epic': epic, 'deal_id': deal_id}, limit)
+        return {'activities': [json.loads(row['data']) for row in rows]}
+
+    def pnl_report(self, start=None, end=None, by='day'):
+        """
+        Sum transaction amounts per period or instrument and transaction type.
+
+        Parameters:
+        - start, end (str or int): The range, as API times or epoch seconds.
+        - by (str): 'day', 'month' or 'epic'.
+
+        Returns:
+        - report (pd.DataFrame): One row per group and one column per transaction type, plus 'total'.
+        """
+        if by not in _GROUPS:
+            raise ValueError(f"Unknown grouping {by}")
+        where, params = _where(start, end, {})
+        with closing(_connect(self.db_path)) as connection:
+            rows = connection.execute(
+                f"SELECT {_GROUPS[by]} AS grp, type, SUM(size) FROM transactions{where} GROUP BY grp, type", params).fetchall()
+        frame = pd.DataFrame([tuple(row) for row in rows], columns=[by, 'type', 'size'])
+        if frame.empty:
+            return pd.DataFrame(columns=['total'])
+        report = frame.pivot_table(index=by, columns='type', values='size', aggfunc='sum', fill_value=0.0)
+        report['total'] = report.sum(axis=1)
+        return report.sort_index()
+
+
+def _where(start, end, filters):
+    """The WHERE clause and parameters of a date range plus column = value filters (None values are ignored)."""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("date >= ?")
+        params.append(_epoch(start))
+    if end is not None:
+        conditions.append("date <= ?")
+        params.append(_epoch(end))
+    for column, value in filters.items():
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def _epoch(value):
+    if isinstance(value, str):
+        return parse_api_time(value)
+    if hasattr(value, 'isoformat'):
+        return parse_api_time(value.isoformat())
+    return int(value)
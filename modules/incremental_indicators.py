@@ -0,0 +1,322 @@
+import math
+import threading
+import time
+import numpy as np
+import pandas as pd
+from modules.candle_store import RESOLUTION_SECONDS
+from modules.indicators import ema, _wilder
+
+NAN = float('nan')
+
+
+def _mid(candle, field):
+    return (float(candle[f'{field}_bid']) + float(candle[f'{field}_ask'])) / 2
+
+
+def _mids(candles, field):
+    return (candles[f'{field}_bid'] + candles[f'{field}_ask']) / 2
+
+
+class EMA:
+    __slots__ = ('span', 'alpha', 'value', 'count')
+
+    def __init__(self, span):
+        """Exponential moving average of the mid close, alpha = 2 / (span + 1); matches indicators.ema."""
+        self.span = span
+        self.alpha = 2 / (span + 1)
+        self.value = NAN
+        self.count = 0
+
+    def seed(self, candles):
+        if len(candles):
+            self.value = float(ema(_mids(candles, 'close'), self.span)[-1])
+            self.count = len(candles)
+
+    def update(self, candle):
+        close = _mid(candle, 'close')
+        self.value = close if self.count == 0 else self.value + self.alpha * (close - self.value)
+        self.count += 1
+        return self.value
+
+
+class RSI:
+    __slots__ = ('period', 'previous', 'average_gain', 'average_loss', 'changes')
+
+    def __init__(self, period=14):
+        """Relative strength index of the mid close with Wilder's smoothing; matches indicators.rsi."""
+        self.period = period
+        self.previous = NAN
+        self.average_gain = 0.0
+        self.average_loss = 0.0
+        self.changes = 0
+
+    def seed(self, candles):
+        if not len(candles):
+            return
+        close = _mids(candles, 'close')
+        change = np.diff(close)
+        if len(change):
+            self.average_gain = float(_wilder(np.maximum(change, 0.0), self.period)[-1])
+            self.average_loss = float(_wilder(np.maximum(-change, 0.0), self.period)[-1])
+        self.previous = float(close[-1])
+        self.changes = len(change)
+
+    def update(self, candle):
+        close = _mid(candle, 'close')
+        if self.previous == self.previous:
+            change = close - self.previous
+            gain, loss = max(change, 0.0), max(-change, 0.0)
+            if self.changes == 0:
+                self.average_gain, self.average_loss = gain, loss
+            else:
+                self.average_gain += (gain - self.average_gain) / self.period
+                self.average_loss += (loss - self.average_loss) / self.period
+            self.changes += 1
+        self.previous = close
+        return self.value
+
+    @property
+    def value(self):
+        if self.changes < self.period:
+            return NAN
+        if self.average_loss == 0:
+            return 100.0
+        return 100 - 100 / (1 + self.average_gain / self.average_loss)
+
+
+class RollingStats:
+    __slots__ = ('window', 'output', 'buffer', 'index', 'count', 'total', 'total_squares')
+
+    def __init__(self, window=20, output='mean'):
+        """
+        Rolling mean, variance or standard deviation of the mid close over `window` bars.
+
+        The last `window` closes are kept in a ring buffer next to their running sums; the
+        sums are recomputed from the buffer once per pass over it, so rounding errors
+        cannot build up while updates stay O(1) on average.
+
+        Parameters:
+        - window (int): Bars in the window.
+        - output (str): 'mean', 'variance' or 'std' (population, like indicators.bollinger).
+        """
+        if output not in ('mean', 'variance', 'std'):
+            raise ValueError(f"Unknown output {output}")
+        self.window = window
+        self.output = output
+        self.buffer = np.zeros(window)
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def seed(self, candles):
+        close = _mids(candles[-self.window:], 'close')
+        self.buffer[:len(close)] = close
+        self.count = len(close)
+        self.index = len(close) % self.window
+        self.total = float(close.sum())
+        self.total_squares = float((close ** 2).sum())
+
+    def update(self, candle):
+        close = _mid(candle, 'close')
+        if self.count == self.window:
+            oldest = self.buffer[self.index]
+            self.total -= oldest
+            self.total_squares -= oldest * oldest
+        else:
+            self.count += 1
+        self.buffer[self.index] = close
+        self.total += close
+        self.total_squares += close * close
+        self.index = (self.index + 1) % self.window
+        if self.index == 0:
+            self.total = float(self.buffer.sum())
+            self.total_squares = float(np.dot(self.buffer, self.buffer))
+        return self.value
+
+    @property
+    def value(self):
+        if self.count < self.window:
+            return NAN
+        mean = self.total / self.window
+        if self.output == 'mean':
+            return mean
+        variance = max(self.total_squares / self.window - mean * mean, 0.0)
+        return variance if self.output == 'variance' else math.sqrt(variance)
+
+
+class ATR:
+    __slots__ = ('period', 'previous', 'value', 'count')
+
+    def __init__(self, period=14):
+        """Average true range of mid prices with Wilder's smoothing; matches indicators.atr."""
+        self.period = period
+        self.previous = NAN
+        self.value = NAN
+        self.count = 0
+
+    def seed(self, candles):
+        if not len(candles):
+            return
+        high, low, close = (_mids(candles, field) for field in ('high', 'low', 'close'))
+        previous = np.concatenate(([close[0]], close[:-1]))
+        true_range = np.maximum(high, previous) - np.minimum(low, previous)
+        self.value = float(_wilder(true_range, self.period)[-1])
+        self.previous = float(close[-1])
+        self.count = len(candles)
+
+    def update(self, candle):
+        high, low, close = _mid(candle, 'high'), _mid(candle, 'low'), _mid(candle, 'close')
+        previous = self.previous if self.count else close
+        true_range = max(high, previous) - min(low, previous)
+        self.value = true_range if self.count == 0 else self.value + (true_range - self.value) / self.period
+        self.previous = close
+        self.count += 1
+        return self.value
+
+
+class VWAP:
+    __slots__ = ('session', 'session_start', 'price_volume', 'volume')
+
+    def __init__(self, session='DAY'):
+        """
+        Volume-weighted average of the typical mid price, (high + low + close) / 3, since the
+        start of the current session (a UTC day by default). NaN until a bar with volume.
+        """
+        self.session = RESOLUTION_SECONDS[session]
+        self.session_start = None
+        self.price_volume = 0.0
+        self.volume = 0.0
+
+    def seed(self, candles):
+        if not len(candles):
+            return
+        self.session_start = int(candles['timestamp'][-1]) // self.session * self.session
+        candles = candles[candles['timestamp'] >= self.session_start]
+        volume = np.nan_to_num(candles['volume'].astype(np.float64))
+        typical = (_mids(candles, 'high') + _mids(candles, 'low') + _mids(candles, 'close')) / 3
+        self.price_volume = float(np.dot(typical, volume))
+        self.volume = float(volume.sum())
+
+    def update(self, candle):
+        session_start = int(candle['timestamp']) // self.session * self.session
+        if session_start != self.session_start:
+            self.session_start = session_start
+            self.price_volume = self.volume = 0.0
+        volume = float(candle['volume'])
+        if volume == volume:
+            self.price_volume += (_mid(candle, 'high') + _mid(candle, 'low') + _mid(candle, 'close')) / 3 * volume
+            self.volume += volume
+        return self.value
+
+    @property
+    def value(self):
+        return self.price_volume / self.volume if self.volume > 0 else NAN
+
+
+# Indicator name -> factory of a fresh state object
+DEFAULT_INDICATORS = {
+    'ema_20': lambda: EMA(20),
+    'ema_50': lambda: EMA(50),
+    'rsi_14': lambda: RSI(14),
+    'mean_20': lambda: RollingStats(20, 'mean'),
+    'std_20': lambda: RollingStats(20, 'std'),
+    'atr_14': lambda: ATR(14),
+    'vwap': lambda: VWAP()
+}
+
+
+class IndicatorEngine:
+    def __init__(self, indicators=None, resolutions=None):
+        """
+        Initialize the IndicatorEngine class.
+
+        Keeps indicator states per (epic, resolution) up to date one closed bar at a time,
+        at O(1) cost per bar and indicator, instead of recomputing them over the history.
+        A key's states are seeded in one vectorized pass over the first history it sees
+        (seed it from the candle store for a long warm-up); after that only bars newer
+        than the last one applied are taken, so the overlapping bars of repeated fetches
+        are skipped. A fetch that leaves a gap after the last bar applied reseeds the key
+        from its own bars instead. Bars still forming are left out until they close.
+
+        Feed it from the price-fetch path with api_client.add_candle_listener(engine.on_candles),
+        or with completed bars from CandleAggregator(on_bar=engine.update).
+
+        Parameters:
+        - indicators (dict): Name -> factory returning a fresh state (default: DEFAULT_INDICATORS).
+        - resolutions (list): The resolutions to track (default: all).
+        """
+        self.indicators = dict(indicators or DEFAULT_INDICATORS)
+        self.resolutions = set(resolutions) if resolutions else None
+        self._states = {}  # (epic, resolution) -> {name: state}
+        self._last = {}  # (epic, resolution) -> timestamp of the last bar applied
+        self._lock = threading.Lock()
+
+    def seed(self, epic, resolution, candles):
+        """Start a key from closed historical bars (CANDLE_DTYPE, oldest first)."""
+        with self._lock:
+            self._seed(epic, resolution, candles)
+
+    def _seed(self, epic, resolution, candles):
+        states = {name: factory() for name, factory in self.indicators.items()}
+        if len(candles):
+            for state in states.values():
+                state.seed(candles)
+        self._states[(epic, resolution)] = states
+        self._last[(epic, resolution)] = int(candles['timestamp'][-1]) if len(candles) else None
+
+    def update(self, epic, resolution, candle):
+        """Apply one closed bar (a CANDLE_DTYPE record); bars not newer than the last one are ignored."""
+        key = (epic, resolution)
+        timestamp = int(candle['timestamp'])
+        with self._lock:
+            states = self._states.get(key)
+            if states is None:
+                states = self._states[key] = {name: factory() for name, factory in self.indicators.items()}
+            last = self._last.get(key)
+            if last is not None and timestamp <= last:
+                return False
+            for state in states.values():
+                state.update(candle)
+            self._last[key] = timestamp
+        return True
+
+    def on_candles(self, epic, resolution, candles, now=None):
+        """CapitalComAPI candle listener: apply the closed bars of a price response."""
+        if self.resolutions is not None and resolution not in self.resolutions:
+            return
+        if resolution not in RESOLUTION_SECONDS or not len(candles):
+            return
+        now = time.time() if now is None else now
+        key = (epic, resolution)
+        closed = candles[candles['timestamp'] + RESOLUTION_SECONDS[resolution] <= now]
+        with self._lock:
+            last = self._last.get(key)
+            if key in self._states and last is not None:
+                new = closed[closed['timestamp'] > last]
+                # The bars follow on from the last one applied when the response still holds it
+                # (closures and weekends are then no gap) or starts right after it
+                if not len(new) or (closed['timestamp'] == last).any() or int(new['timestamp'][0]) == last + RESOLUTION_SECONDS[resolution]:
+                    for candle in new:
+                        for state in self._states[key].values():
+                            state.update(candle)
+                        self._last[key] = int(candle['timestamp'])
+                    return
+            # Not tracked yet, or bars are missing between the last one applied and this
+            # response: applying them in sequence would skew every state, so start over
+            self._seed(epic, resolution, closed)
+
+    def values(self, epic, resolution):
+        """Return the current value of every indicator of a key, or None if it is not tracked."""
+        with self._lock:
+            states = self._states.get((epic, resolution))
+            return None if states is None else {name: state.value for name, state in states.items()}
+
+    def frame(self, resolution):
+        """Return the current values of every tracked epic at a resolution, one row per epic."""
+        with self._lock:
+            rows = {
+                epic: {name: state.value for name, state in states.items()}
+                for (epic, key_resolution), states in self._states.items() if key_resolution == resolution
+            }
+        return pd.DataFrame.from_dict(rows, orient='index', columns=list(self.indicators))
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+# The indicators latest_indicators knows, in the order they are reported
+INDICATORS = ["sma", "ema", "rsi", "macd", "bollinger", "atr", "volatility"]
+
+SECONDS_PER_YEAR = 365.25 * 86400
+
+
+def sma(values, window):
+    """Simple moving average; the first window - 1 values are NaN."""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        sums = np.cumsum(np.concatenate(([0.0], values)))
+        result[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return result
+
+
+def ema(values, span):
+    """Exponential moving average with alpha = 2 / (span + 1), seeded with the first value."""
+    return pd.Series(values, dtype=np.float64).ewm(span=span, adjust=False).mean().to_numpy()
+
+
+def _wilder(values, period):
+    """Wilder's smoothing (alpha = 1 / period), as used by RSI and ATR."""
+    return pd.Series(values, dtype=np.float64).ewm(alpha=1 / period, adjust=False).mean().to_numpy()
+
+
+def rsi(close, period=14):
+    """Relative strength index (0-100) with Wilder's smoothing."""
+    change = np.diff(np.asarray(close, dtype=np.float64), prepend=np.nan)
+    gain = _wilder(np.where(change > 0, change, 0.0)[1:], period)
+    loss = _wilder(np.where(change < 0, -change, 0.0)[1:], period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(loss == 0, 100.0, 100 - 100 / (1 + gain / loss))
+    result[:period - 1] = np.nan
+    return np.concatenate(([np.nan], result))
+
+
+def macd(close, fast=12, slow=26, signal=9):
+    """Return (macd line, signal line, histogram)."""
+    line = ema(close, fast) - ema(close, slow)
+    signal_line = ema(line, signal)
+    return line, signal_line, line - signal_line
+
+
+def bollinger(close, window=20, k=2.0):
+    """Return (middle band, upper band, lower band) at k population standard deviations."""
+    close = np.asarray(close, dtype=np.float64)
+    middle = sma(close, window)
+    deviation = np.sqrt(np.maximum(sma(close ** 2, window) - middle ** 2, 0.0))
+    return middle, middle + k * deviation, middle - k * deviation
+
+
+def atr(high, low, close, period=14):
+    """Average true range with Wilder's smoothing."""
+    high, low, close = (np.asarray(values, dtype=np.float64) for values in (high, low, close))
+    previous = np.concatenate(([close[0]], close[:-1])) if len(close) else close
+    true_range = np.maximum(high, previous) - np.minimum(low, previous)
+    return _wilder(true_range, period)
+
+
+def mid_prices(candles, field='close'):
+    """The mid of the bid and ask `field` prices of CANDLE_DTYPE candles."""
+    return (candles[f'{field}_bid'] + candles[f'{field}_ask']) / 2
+
+
+def log_returns(close):
+    close = np.asarray(close, dtype=np.float64)
+    return np.diff(np.log(close))
+
+
+def periods_per_year(timestamps):
+    """Bars per year, estimated from the timestamps so market closures are accounted for."""
+    span = float(timestamps[-1] - timestamps[0]) if len(timestamps) > 1 else 0.0
+    return (len(timestamps) - 1) * SECONDS_PER_YEAR / span if span > 0 else np.nan
+
+
+def volatility(close, timestamps, window=None):
+    """Annualized volatility of log returns over the last `window` returns (default: all)."""
+    returns = log_returns(close)
+    if window:
+        returns = returns[-window:]
+        timestamps = timestamps[-window - 1:]
+    if len(returns) < 2:
+        return np.nan
+    return float(np.std(returns, ddof=1) * np.sqrt(periods_per_year(timestamps)))
+
+
+def correlation(candles_by_epic):
+    """
+    Correlation of log returns of the mid closes across epics, on the timestamps all of them have.
+
+    Parameters:
+    - candles_by_epic (dict): Epic -> CANDLE_DTYPE candles.
+
+    Returns:
+    - matrix (pd.DataFrame): Epic x epic correlations.
+    - bars (int): The number of common bars used.
+    """
+    epics = list(candles_by_epic)
+    common = None
+    for candles in candles_by_epic.values():
+        common = candles['timestamp'] if common is None else np.intersect1d(common, candles['timestamp'])
+    if common is None or len(common) < 3:
+        return pd.DataFrame(np.nan, index=epics, columns=epics), 0 if common is None else len(common)
+    returns = np.vstack([
+        log_returns(mid_prices(candles)[np.isin(candles['timestamp'], common)]) for candles in candles_by_epic.values()
+    ])
+    return pd.DataFrame(np.corrcoef(returns), index=epics, columns=epics), len(common)
+
+
+def latest_indicators(candles, indicators=INDICATORS, window=20, period=14, decimals=None):
+    """
+    Compute indicators over the mid prices of candles and return only their latest values.
+
+    Parameters:
+    - candles (np.ndarray): CANDLE_DTYPE candles, oldest first.
+    - indicators (list): Names from INDICATORS.
+    - window (int): The window of sma, ema, bollinger and volatility.
+    - period (int): The period of rsi and atr.
+    - decimals (int): Decimals to round prices to (default: about six significant digits).
+
+    Returns:
+    - values (dict): Indicator name -> latest value, or a dict of values for multi-line indicators.
+    """
+    unknown = [name for name in indicators if name not in INDICATORS]
+    if unknown:
+        raise ValueError(f"Unknown indicators: {', '.join(unknown)}")
+    if not len(candles):
+        raise ValueError("No candles to compute indicators over")
+    high, low, close = (mid_prices(candles, field) for field in ('high', 'low', 'close'))
+    if decimals is None:
+        largest = float(np.nanmax(np.abs(close)))
+        decimals = int(max(0, 5 - np.floor(np.log10(largest)))) if largest > 0 else 2
+
+    def last(values, digits=decimals):
+        value = float(values[-1]) if len(values) else np.nan
+        return None if np.isnan(value) else round(value, digits)
+
+    values = {'close': last(close)}
+    for name in INDICATORS:
+        if name not in indicators:
+            continue
+        if name == 'sma':
+            values['sma'] = last(sma(close, window))
+        elif name == 'ema':
+            values['ema'] = last(ema(close, window))
+        elif name == 'rsi':
+            values['rsi'] = last(rsi(close, period), 2)
+        elif name == 'macd':
+            line, signal_line, histogram = macd(close)
+            values['macd'] = {'macd': last(line), 'signal': last(signal_line), 'histogram': last(histogram)}
+        elif name == 'bollinger':
+            middle, upper, lower = bollinger(close, window)
+            values['bollinger'] = {'middle': last(middle), 'upper': last(upper), 'lower': last(lower)}
+        elif name == 'atr':
+            values['atr'] = last(atr(high, low, close, period))
+        elif name == 'volatility':
+            value = volatility(close, candles['timestamp'], window)
+            values['volatility'] = None if np.isnan(value) else round(value, 4)
+    return values
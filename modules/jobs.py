@@ -0,0 +1,449 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import multiprocessing
+from contextlib import closing, contextmanager
+import pandas as pd
+from modules.worker_limits import limit_worker_cpus
+
+# Job states; the last three are final
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+# Job kinds; a spec without a kind is a training job
+TRAINING, BACKTEST = 'training', 'backtest'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    name TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL,
+    message TEXT,
+    pid INTEGER,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, owner);
+"""
+
+
+def _connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    def __init__(self, db_path="data/jobs.sqlite", model_dir="models", registry=None, max_workers=None, cpus_per_worker=None, poll_interval=1.0):
+        """
+        Initialize the JobQueue class.
+
+        Runs model fits in worker processes so they never block the Streamlit script.
+        Jobs are kept in a SQLite table, so they outlive reruns and restarts, and every
+        app process on the machine shares it: max_workers limits the running fits across
+        all of them. Owners take turns for free workers, starting with the one with the
+        fewest running jobs, and each owner's jobs run lowest priority value first, so
+        one user's batch of retrains cannot starve the others. Call start() to run the
+        scheduler.
+
+        Each job gets its own process rather than a slot in a concurrent.futures pool,
+        so a running fit can be cancelled and its memory is returned when it ends.
+
+        Parameters:
+        - db_path (str): The SQLite job table; submitted training data is kept next to it.
+        - model_dir (str): Where the trained models are saved.
+        - registry (ModelRegistry): Version the models in this registry (see AutoGluonTrainer).
+        - max_workers (int): The number of fits run at once (default: CPUs / cpus_per_worker).
+        - cpus_per_worker (int): The CPU cores each fit may use (default: 1 when max_workers
+          is not given, else an equal share of the machine).
+        - poll_interval (float): Seconds between scheduler passes.
+        """
+        cpu_count = os.cpu_count() or 1
+        if max_workers is None:
+            cpus_per_worker = cpus_per_worker or 1
+            max_workers = max(1, cpu_count // cpus_per_worker)
+        self.cpus_per_worker = cpus_per_worker or max(1, cpu_count // max_workers)
+        self.max_workers = max_workers
+        self.db_path = db_path
+        self.data_dir = os.path.join(os.path.dirname(db_path) or '.', 'jobs')
+        self.model_dir = model_dir
+        self.registry = registry
+        self.poll_interval = poll_interval
+        self._processes = {}  # job id -> Process started by this queue
+        self._context = multiprocessing.get_context('spawn')
+        self._thread = None
+        self._stopping = threading.Event()
+        os.makedirs(self.data_dir, exist_ok=True)
+        with self._db() as db:
+            db.executescript(_SCHEMA)
+
+    @contextmanager
+    def _db(self):
+        with closing(_connect(self.db_path)) as connection:
+            yield connection
+
+    def submit(self, owner, epic, resolution, data, prediction_length=10, time_limit=None, global_model=False, priority=0):
+        """
+        Queue a training job.
+
+        Parameters:
+        - owner (str): Who the job is for; workers are shared fairly between owners.
+        - epic (str): The epic, or the global model's name when global_model is set.
+        - resolution (str): The time interval used for the data.
+        - data (pd.DataFrame): The training frame (item_id, timestamp, target).
+        - time_limit (float): Seconds the fit may take.
+        - global_model (bool): Train one model on all items of data (AutoGluonTrainer.global_trainer).
+        - priority (int): Lower runs first among one owner's jobs, e.g. 1 for scheduled retrains.
+
+        Returns:
+        - job_id (int): The id to poll with status().
+        """
+        # The data is kept on disk so a queued job survives a restart of the app
+        data_path = os.path.join(self.data_dir, f"{uuid.uuid4().hex}.pkl")
+        data.to_pickle(data_path)
+        spec = {
+            'data_path': data_path,
+            'epic': epic,
+            'resolution': resolution,
+            'prediction_length': prediction_length,
+            'time_limit': time_limit,
+            'global_model': global_model
+        }
+        name = f"{epic} {resolution}" + (" (global)" if global_model else "")
+        with self._db() as db:
+            job_id = db.execute(
+                'INSERT INTO jobs (owner, priority, name, spec, status, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                (owner, priority, name, json.dumps(spec), QUEUED, time.time())
+            ).lastrowid
+        return job_id
+
+    def submit_backtest(self, owner, epics, resolution, candle_store, train_size=500, prediction_length=10, time_limit=None,
+                        threshold=0.0, fold_workers=1, priority=0):
+        """
+        Queue a walk-forward backtest (see WalkForwardBacktest.run) over the stored history of some epics.
+
+        Parameters:
+        - candle_store (CandleStore): The store holding the history; the job reads it from its directory.
+        - time_limit (float): Seconds each fold's fit may take.
+        - threshold (float): The fractional forecast move needed to trade.
+        - fold_workers (int): Folds trained at once inside the job, each with this queue's cpus_per_worker cores.
+
+        Returns:
+        - job_id (int): The id to poll with status(); backtest_result() returns the trades and summary once it is done.
+        """
+        spec = {
+            'kind': BACKTEST,
+            'epics': list(epics),
+            'resolution': resolution,
+            'candle_dir': candle_store.root,
+            'derive_resolutions': list(candle_store.derive_resolutions),
+            'train_size': train_size,
+            'prediction_length': prediction_length,
+            'time_limit': time_limit,
+            'threshold': threshold,
+            'fold_workers': fold_workers
+        }
+        name = f"Backtest of {len(spec['epics'])} epics {resolution}"
+        with self._db() as db:
+            job_id = db.execute(
+                'INSERT INTO jobs (owner, priority, name, spec, status, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                (owner, priority, name, json.dumps(spec), QUEUED, time.time())
+            ).lastrowid
+        return job_id
+
+    def status(self, job_id):
+        """Return a job as a dict (status, progress, message, result, error, ...), or None."""
+        with self._db() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def jobs(self, owner=None, limit=50):
+        """Return the most recent jobs, optionally of one owner, newest first."""
+        with self._db() as db:
+            if owner is None:
+                rows = db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = db.execute('SELECT * FROM jobs WHERE owner = ? ORDER BY id DESC LIMIT ?', (owner, limit)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job['spec'] = json.loads(job['spec'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job.
+
+        Returns:
+        - cancelled (bool): False if the job had already finished.
+        """
+        with self._db() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT status, spec FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row['status'] in FINAL_STATES:
+                db.execute('COMMIT')
+                return False
+            if row['status'] == QUEUED:
+                db.execute('UPDATE jobs SET status = ?, finished = ? WHERE id = ?', (CANCELLED, time.time(), job_id))
+            else:
+                # The scheduler that started the fit stops its process
+                db.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+            db.execute('COMMIT')
+        if row['status'] == QUEUED:
+            _remove_file(json.loads(row['spec']).get('data_path'))
+        return True
+
+    def leaderboard(self, job_id):
+        """Return the leaderboard of a finished job's models as a DataFrame, or None."""
+        job = self.status(job_id)
+        if job is None or not job['result'] or 'leaderboard' not in job['result']:
+            return None
+        return pd.DataFrame(job['result']['leaderboard'])
+
+    def backtest_result(self, job_id):
+        """Return a finished backtest job's {'trades', 'summary'} DataFrames, or None."""
+        job = self.status(job_id)
+        if job is None or not job['result'] or 'trades' not in job['result']:
+            return None
+        return {name: pd.DataFrame(job['result'][name]) for name in ('trades', 'summary')}
+
+    def start(self):
+        """Run the scheduler in a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='job-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, cancel_running=False):
+        """Stop scheduling; running fits finish on their own unless cancel_running is set."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        if cancel_running:
+            for job_id in list(self._processes):
+                self.cancel(job_id)
+            self.schedule_once()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.schedule_once()
+            except Exception as e:
+                print(f"Job scheduler failed: {str(e)}")
+            self._stopping.wait(self.poll_interval)
+
+    def schedule_once(self):
+        """One scheduler pass: reap finished workers, apply cancellations and start queued jobs."""
+        self._reap()
+        self._apply_cancellations()
+        self._recover_orphans()
+        if not self._stopping.is_set():
+            while self._start_next():
+                pass
+
+    def _reap(self):
+        for job_id, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self._processes[job_id]
+            # A worker records its own outcome; a job still running here died with its process
+            with self._db() as db:
+                db.execute(
+                    'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ? AND status = ?',
+                    (FAILED, time.time(), f"worker exited with code {process.exitcode}", job_id, RUNNING)
+                )
+            self._remove_data(job_id)
+
+    def _apply_cancellations(self):
+        with self._db() as db:
+            rows = db.execute('SELECT id FROM jobs WHERE status = ? AND cancel_requested = 1', (RUNNING,)).fetchall()
+        for row in rows:
+            process = self._processes.pop(row['id'], None)
+            if process is None:
+                continue  # started by another app process
+            process.terminate()
+            process.join()
+            with self._db() as db:
+                db.execute(
+                    'UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?',
+                    (CANCELLED, time.time(), row['id'], RUNNING)
+                )
+            self._remove_data(row['id'])
+
+    def _recover_orphans(self):
+        """Fail running jobs whose worker (or, before it started, whose claiming process) is gone, e.g. after the app was killed."""
+        with self._db() as db:
+            rows = db.execute('SELECT id, pid, cancel_requested FROM jobs WHERE status = ?', (RUNNING,)).fetchall()
+            for row in rows:
+                if row['id'] in self._processes or (row['pid'] and _pid_alive(row['pid'])):
+                    continue
+                status = CANCELLED if row['cancel_requested'] else FAILED
+                db.execute(
+                    'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ? AND status = ?',
+                    (status, time.time(), None if status == CANCELLED else "worker process is gone", row['id'], RUNNING)
+                )
+
+    def _start_next(self):
+        """Claim the next queued job, fairly across owners, and start it; False when none can start."""
+        with self._db() as db:
+            db.execute('BEGIN IMMEDIATE')
+            running = dict(db.execute(
+                'SELECT owner, COUNT(*) FROM jobs WHERE status = ? GROUP BY owner', (RUNNING,)).fetchall())
+            last_started = dict(db.execute(
+                'SELECT owner, MAX(started) FROM jobs WHERE started IS NOT NULL GROUP BY owner').fetchall())
+            queued = db.execute(
+                'SELECT id, owner, priority, submitted, spec FROM jobs WHERE status = ?', (QUEUED,)).fetchall()
+            if not queued or sum(running.values()) >= self.max_workers:
+                db.execute('COMMIT')
+                return False
+            # Owners take turns: fewest running jobs first, then whoever was served longest ago
+            job = min(queued, key=lambda row: (
+                running.get(row['owner'], 0), last_started.get(row['owner'], 0),
+                row['priority'], row['submitted'], row['id']))
+            # The claiming process's pid stands in until the worker's is known, so another app
+            # process's _recover_orphans sees a live owner rather than a job without a worker
+            db.execute(
+                'UPDATE jobs SET status = ?, started = ?, progress = 0, message = ?, pid = ? WHERE id = ?',
+                (RUNNING, time.time(), "starting", os.getpid(), job['id'])
+            )
+            db.execute('COMMIT')
+
+        spec = json.loads(job['spec'])
+        spec.update({
+            'model_dir': self.model_dir,
+            'registry': self.registry,
+            'cpus': self.cpus_per_worker
+        })
+        process = self._context.Process(
+            target=_run_job, args=(self.db_path, job['id'], spec), name=f"training-job-{job['id']}")
+        try:
+            process.start()
+        except Exception as e:
+            with self._db() as db:
+                db.execute(
+                    'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ? AND status = ?',
+                    (FAILED, time.time(), f"worker could not be started: {str(e)}", job['id'], RUNNING)
+                )
+            self._remove_data(job['id'])
+            return True
+        self._processes[job['id']] = process
+        with self._db() as db:
+            db.execute('UPDATE jobs SET pid = ? WHERE id = ?', (process.pid, job['id']))
+        return True
+
+    def _remove_data(self, job_id):
+        job = self.status(job_id)
+        if job is not None:
+            _remove_file(job['spec'].get('data_path'))
+
+
+def _remove_file(path):
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _run_job(db_path, job_id, spec):
+    """Worker process: fit one job's model, or run its backtest, and record progress, result and outcome."""
+    started = time.time()
+    finished = threading.Event()
+
+    def update(**columns):
+        assignments = ', '.join(f"{column} = ?" for column in columns)
+        with closing(_connect(db_path)) as db:
+            db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*columns.values(), job_id))
+
+    def heartbeat():
+        # AutoGluon reports no progress, so estimate it from the time budget
+        while not finished.wait(2):
+            elapsed = time.time() - started
+            progress = min(elapsed / spec['time_limit'], 0.99) if spec['time_limit'] else None
+            update(progress=progress, message=f"training for {elapsed:.0f}s")
+
+    reporter = threading.Thread(target=heartbeat, daemon=True)
+
+    def stop_reporter():
+        finished.set()
+        if reporter.is_alive():
+            reporter.join()
+    try:
+        # Limit the thread pools before AutoGluon and torch are imported, which is when they are sized;
+        # imported here also so the scheduler process does not need AutoGluon loaded to start jobs
+        limit_worker_cpus(spec['cpus'])
+        if spec.get('kind') == BACKTEST:
+            result = _run_backtest(spec, update)
+            update(status=DONE, progress=1.0, message="done", finished=time.time(), result=json.dumps(result))
+            return
+        from modules.predictors import AutoGluonTrainer
+        update(message="loading data")
+        data = pd.read_pickle(spec['data_path'])
+        if spec['global_model']:
+            trainer = AutoGluonTrainer.global_trainer(
+                spec['epic'], spec['resolution'], spec['prediction_length'], spec['model_dir'], registry=spec['registry'])
+        else:
+            trainer = AutoGluonTrainer(
+                spec['epic'], spec['resolution'], len(data), spec['prediction_length'], spec['model_dir'], registry=spec['registry'])
+        reporter.start()
+        predictor = trainer.train_model(data, "target", time_limit=spec['time_limit'])
+        leaderboard = predictor.leaderboard(silent=True)
+        stop_reporter()
+        result = {'model_path': trainer.model_path, 'leaderboard': json.loads(leaderboard.to_json(orient='records'))}
+        update(status=DONE, progress=1.0, message="done", finished=time.time(), result=json.dumps(result))
+    except Exception as e:
+        stop_reporter()
+        update(status=FAILED, message="failed", finished=time.time(), error=str(e))
+    finally:
+        _remove_file(spec.get('data_path'))
+
+
+def _run_backtest(spec, update):
+    """Run a backtest job's folds, reporting progress per fold; return its trades and summary as records."""
+    from modules.backtest import WalkForwardBacktest
+    from modules.candle_store import CandleStore
+
+    def progress(done, total):
+        update(progress=done / total if total else None, message=f"{done} of {total} folds")
+
+    backtest = WalkForwardBacktest(
+        CandleStore(spec['candle_dir'], derive_resolutions=spec['derive_resolutions']),
+        spec['resolution'],
+        train_size=spec['train_size'],
+        prediction_length=spec['prediction_length'],
+        max_workers=spec['fold_workers'],
+        cpus_per_worker=spec['cpus'],
+        time_limit=spec['time_limit'],
+        threshold=spec['threshold']
+    )
+    update(message="reading history")
+    result = backtest.run(spec['epics'], progress=progress)
+    return {name: json.loads(frame.to_json(orient='records', date_format='iso')) for name, frame in result.items()}
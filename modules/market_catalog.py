@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from collections import defaultdict
+from modules.rate_limiter import PRIORITY_LOW
+
+# The most epics the markets endpoint takes in one request
+EPICS_PER_REQUEST = 50
+# Instrument fields kept from search_markets(epics=...) details
+DETAIL_FIELDS = ('symbol', 'currency', 'type', 'lotSize', 'country')
+# Minimum trigram similarity of a fuzzy match
+MIN_SIMILARITY = 0.3
+
+
+def _normalize(text):
+    return re.sub(r'[^a-z0-9]+', ' ', (text or '').lower()).strip()
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CatalogIndex:
+    def __init__(self, markets):
+        """
+        Initialize the CatalogIndex class.
+
+        An immutable search index over catalog entries: a sorted list of (token, market)
+        pairs answers prefix queries by binary search, and an inverted trigram index
+        answers fuzzy ones (typos, partial words) by similarity of trigram sets.
+
+        Parameters:
+        - markets (dict): Epic -> entry dict with at least 'name'.
+        """
+        self.epics = list(markets)
+        self.entries = [markets[epic] for epic in self.epics]
+        tokens = []
+        self._grams = []
+        index = defaultdict(list)
+        for i, (epic, entry) in enumerate(zip(self.epics, self.entries)):
+            words = set(_normalize(f"{epic} {entry.get('name', '')} {entry.get('symbol') or ''}").split())
+            words.add(_normalize(epic).replace(' ', ''))
+            tokens.extend((word, i) for word in words)
+            grams = _trigrams(_normalize(f"{epic} {entry.get('name', '')}"))
+            self._grams.append(len(grams))
+            for gram in grams:
+                index[gram].append(i)
+        tokens.sort()
+        self._tokens = [token for token, _ in tokens]
+        self._token_markets = [i for _, i in tokens]
+        self._index = dict(index)
+
+    def __len__(self):
+        return len(self.epics)
+
+    def search(self, query, limit=10, market_type=None):
+        """
+        Return up to `limit` entries matching a query, best first.
+
+        Exact epics score 3, epics starting with the query 2 and names with a word starting
+        with it 1, each plus a tenth of the trigram similarity; other markets score their
+        trigram similarity (< 1) when it reaches MIN_SIMILARITY.
+
+        Parameters:
+        - query (str): Part of an epic, symbol or name.
+        - limit (int): The most results to return.
+        - market_type (str): Only return markets of this instrument type (e.g. 'SHARES').
+        """
+        normalized = _normalize(query)
+        if not normalized:
+            return []
+        scores = {}
+        compact = normalized.replace(' ', '')
+        for word in set(normalized.split()) | {compact}:
+            start = bisect.bisect_left(self._tokens, word)
+            for position in range(start, len(self._tokens)):
+                token = self._tokens[position]
+                if not token.startswith(word):
+                    break
+                i = self._token_markets[position]
+                epic = _normalize(self.epics[i]).replace(' ', '')
+                score = 3.0 if epic == compact else 2.0 if epic.startswith(compact) else 1.0
+                scores[i] = max(scores.get(i, 0.0), score)
+
+        grams = _trigrams(normalized)
+        hits = defaultdict(int)
+        for gram in grams:
+            for i in self._index.get(gram, ()):
+                hits[i] += 1
+        for i, count in hits.items():
+            similarity = 2 * count / (len(grams) + self._grams[i])
+            if i in scores:
+                # Among prefix matches, the closer overall text ranks first
+                scores[i] += similarity / 10
+            elif similarity >= MIN_SIMILARITY:
+                scores[i] = similarity
+
+        results = []
+        for i in sorted(scores, key=lambda i: (-scores[i], self.epics[i])):
+            entry = self.entries[i]
+            if market_type and entry.get('type') != market_type:
+                continue
+            results.append(dict(entry, epic=self.epics[i], score=round(scores[i], 3)))
+            if len(results) >= limit:
+                break
+        return results
+
+
+class MarketCatalog:
+    def __init__(self, path="data/markets.json", max_age=86400, stale_after=7 * 86400):
+        """
+        Initialize the MarketCatalog class.
+
+        A local copy of every market in the broker's navigation tree, kept in one compact
+        JSON file and searched in memory, so finding an epic needs no request. refresh()
+        walks the tree under the rate limiter at low priority, only re-reading category
+        nodes older than max_age, and adds instrument details in batches of 50 epics.
+
+        Parameters:
+        - path (str): The catalog file.
+        - max_age (float): Seconds after which a category node or a market's details are fetched again.
+        - stale_after (float): Seconds after which a market no longer listed in any node is dropped.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = None
+        self.markets = {}  # epic -> {'name', 'type', 'path', 'seen', 'detailed', ...details}
+        self.nodes = {}  # node id -> {'name', 'children', 'crawled'}
+        self.index = CatalogIndex({})
+        self.load()
+
+    def load(self):
+        """Read the catalog file, if there is one, and rebuild the index."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as catalog_file:
+                data = json.load(catalog_file)
+        except (OSError, ValueError) as e:
+            print(f"Could not read market catalog {self.path}: {str(e)}")
+            return
+        with self._lock:
+            self.markets = data.get('markets', {})
+            self.nodes = data.get('nodes', {})
+            self.index = CatalogIndex(self.markets)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {'markets': self.markets, 'nodes': self.nodes}
+            tmp_path = self.path + f".{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as catalog_file:
+                json.dump(data, catalog_file, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+
+    def search(self, query, limit=10, market_type=None):
+        """Search the catalog locally; see CatalogIndex.search."""
+        return self.index.search(query, limit, market_type)
+
+    def get(self, epic):
+        entry = self.markets.get(epic)
+        return dict(entry, epic=epic) if entry is not None else None
+
+    def refresh(self, api_client, progress=None, save_every=20):
+        """
+        Bring the catalog up to date with the navigation tree.
+
+        Parameters:
+        - api_client (CapitalComAPI): The client to crawl with.
+        - progress (callable): Optional progress(done, total) callback, called per request.
+        - save_every (int): Nodes between saves, so an interrupted crawl keeps its progress.
+
+        Returns:
+        - report (dict): requests, nodes crawled, markets found, markets detailed and dropped, and the first error.
+        """
+        with self._refresh_lock:
+            report = {'requests': 0, 'nodes': 0, 'markets': 0, 'detailed': 0, 'dropped': 0, 'error': None}
+            now = time.time()
+            root = api_client.get_market_categories(priority=PRIORITY_LOW)
+            report['requests'] += 1
+            if 'errorCode' in root:
+                report['error'] = root
+                return report
+
+            # Depth-first over the tree; fresh nodes are not fetched, but their stored children are walked
+            stack = [(node['id'], node.get('name'), []) for node in reversed(root.get('nodes', []))]
+            visited = set()
+            while stack:
+                node_id, name, path = stack.pop()
+                if node_id in visited:
+                    continue
+                visited.add(node_id)
+                path = path + [name] if name else path
+                stored = self.nodes.get(node_id)
+                if stored is not None and now - stored.get('crawled', 0) < self.max_age:
+                    with self._lock:
+                        for market_epic in stored.get('markets', []):
+                            if market_epic in self.markets:
+                                self.markets[market_epic]['seen'] = now
+                    stack.extend((child, self.nodes.get(child, {}).get('name'), path) for child in reversed(stored.get('children', [])))
+                    continue
+
+                response = api_client.get_category_markets(node_id, priority=PRIORITY_LOW)
+                report['requests'] += 1
+                report['nodes'] += 1
+                if progress:
+                    # The tree is discovered while walking it, so the total is the nodes known so far
+                    progress(report['nodes'], report['nodes'] + len(stack))
+                if 'errorCode' in response:
+                    print(f"Market catalog crawl of {node_id} failed: {response['errorCode']}")
+                    report['error'] = report['error'] or response
+                    continue
+                children = response.get('nodes', [])
+                markets = response.get('markets', [])
+                with self._lock:
+                    for child in children:
+                        self.nodes.setdefault(child['id'], {'name': child.get('name'), 'children': [], 'markets': [], 'crawled': 0})
+                    self.nodes[node_id] = {
+                        'name': name,
+                        'children': [child['id'] for child in children],
+                        'markets': [market['epic'] for market in markets],
+                        'crawled': now
+                    }
+                    for market in markets:
+                        entry = self.markets.setdefault(market['epic'], {})
+                        entry.update({
+                            'name': market.get('instrumentName', entry.get('name')),
+                            'type': market.get('instrumentType', entry.get('type')),
+                            'path': ' / '.join(path),
+                            'seen': now
+                        })
+                report['markets'] += len(markets)
+                stack.extend((child['id'], child.get('name'), path) for child in reversed(children))
+                if report['nodes'] % save_every == 0:
+                    self.save()
+
+            report['detailed'] = self._enrich(api_client, now, report)
+            with self._lock:
+                dropped = [epic for epic, entry in self.markets.items() if now - entry.get('seen', 0) > self.stale_after]
+                for epic in dropped:
+                    del self.markets[epic]
+                report['dropped'] = len(dropped)
+                self.index = CatalogIndex(self.markets)
+            self.save()
+            return report
+
+    def _enrich(self, api_client, now, report):
+        """Add instrument details to markets without fresh ones, EPICS_PER_REQUEST at a time."""
+        pending = [epic for epic, entry in self.markets.items() if now - entry.get('detailed', 0) >= self.max_age]
+        detailed = 0
+        for start in range(0, len(pending), EPICS_PER_REQUEST):
+            batch = pending[start:start + EPICS_PER_REQUEST]
+            response = api_client.search_markets(epics=batch, priority=PRIORITY_LOW)
+            report['requests'] += 1
+            if 'errorCode' in response:
+                print(f"Market details of {len(batch)} epics failed: {response['errorCode']}")
+                report['error'] = report['error'] or response
+                continue
+            with self._lock:
+                for details in response.get('marketDetails', []):
+                    instrument = details.get('instrument', {})
+                    entry = self.markets.get(instrument.get('epic'))
+                    if entry is None:
+                        continue
+                    entry.update({field: instrument[field] for field in DETAIL_FIELDS if instrument.get(field) is not None})
+                    if instrument.get('name'):
+                        entry['name'] = instrument['name']
+                    entry['detailed'] = now
+                    detailed += 1
+        return detailed
+
+    def start_background_refresh(self, api_client, interval=3600):
+        """Refresh the catalog in a daemon thread now and then every `interval` seconds."""
+        self.stop_background_refresh()
+        stop = threading.Event()
+        self._stop = stop
+
+        def run():
+            while not stop.is_set():
+                try:
+                    self.refresh(api_client)
+                except Exception as e:
+                    print(f"Market catalog refresh failed: {str(e)}")
+                stop.wait(interval)
+
+        threading.Thread(target=run, name='market-catalog', daemon=True).start()
+
+    def stop_background_refresh(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from importlib import metadata
+import pandas as pd
+import portalocker
+
+
+def autogluon_version():
+    """The installed AutoGluon time series version, part of every fingerprint."""
+    try:
+        return metadata.version('autogluon.timeseries')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def hash_items(data, target_column='target'):
+    """
+    Hash the training data per item.
+
+    Returns:
+    - items (dict): item_id -> (row count, hex digest of the item's timestamps and targets).
+    """
+    frame = data.reset_index() if 'item_id' not in data.columns else data
+    frame = frame[['item_id', 'timestamp', target_column]].sort_values(['item_id', 'timestamp'], kind='stable')
+    row_hashes = pd.util.hash_pandas_object(frame[['timestamp', target_column]], index=False).to_numpy()
+    items = {}
+    for item_id, positions in frame.groupby('item_id', sort=True).indices.items():
+        items[str(item_id)] = (len(positions), hashlib.sha256(row_hashes[positions].tobytes()).hexdigest())
+    return items
+
+
+def _prefix_hashes(data, lengths, target_column='target'):
+    """Hash the first `lengths[item_id]` rows of every item, to spot data that only had bars appended."""
+    frame = data.reset_index() if 'item_id' not in data.columns else data
+    frame = frame[['item_id', 'timestamp', target_column]].sort_values(['item_id', 'timestamp'], kind='stable')
+    row_hashes = pd.util.hash_pandas_object(frame[['timestamp', target_column]], index=False).to_numpy()
+    positions = frame.groupby('item_id', sort=True).indices
+    return {
+        item_id: hashlib.sha256(row_hashes[positions[item_id][:length]].tobytes()).hexdigest()
+        for item_id, length in lengths.items() if item_id in positions
+    }
+
+
+class ModelRegistry:
+    def __init__(self, model_dir="models", max_versions=3, disk_quota=20 * 1024 ** 3, max_appended_fraction=0.1):
+        """
+        Initialize the ModelRegistry class.
+
+        Every trained model is registered under a fingerprint of its training data,
+        hyperparameters and the AutoGluon version, so retraining on unchanged data returns
+        the existing artifact. Versions are immutable directories under model_dir/<key>/.
+
+        Parameters:
+        - model_dir (str): The directory holding the models and registry.json.
+        - max_versions (int): Versions kept per key; older ones are pruned least recently used first.
+        - disk_quota (int): Bytes all models may use before the least recently used are pruned.
+        - max_appended_fraction (float): When new data only appends up to this fraction of bars
+          to a registered model's data, that model is reused instead of refit; it sees the new
+          bars as context at prediction time.
+        """
+        self.model_dir = model_dir
+        self.max_versions = max_versions
+        self.disk_quota = disk_quota
+        self.max_appended_fraction = max_appended_fraction
+        self.index_path = os.path.join(model_dir, 'registry.json')
+
+    def _locked(self):
+        os.makedirs(self.model_dir, exist_ok=True)
+        return portalocker.Lock(self.index_path + '.lock', 'a', timeout=60)
+
+    def _read(self):
+        if not os.path.exists(self.index_path):
+            return {'models': {}}
+        with open(self.index_path) as index_file:
+            return json.load(index_file)
+
+    def _write(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def fingerprint(self, data, params, target_column='target'):
+        """Return (fingerprint, per-item hashes) of a training frame and its hyperparameters."""
+        items = hash_items(data, target_column)
+        payload = json.dumps({'items': items, 'params': params, 'autogluon': autogluon_version()}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest(), items
+
+    def lookup(self, key, data, params, target_column='target'):
+        """
+        Find a registered model that can serve this training data without a new fit.
+
+        Returns:
+        - entry (dict): The registry entry (with 'path'), or None if a fit is needed.
+        - fingerprint (str): The fingerprint of the data, to register a new fit under.
+        - items (dict): The per-item hashes of the data.
+        """
+        fingerprint, items = self.fingerprint(data, params, target_column)
+        with self._locked():
+            index = self._read()
+            entry = index['models'].get(fingerprint)
+            if entry is None:
+                entry = self._find_appended(index, key, data, params, items, target_column)
+                if entry is not None:
+                    # Remember the new data as served by the same artifact; trained_items stays the
+                    # data it was fit on, so later appends are measured against that, not this alias
+                    entry = dict(entry, items=items, trained_items=entry.get('trained_items', entry['items']), created=time.time())
+                    index['models'][fingerprint] = entry
+            if entry is not None and os.path.exists(entry['path']):
+                entry['last_used'] = time.time()
+                index['models'][fingerprint] = entry
+                self._write(index)
+                return entry, fingerprint, items
+        return None, fingerprint, items
+
+    def _find_appended(self, index, key, data, params, items, target_column):
+        candidates = [
+            entry for entry in index['models'].values()
+            if entry['key'] == key and entry['params'] == params and entry['autogluon'] == autogluon_version()
+            and set(entry['items']) == set(items) and os.path.exists(entry['path'])
+        ]
+        for entry in sorted(candidates, key=lambda entry: entry['created'], reverse=True):
+            trained_items = entry.get('trained_items', entry['items'])
+            old_rows = {item_id: rows for item_id, (rows, _) in trained_items.items()}
+            new_rows = sum(items[item_id][0] for item_id in items) - sum(old_rows.values())
+            if new_rows < 0 or new_rows > self.max_appended_fraction * sum(old_rows.values()):
+                continue
+            prefixes = _prefix_hashes(data, old_rows, target_column)
+            if all(prefixes.get(item_id) == digest for item_id, (_, digest) in trained_items.items()):
+                return entry
+        return None
+
+    def new_path(self, key, fingerprint):
+        """The directory a new version of `key` should be saved to."""
+        return os.path.join(self.model_dir, key, fingerprint[:16])
+
+    def register(self, key, fingerprint, items, params, path):
+        """Record a freshly trained model."""
+        now = time.time()
+        with self._locked():
+            index = self._read()
+            index['models'][fingerprint] = {
+                'key': key,
+                'path': path,
+                'items': items,
+                'params': params,
+                'autogluon': autogluon_version(),
+                'created': now,
+                'last_used': now,
+                'size': directory_size(path)
+            }
+            self._write(index)
+
+    def latest(self, key, params=None):
+        """Return the most recently created entry for a key (optionally with these params), or None."""
+        entries = [
+            entry for entry in self._read()['models'].values()
+            if entry['key'] == key and (params is None or entry['params'] == params) and os.path.exists(entry['path'])
+        ]
+        return max(entries, key=lambda entry: entry['created'], default=None)
+
+    def prune(self, keep=()):
+        """
+        Delete old versions beyond max_versions per key, then the least recently used ones until
+        the models fit in disk_quota.
+
+        Parameters:
+        - keep (iterable): Paths that must not be deleted, e.g. the model just trained.
+
+        Returns:
+        - deleted (list): The deleted model paths.
+        """
+        keep = set(keep)
+        with self._locked():
+            index = self._read()
+            models = index['models']
+            # Several fingerprints can share one artifact; a path is as recent as its latest use
+            paths = {}
+            for entry in models.values():
+                info = paths.setdefault(entry['path'], {'key': entry['key'], 'last_used': 0, 'size': entry.get('size', 0)})
+                info['last_used'] = max(info['last_used'], entry['last_used'])
+
+            doomed = set()
+            by_key = {}
+            for path, info in paths.items():
+                by_key.setdefault(info['key'], []).append(path)
+            for key_paths in by_key.values():
+                key_paths.sort(key=lambda path: paths[path]['last_used'], reverse=True)
+                doomed.update(key_paths[self.max_versions:])
+
+            total = sum(info['size'] for path, info in paths.items() if path not in doomed)
+            for path in sorted(paths, key=lambda path: paths[path]['last_used']):
+                if total <= self.disk_quota:
+                    break
+                if path not in doomed:
+                    doomed.add(path)
+                    total -= paths[path]['size']
+
+            doomed -= keep
+            for path in doomed:
+                shutil.rmtree(path, ignore_errors=True)
+            index['models'] = {
+                fingerprint: entry for fingerprint, entry in models.items()
+                if entry['path'] not in doomed and os.path.exists(entry['path'])
+            }
+            self._write(index)
+        return sorted(doomed)
+
+
+def directory_size(path):
+    """The total size in bytes of the files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,178 @@
+import copy
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Base URL of the paper broker's requests, used only to pick rate limit buckets
+PAPER_URL = 'paper://broker/'
+
+
+class PaperBroker:
+    def __init__(self, open_positions=None, open_orders=None, prices=None, hedging=True, latency=0.0, rate_limiter=None, reject=None):
+        """
+        Initialize the PaperBroker class.
+
+        A local stand-in for the trading part of CapitalComAPI (create_position,
+        close_position, create_working_order, delete_working_order, get_deal_confirmation,
+        get_open_positions and get_open_orders) that answers with responses of the same
+        shape, so an ExecutionEngine can run a whole basket as a dry run. Orders fill at
+        once at the given prices; nothing is sent to the broker.
+
+        Parameters:
+        - open_positions (dict): A get_open_positions response to start from, e.g. the account's real positions.
+        - open_orders (dict): A get_open_orders response to start from.
+        - prices (dict or callable): EPIC -> fill level, or a function of the EPIC; None fills at no level.
+        - hedging (bool): Whether opposite deals stay open side by side; otherwise they reduce the oldest positions first.
+        - latency (float): Seconds each request takes, to time a dry run like a real one.
+        - rate_limiter (RateLimiter): Optional limiter to pace requests as the broker would, e.g. RateLimiter(shared=False).
+        - reject (callable): Optional reject(order) returning a reason to refuse an order, or None to accept it.
+        """
+        self.prices = prices or {}
+        self.hedging = hedging
+        self.latency = latency
+        self.rate_limiter = rate_limiter
+        self.reject = reject
+        self.positions = copy.deepcopy((open_positions or {}).get('positions', []))
+        self.orders = copy.deepcopy((open_orders or {}).get('workingOrders', []))
+        self.confirmations = {}
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _request(self, method, path, priority=None):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire_for(method, PAPER_URL + path, priority)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+
+    def _price(self, epic):
+        return self.prices(epic) if callable(self.prices) else self.prices.get(epic)
+
+    def _confirm(self, epic, direction, size, level, reason=None, deal_id=None, status='OPEN'):
+        deal_reference = f"o_{uuid.uuid4()}"
+        accepted = reason is None
+        self.confirmations[deal_reference] = {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'status': status if accepted else None,
+            'dealStatus': 'ACCEPTED' if accepted else 'REJECTED',
+            'reason': 'SUCCESS' if accepted else reason,
+            'epic': epic,
+            'dealReference': deal_reference,
+            'dealId': deal_id,
+            'affectedDeals': [{'dealId': deal_id, 'status': status}] if accepted and deal_id else [],
+            'level': level,
+            'size': size,
+            'direction': direction
+        }
+        return {'dealReference': deal_reference}
+
+    def _new_deal_id(self):
+        return f"PAPER-{next(self._ids):06d}"
+
+    def create_position(self, epic, direction, size, guaranteed_stop=False, stop_level=None, profit_level=None):
+        self._request('POST', 'api/v1/positions')
+        order = {'epic': epic, 'direction': direction, 'size': size}
+        reason = self.reject(order) if self.reject else None
+        level = self._price(epic)
+        with self._lock:
+            if reason is not None:
+                return self._confirm(epic, direction, size, level, reason)
+            remaining = float(size)
+            if not self.hedging:
+                # Netting account: an opposite deal reduces the oldest positions of the EPIC first
+                for item in [item for item in self.positions if item['market']['epic'] == epic]:
+                    position = item['position']
+                    if remaining <= 0 or position['direction'] == direction:
+                        continue
+                    reduce = min(remaining, float(position['size']))
+                    position['size'] = float(position['size']) - reduce
+                    remaining -= reduce
+                    if position['size'] <= 1e-9:
+                        self.positions.remove(item)
+                if remaining <= 1e-9:
+                    return self._confirm(epic, direction, size, level, status='CLOSED')
+            deal_id = self._new_deal_id()
+            self.positions.append({
+                'position': {
+                    'dealId': deal_id,
+                    'direction': direction,
+                    'size': remaining,
+                    'level': level,
+                    'createdDateUTC': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+                    'guaranteedStop': guaranteed_stop,
+                    'stopLevel': stop_level,
+                    'profitLevel': profit_level
+                },
+                'market': {'epic': epic, 'bid': level, 'offer': level}
+            })
+            return self._confirm(epic, direction, size, level, deal_id=deal_id)
+
+    def close_position(self, deal_id):
+        self._request('DELETE', f'api/v1/positions/{deal_id}')
+        with self._lock:
+            for item in self.positions:
+                if item['position']['dealId'] == deal_id:
+                    self.positions.remove(item)
+                    position = item['position']
+                    direction = 'SELL' if position['direction'] == 'BUY' else 'BUY'
+                    return self._confirm(item['market']['epic'], direction, position['size'],
+                                         self._price(item['market']['epic']), deal_id=deal_id, status='CLOSED')
+        return {'errorCode': 'error.not-found.dealId'}
+
+    def create_working_order(self, epic, direction, size, level, order_type='LIMIT', guaranteed_stop=False, stop_level=None, profit_level=None, good_till_date=None):
+        self._request('POST', 'api/v1/workingorders')
+        order = {'epic': epic, 'direction': direction, 'size': size, 'level': level, 'order_type': order_type}
+        reason = self.reject(order) if self.reject else None
+        with self._lock:
+            if reason is not None:
+                return self._confirm(epic, direction, size, level, reason)
+            deal_id = self._new_deal_id()
+            self.orders.append({
+                'workingOrderData': {
+                    'dealId': deal_id,
+                    'epic': epic,
+                    'direction': direction,
+                    'orderSize': size,
+                    'orderLevel': level,
+                    'orderType': order_type,
+                    'guaranteedStop': guaranteed_stop,
+                    'stopLevel': stop_level,
+                    'profitLevel': profit_level,
+                    'goodTillDate': good_till_date
+                },
+                'marketData': {'epic': epic}
+            })
+            return self._confirm(epic, direction, size, level, deal_id=deal_id)
+
+    def delete_working_order(self, deal_id):
+        self._request('DELETE', f'api/v1/workingorders/{deal_id}')
+        with self._lock:
+            for item in self.orders:
+                if item['workingOrderData']['dealId'] == deal_id:
+                    self.orders.remove(item)
+                    order = item['workingOrderData']
+                    return self._confirm(order['epic'], order['direction'], order['orderSize'], order['orderLevel'],
+                                         deal_id=deal_id, status='DELETED')
+        return {'errorCode': 'error.not-found.dealId'}
+
+    def get_deal_confirmation(self, deal_reference, priority=None):
+        self._request('GET', f'api/v1/confirms/{deal_reference}', priority)
+        with self._lock:
+            confirmation = self.confirmations.get(deal_reference)
+        if confirmation is None:
+            return {'errorCode': 'error.not-found.dealReference'}
+        return dict(confirmation)
+
+    def get_open_positions(self, priority=None):
+        self._request('GET', 'api/v1/positions', priority)
+        with self._lock:
+            return {'positions': copy.deepcopy(self.positions)}
+
+    def get_open_orders(self, priority=None):
+        self._request('GET', 'api/v1/workingorders', priority)
+        with self._lock:
+            return {'workingOrders': copy.deepcopy(self.orders)}
@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import deque
+
+# Fields of a position or working order whose change counts as an amendment; market
+# prices and running PnL move on every poll and are only kept in the snapshot
+POSITION_FIELDS = ('size', 'level', 'direction', 'stopLevel', 'profitLevel', 'trailingStop', 'stopDistance', 'guaranteedStop', 'leverage')
+ORDER_FIELDS = ('orderLevel', 'orderSize', 'direction', 'orderType', 'stopLevel', 'profitLevel', 'stopDistance', 'profitDistance',
+                'trailingStop', 'guaranteedStop', 'goodTillDate', 'timeInForce')
+# Account fields that change through deposits, withdrawals and closed deals rather than market moves
+ACCOUNT_FIELDS = ('balance', 'deposit')
+
+
+class PortfolioSnapshot:
+    __slots__ = ('version', 'updated', 'accounts', 'positions', 'orders')
+
+    def __init__(self, version, updated, accounts, positions, orders):
+        """
+        Initialize the PortfolioSnapshot class.
+
+        A snapshot is never modified after it is published, so readers can hold on to it
+        without locking.
+
+        Parameters:
+        - version (int): Increases by one with every published change.
+        - updated (float): Epoch seconds of the poll that produced it.
+        - accounts (dict): The get_accounts response.
+        - positions (dict): Deal id -> item of the get_open_positions response.
+        - orders (dict): Deal id -> item of the get_open_orders response.
+        """
+        self.version = version
+        self.updated = updated
+        self.accounts = accounts
+        self.positions = positions
+        self.orders = orders
+
+    def open_positions(self):
+        """The positions in the shape of a get_open_positions response."""
+        return {'positions': list(self.positions.values())}
+
+    def open_orders(self):
+        """The working orders in the shape of a get_open_orders response."""
+        return {'workingOrders': list(self.orders.values())}
+
+
+class PortfolioSynchronizer:
+    def __init__(self, api_client, min_interval=2.0, max_interval=30.0, history=50):
+        """
+        Initialize the PortfolioSynchronizer class.
+
+        A single background thread polls accounts, open positions and working orders and
+        keeps the latest state as a PortfolioSnapshot, so any number of readers cost no
+        broker calls. The poll interval starts at min_interval, doubles after every poll
+        that found no change, up to max_interval, and drops back to min_interval when
+        something changed or poke() is called (e.g. right after placing a trade).
+
+        Subscribers receive only what changed, as a dict with the new 'version', the
+        position and order 'changes' (each with kind 'position' or 'order', change
+        'opened', 'closed' or 'amended', deal_id, before and after), and 'account_changed'
+        when a balance or deposit moved.
+
+        Parameters:
+        - api_client (CapitalComAPI): The client to poll with.
+        - min_interval (float): Seconds between polls while things change.
+        - max_interval (float): Seconds between polls when everything is quiet.
+        - history (int): The number of recent changes kept in recent_changes.
+        """
+        self.api_client = api_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        # The latest changes, oldest first, each with the version and time it was seen
+        self.recent_changes = deque(maxlen=history)
+        self._snapshot = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def snapshot(self):
+        """The latest PortfolioSnapshot, or None before the first successful poll."""
+        return self._snapshot
+
+    def subscribe(self, callback):
+        """Call callback(diff) after every poll that changed something."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def poke(self):
+        """Poll now and at the shortest interval again, e.g. after placing or closing a deal."""
+        self.interval = self.min_interval
+        self._wake.set()
+
+    def wait_for_version(self, version, timeout=None):
+        """Block until a snapshot newer than `version` is published; return it, or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version > version:
+                return snapshot
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='portfolio-sync', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Cleared before polling, so a poke() that arrives during or after the poll wakes the next wait
+            self._wake.clear()
+            try:
+                changed = self.sync()
+            except Exception as e:
+                print(f"Portfolio sync failed: {str(e)}")
+                changed = False
+            self.interval = self.min_interval if changed else min(self.interval * 2, self.max_interval)
+            self._wake.wait(self.interval)
+
+    def sync(self):
+        """
+        Poll the broker once and publish a new snapshot.
+
+        Returns:
+        - changed (bool): Whether a deal or the account balance changed.
+        """
+        accounts = self.api_client.get_accounts()
+        positions = self.api_client.get_open_positions()
+        orders = self.api_client.get_open_orders()
+        for response in (accounts, positions, orders):
+            if 'errorCode' in response:
+                raise RuntimeError(response['errorCode'])
+
+        positions = {item['position']['dealId']: item for item in positions.get('positions', [])}
+        orders = {item['workingOrderData']['dealId']: item for item in orders.get('workingOrders', [])}
+        previous = self._snapshot
+        if previous is None:
+            changes, account_changed = [], True
+        else:
+            changes = (diff_deals('position', previous.positions, positions, 'position', POSITION_FIELDS)
+                       + diff_deals('order', previous.orders, orders, 'workingOrderData', ORDER_FIELDS))
+            account_changed = _account_state(previous.accounts) != _account_state(accounts)
+
+        changed = bool(changes) or account_changed
+        version = (previous.version if previous is not None else 0) + (1 if changed else 0)
+        # Publishing is a single reference swap; the old snapshot stays valid for its readers
+        self._snapshot = PortfolioSnapshot(version, time.time(), accounts, positions, orders)
+        if changed:
+            diff = {'version': version, 'changes': changes, 'account_changed': account_changed}
+            self.recent_changes.extend(dict(change, version=version, time=self._snapshot.updated) for change in changes)
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                try:
+                    callback(diff)
+                except Exception as e:
+                    print(f"Portfolio subscriber failed: {str(e)}")
+        return changed
+
+
+def diff_deals(kind, before, after, section, fields):
+    """
+    Compare two {deal id: item} maps.
+
+    Parameters:
+    - kind (str): 'position' or 'order', copied into every change.
+    - section (str): The key of the deal's own fields in an item ('position' or 'workingOrderData').
+    - fields (tuple): The fields whose change counts as an amendment.
+
+    Returns:
+    - changes (list): Dicts with kind, change ('opened', 'closed' or 'amended'), deal_id, before and after.
+    """
+    changes = []
+    for deal_id, item in after.items():
+        old = before.get(deal_id)
+        if old is None:
+            changes.append({'kind': kind, 'change': 'opened', 'deal_id': deal_id, 'before': None, 'after': item})
+        elif any(old[section].get(field) != item[section].get(field) for field in fields):
+            changes.append({'kind': kind, 'change': 'amended', 'deal_id': deal_id, 'before': old, 'after': item})
+    for deal_id, item in before.items():
+        if deal_id not in after:
+            changes.append({'kind': kind, 'change': 'closed', 'deal_id': deal_id, 'before': item, 'after': None})
+    return changes
+
+
+def _account_state(accounts):
+    return {
+        account.get('accountId'): tuple((account.get('balance') or {}).get(field) for field in ACCOUNT_FIELDS)
+        for account in accounts.get('accounts', [])
+    }
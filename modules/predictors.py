@@ -1,9 +1,97 @@
 import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
 import pandas as pd
 from autogluon.timeseries import TimeSeriesPredictor, TimeSeriesDataFrame
+from modules.model_registry import directory_size
+from modules.worker_limits import limit_worker_cpus
+
+
+class PredictorCache:
+    def __init__(self, max_entries=8, max_bytes=4 * 1024 ** 3):
+        """
+        Initialize the PredictorCache class.
+
+        Keeps loaded predictors in memory, keyed by model path. An entry is reloaded when
+        the artifact on disk has a newer mtime, and the least recently used entries are
+        evicted beyond max_entries or max_bytes. The size on disk of the model directory
+        stands in for its memory use.
+
+        Parameters:
+        - max_entries (int): The maximum number of predictors kept.
+        - max_bytes (int): The maximum estimated size of all kept predictors.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (mtime, size, predictor)
+        self._lock = threading.Lock()
+
+    def get(self, path, loader=TimeSeriesPredictor.load):
+        """Return the predictor stored at path, loading it only if it is not cached or changed on disk."""
+        mtime = _artifact_mtime(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(path)
+                return entry[2]
+        predictor = loader(path)
+        self.put(path, predictor)
+        return predictor
+
+    def put(self, path, predictor):
+        """Cache a predictor that was just trained or loaded from path."""
+        entry = (_artifact_mtime(path), directory_size(path), predictor)
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            self._evict()
+
+    def invalidate(self, path):
+        """Drop the predictor stored at path."""
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        """Drop every cached predictor."""
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        total = sum(entry[1] for entry in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            total -= size
+
+    def warm_up(self, model_dir="models", limit=None):
+        """Load the most recently trained predictors in model_dir, e.g. when the app starts."""
+        paths = []
+        for root, dirs, files in os.walk(model_dir):
+            if 'predictor.pkl' in files:
+                paths.append(root)
+                dirs.clear()  # a predictor's own subdirectories hold its models
+        paths.sort(key=_artifact_mtime, reverse=True)
+        for path in paths[:limit or self.max_entries]:
+            try:
+                self.get(path)
+            except Exception as e:
+                print(f"Could not warm up {path}: {str(e)}")
+
+
+def _artifact_mtime(path):
+    """The mtime of the saved predictor, which changes whenever a new version is saved."""
+    artifact = os.path.join(path, 'predictor.pkl')
+    return os.stat(artifact if os.path.exists(artifact) else path).st_mtime_ns
+
+
+# Shared by every AutoGluonTrainer in the process
+predictor_cache = PredictorCache()
+
 
 class AutoGluonTrainer:
-    def __init__(self, epic, resolution, data_points, prediction_length=10, model_dir="models"):
+    def __init__(self, epic, resolution, data_points, prediction_length=10, model_dir="models", model_path=None, registry=None):
         """
         Initialize the AutoGluonTrainer class.
 
@@ -12,12 +100,31 @@ class AutoGluonTrainer:
         - resolution (str): The time interval used for the data (e.g., 'MINUTE', 'HOUR').
         - prediction_length (int): The number of future steps to predict.
         - model_dir (str): The directory to save the trained models.
+        - model_path (str): Where to save the model, instead of a path derived from the other parameters.
+        - registry (ModelRegistry): Version models by a fingerprint of their training data instead;
+          the model path is then chosen by the registry and data_points is not used.
         """
         self.epic = epic
         self.resolution = resolution
         self.prediction_length = prediction_length
-        self.model_path = f"{model_dir}/{epic}_{resolution}_{data_points}predictor"
+        self.model_path = model_path or f"{model_dir}/{epic}_{resolution}_{data_points}predictor"
         self.freq = self._get_frequency(resolution)
+        self.registry = registry
+        self.key = os.path.basename(model_path) if model_path else f"{epic}_{resolution}"
+        self.params = {'prediction_length': prediction_length, 'freq': self.freq}
+        if registry is not None:
+            self.model_path = None  # resolved from the registry on training or loading
+
+    @classmethod
+    def global_trainer(cls, name, resolution, prediction_length=10, model_dir="models", registry=None):
+        """
+        Create a trainer for one global model shared by a whole watchlist.
+
+        Train it on a multi-item frame (one item_id per epic) and forecast any of those
+        epics with predict_batch.
+        """
+        return cls(name, resolution, None, prediction_length, model_dir,
+                   model_path=f"{model_dir}/{name}_{resolution}_globalpredictor", registry=registry)
 
     def _get_frequency(self, resolution):
         """Map the resolution to a pandas frequency string."""
@@ -32,43 +139,153 @@ class AutoGluonTrainer:
         }
         return freq_map.get(resolution, "T")
 
-    def train_model(self, data, target_column):
+    def train_model(self, data, target_column, time_limit=None):
+        if self.registry is not None:
+            return self._train_registered(data, target_column, time_limit)
+
         # Check if the model already exists
         if os.path.exists(self.model_path):
             # Load the existing model
             predictor = self.load_model()
             # Retrain or fine-tune the existing model with new data
-            predictor.fit(train_data=data, tuning_data=None, time_limit=None, presets=None)
+            predictor.fit(train_data=data, tuning_data=None, time_limit=time_limit, presets=None)
         else:
             # Train a new model if it doesn't exist
-            predictor = TimeSeriesPredictor(
-                prediction_length=self.prediction_length,
-                freq=self.freq,
-                path=self.model_path  # specify the path to save the model
-            )
-            predictor.fit(train_data=data)
-            predictor.save()  # Save the model after training
+            predictor = self._fit_new(data, time_limit)
 
+        # Later predictions reuse the new version instead of loading it from disk
+        predictor_cache.put(self.model_path, predictor)
+        return predictor
+
+    def _fit_new(self, data, time_limit):
+        predictor = TimeSeriesPredictor(
+            prediction_length=self.prediction_length,
+            freq=self.freq,
+            path=self.model_path  # specify the path to save the model
+        )
+        predictor.fit(train_data=data, time_limit=time_limit)
+        predictor.save()  # Save the model after training
+        return predictor
+
+    def _train_registered(self, data, target_column, time_limit):
+        """Reuse the registered model for this data if there is one, else fit and register a new version."""
+        entry, fingerprint, items = self.registry.lookup(self.key, data, self.params, target_column)
+        if entry is not None:
+            self.model_path = entry['path']
+            return self.load_model()
+
+        self.model_path = self.registry.new_path(self.key, fingerprint)
+        predictor = self._fit_new(data, time_limit)
+        self.registry.register(self.key, fingerprint, items, self.params, self.model_path)
+        for path in self.registry.prune(keep=[self.model_path]):
+            predictor_cache.invalidate(path)
+        predictor_cache.put(self.model_path, predictor)
         return predictor
 
     def load_model(self):
         """
-        Load a previously trained AutoGluon model.
+        Load a previously trained AutoGluon model, from the in-memory cache when possible.
 
         Returns:
         - predictor (TimeSeriesPredictor): The loaded AutoGluon model.
         """
-        return TimeSeriesPredictor.load(self.model_path)
+        if self.model_path is None:
+            entry = self.registry.latest(self.key, self.params)
+            if entry is None:
+                raise FileNotFoundError(f"No trained model registered for {self.key}")
+            self.model_path = entry['path']
+        return predictor_cache.get(self.model_path)
 
-    def make_predictions(self, data):
+    def make_predictions(self, data, context_length=None):
         """
         Make predictions using the trained model.
 
         Parameters:
         - data (pd.DataFrame): The historical data to make predictions on.
+        - context_length (int): The number of most recent rows per item the model sees (default: all).
 
         Returns:
         - predictions (pd.DataFrame): The predicted values.
         """
         predictor = self.load_model()
-        return predictor.predict(data.tail(self.prediction_length))
+        return predictor.predict(_tail_per_item(data, context_length))
+
+    def predict_batch(self, data, context_length=None):
+        """
+        Forecast many epics with a single predict call.
+
+        Parameters:
+        - data (pd.DataFrame, TimeSeriesDataFrame or dict): A multi-item frame with one
+          item_id per epic, or a dict of epic -> single-epic frame.
+        - context_length (int): The number of most recent rows per epic the model sees (default: all).
+
+        Returns:
+        - forecasts (dict): Epic -> DataFrame with the 'mean' and quantile columns per future timestamp.
+        """
+        if isinstance(data, dict):
+            data = pd.concat(data.values())
+        predictor = self.load_model()
+        predictions = predictor.predict(_tail_per_item(data, context_length))
+        return {item_id: predictions.loc[item_id] for item_id in predictions.index.unique(level='item_id')}
+
+
+def _tail_per_item(data, length):
+    """Keep the last `length` rows of every item."""
+    if not length:
+        return data
+    if isinstance(data, TimeSeriesDataFrame):
+        return data.slice_by_timestep(-length, None)
+    return data.groupby('item_id', sort=False).tail(length)
+
+
+def train_parallel(datasets, resolution, prediction_length=10, model_dir="models", max_workers=None, cpus_per_worker=1, time_limit=None, registry=None):
+    """
+    Train one model per epic on a pool of worker processes.
+
+    Parameters:
+    - datasets (dict): Epic -> training frame (item_id, timestamp, target).
+    - resolution (str): The time interval used for the data.
+    - max_workers (int): The number of fits run at once (default: CPUs / cpus_per_worker).
+    - cpus_per_worker (int): The CPU cores each worker's numeric libraries may use.
+    - time_limit (float): Seconds for the whole run; each fit gets an equal share of it.
+    - registry (ModelRegistry): Version the models in this registry (see AutoGluonTrainer).
+
+    Returns:
+    - results (dict): Epic -> model path, or the error message if the fit failed or ran out of time.
+    """
+    max_workers = max_workers or max(1, (os.cpu_count() or 1) // cpus_per_worker)
+    deadline = time.time() + time_limit if time_limit else None
+    fit_time_limit = time_limit * min(max_workers, len(datasets)) / len(datasets) if time_limit and datasets else None
+
+    results = {}
+    # Spawned, not forked: the app's threads may hold locks, and the limits must be set before the libraries load
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=limit_worker_cpus, initargs=(cpus_per_worker,)) as executor:
+        futures = {
+            executor.submit(
+                _train_one, epic, resolution, len(data), prediction_length, model_dir, data, fit_time_limit, deadline, registry
+            ): epic
+            for epic, data in datasets.items()
+        }
+        for future in as_completed(futures):
+            epic = futures[future]
+            try:
+                results[epic] = future.result()
+            except Exception as e:
+                results[epic] = f"error: {str(e)}"
+    return results
+
+
+def _train_one(epic, resolution, data_points, prediction_length, model_dir, data, time_limit, deadline, registry):
+    """Worker process: fit and save one epic's model, within the run's deadline."""
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("time budget used up before this fit started")
+        time_limit = min(time_limit, remaining) if time_limit else remaining
+    trainer = AutoGluonTrainer(epic, resolution, data_points, prediction_length, model_dir, registry=registry)
+    trainer.train_model(data, "target", time_limit=time_limit)
+    # Workers only train; keeping the predictor would just hold memory in this process
+    predictor_cache.invalidate(trainer.model_path)
+    return trainer.model_path
+
@@ -0,0 +1,243 @@
+import os
+import mmap
+import asyncio
+import time
+import heapq
+import struct
+import itertools
+import threading
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import portalocker
+
+# Priority classes; lower values are served first
+PRIORITY_HIGH = 0    # order placement and closing
+PRIORITY_NORMAL = 1  # interactive requests
+PRIORITY_LOW = 2     # bulk downloads such as history backfills
+
+# Bucket name -> (tokens per second, burst capacity), following the Capital.com API limits
+DEFAULT_LIMITS = {
+    'default': (10.0, 10.0),  # 10 requests per second per user
+    'session': (1.0, 1.0),    # 1 session request per second
+    'trading': (10.0, 1.0)    # 1 order request per 0.1 seconds
+}
+
+
+def endpoint_buckets(method, url):
+    """Return the names of the buckets a request to `url` draws from."""
+    path = urlparse(url).path
+    if '/session' in path:
+        return ('default', 'session')
+    if method.upper() != 'GET' and ('/positions' in path or '/workingorders' in path):
+        return ('default', 'trading')
+    return ('default',)
+
+
+def _buckets_and_priority(method, url, priority):
+    bucket_names = endpoint_buckets(method, url)
+    if priority is None:
+        priority = PRIORITY_HIGH if 'trading' in bucket_names else PRIORITY_NORMAL
+    return bucket_names, priority
+
+
+class TokenBucket:
+    def __init__(self, name, rate, capacity):
+        """
+        Initialize an in-process token bucket.
+
+        Parameters:
+        - name (str): The bucket name.
+        - rate (float): Tokens added per second.
+        - capacity (float): The largest burst the bucket allows.
+        """
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, reserve=0.0):
+        """Take a token if at least `reserve` tokens remain afterwards; otherwise return seconds to wait."""
+        reserve = min(reserve, self.capacity - 1)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens - 1 >= reserve:
+                self._tokens -= 1
+                return 0.0
+            return (1 + reserve - self._tokens) / self.rate
+
+    def refund(self):
+        """Give back a token taken by try_acquire."""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server answered 429."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class SharedTokenBucket:
+    _STATE = struct.Struct('dd')  # tokens, last refill (epoch seconds)
+
+    def __init__(self, name, rate, capacity, directory=None):
+        """
+        Initialize a token bucket shared by every process on this machine.
+
+        The bucket state is two doubles in a memory-mapped file, guarded by a short
+        file lock, so no process has to parse or rewrite a file per request.
+
+        Parameters:
+        - directory (str): Where to keep the bucket files.
+        """
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        directory = directory or os.path.join(tempfile.gettempdir(), 'capital_com_rate_limits')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{name}.bucket")
+        self._lock = threading.Lock()
+        open(self.path, 'ab').close()
+        self._file = open(self.path, 'r+b')
+        with self._locked():
+            if os.path.getsize(self.path) < self._STATE.size:
+                self._file.truncate(self._STATE.size)
+                self._file.flush()
+                with mmap.mmap(self._file.fileno(), self._STATE.size) as state:
+                    self._STATE.pack_into(state, 0, capacity, time.time())
+        self._state = mmap.mmap(self._file.fileno(), self._STATE.size)
+
+    @contextmanager
+    def _locked(self):
+        # The file lock excludes other processes, the thread lock other threads of this one
+        with self._lock:
+            portalocker.lock(self._file, portalocker.LOCK_EX)
+            try:
+                yield
+            finally:
+                portalocker.unlock(self._file)
+
+    def try_acquire(self, reserve=0.0):
+        """Take a token if at least `reserve` tokens remain afterwards; otherwise return seconds to wait."""
+        reserve = min(reserve, self.capacity - 1)
+        with self._locked():
+            tokens, updated = self._STATE.unpack_from(self._state, 0)
+            now = time.time()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            if tokens - 1 >= reserve:
+                self._STATE.pack_into(self._state, 0, tokens - 1, now)
+                return 0.0
+            self._STATE.pack_into(self._state, 0, tokens, now)
+            return (1 + reserve - tokens) / self.rate
+
+    def refund(self):
+        """Give back a token taken by try_acquire."""
+        with self._locked():
+            tokens, updated = self._STATE.unpack_from(self._state, 0)
+            self._STATE.pack_into(self._state, 0, min(self.capacity, tokens + 1), updated)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server answered 429."""
+        with self._locked():
+            self._STATE.pack_into(self._state, 0, 0.0, time.time())
+
+
+class RateLimiter:
+    def __init__(self, limits=None, shared=True, directory=None, low_priority_reserve=1.0):
+        """
+        Initialize the RateLimiter class.
+
+        Requests wait in a priority queue, so an order placed while a backfill is queued
+        is the next request to go out. Low priority requests also leave a reserve of
+        tokens in each bucket so other processes' orders are not starved either.
+
+        Parameters:
+        - limits (dict): Bucket name -> (tokens per second, burst capacity).
+        - shared (bool): Share the buckets with other processes through memory-mapped files.
+        - directory (str): Where shared bucket files are kept.
+        - low_priority_reserve (float): Tokens PRIORITY_LOW requests leave untouched.
+        """
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.low_priority_reserve = low_priority_reserve
+        if shared:
+            self.buckets = {
+                name: SharedTokenBucket(name, rate, capacity, directory)
+                for name, (rate, capacity) in self.limits.items()
+            }
+        else:
+            self.buckets = {
+                name: TokenBucket(name, rate, capacity)
+                for name, (rate, capacity) in self.limits.items()
+            }
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def try_acquire(self, bucket_names, priority=PRIORITY_NORMAL):
+        """Take a token from every named bucket, or none; return 0 or the seconds to wait."""
+        reserve = self.low_priority_reserve if priority >= PRIORITY_LOW else 0.0
+        taken = []
+        for name in bucket_names:
+            wait = self.buckets[name].try_acquire(reserve)
+            if wait > 0:
+                for bucket in taken:
+                    bucket.refund()
+                return wait
+            taken.append(self.buckets[name])
+        return 0.0
+
+    def acquire(self, bucket_names=('default',), priority=PRIORITY_NORMAL):
+        """Block until the request may be sent, serving waiters in priority order."""
+        entry = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._cond.notify_all()
+            try:
+                while True:
+                    wait = None
+                    if self._waiters[0] == entry:
+                        wait = self.try_acquire(bucket_names, priority)
+                        if wait == 0:
+                            return
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    async def acquire_async(self, bucket_names=('default',), priority=PRIORITY_NORMAL, poll_interval=0.01):
+        """Wait without blocking the event loop, sharing the priority queue with blocking callers."""
+        entry = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            self._cond.notify_all()
+        try:
+            while True:
+                with self._cond:
+                    wait = self.try_acquire(bucket_names, priority) if self._waiters[0] == entry else None
+                if wait == 0:
+                    return
+                await asyncio.sleep(poll_interval if wait is None else wait)
+        finally:
+            with self._cond:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def acquire_for(self, method, url, priority=None):
+        """Block until a request to `url` may be sent; orders default to PRIORITY_HIGH."""
+        self.acquire(*_buckets_and_priority(method, url, priority))
+
+    async def acquire_for_async(self, method, url, priority=None):
+        """Asyncio counterpart of acquire_for."""
+        await self.acquire_async(*_buckets_and_priority(method, url, priority))
+
+    def drain_for(self, method, url):
+        """Empty the buckets a request to `url` draws from, slowing every caller down."""
+        for name in endpoint_buckets(method, url):
+            self.buckets[name].drain()
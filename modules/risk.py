@@ -0,0 +1,245 @@
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+from modules.candle_store import prices_to_array
+
+# Paths simulated at once; a chunk of 65536 paths x 100 steps takes about 50 MB
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def positions_from_api(open_positions, preferences=None):
+    """
+    Turn a get_open_positions response into the position dicts RiskEngine works with.
+
+    A position's leverage is taken from the position itself, else from the account's
+    leverage setting for the market's instrument type in a get_account_preferences response.
+
+    Returns:
+    - positions (list): Dicts with deal_id, epic, direction (1 long, -1 short), size, level,
+      stop_level, profit_level, guaranteed_stop, leverage and margin.
+    """
+    leverages = (preferences or {}).get('leverages', {})
+    positions = []
+    for item in open_positions.get('positions', []):
+        position, market = item['position'], item.get('market', {})
+        leverage = position.get('leverage') or leverages.get(market.get('instrumentType'), {}).get('current') or 1
+        positions.append({
+            'deal_id': position.get('dealId'),
+            'epic': market.get('epic', position.get('epic')),
+            'direction': 1 if position['direction'] == 'BUY' else -1,
+            'size': float(position['size']),
+            'level': float(position['level']),
+            'stop_level': position.get('stopLevel'),
+            'profit_level': position.get('profitLevel'),
+            'guaranteed_stop': bool(position.get('guaranteedStop')),
+            'leverage': float(leverage),
+            'margin': float(position['size']) * float(position['level']) / float(leverage)
+        })
+    return positions
+
+
+class QuantileSampler:
+    def __init__(self, forecasts):
+        """
+        Initialize the QuantileSampler class.
+
+        Samples price paths whose value at every step follows the forecast quantiles of
+        make_predictions / predict_batch. A path is a random walk in normal scores, scaled
+        so each step is standard normal, and mapped to prices by interpolating the
+        quantiles in normal-score space (linear beyond the outer quantiles, i.e. normal
+        tails). All epics share the same scores, which makes their moves fully dependent:
+        a conservative choice for a portfolio's VaR.
+
+        Parameters:
+        - forecasts (dict): Epic -> forecast DataFrame with one row per step and quantile columns ('0.1', ..., '0.9').
+        """
+        self.epics = list(forecasts)
+        self._grids = {}
+        self._lines = {}
+        for epic, forecast in forecasts.items():
+            levels = sorted(float(column) for column in forecast.columns if _is_quantile(column))
+            if len(levels) < 2:
+                raise ValueError(f"The forecast of {epic} needs at least two quantile columns")
+            columns = [column for level in levels for column in forecast.columns if _is_quantile(column) and float(column) == level]
+            grid = np.array([NormalDist().inv_cdf(level) for level in levels], dtype=np.float32)
+            # Sorting per step guards against crossing quantiles
+            values = np.sort(forecast[columns].to_numpy(dtype=np.float32), axis=1)
+            # The line through each pair of neighbouring quantiles, as (intercept, slope) per step and segment
+            slopes = np.diff(values, axis=1) / np.diff(grid)
+            self._grids[epic] = grid
+            self._lines[epic] = (values[:, :-1] - grid[:-1] * slopes, slopes)
+        self.steps = min(len(lines[1]) for lines in self._lines.values())
+
+    def sample(self, n, rng):
+        """Return {epic: (n, steps) price paths}."""
+        walk = np.cumsum(rng.standard_normal((n, self.steps), dtype=np.float32), axis=1)
+        scores = walk / np.sqrt(np.arange(1, self.steps + 1, dtype=np.float32))
+        paths = {}
+        for epic in self.epics:
+            grid = self._grids[epic]
+            intercepts, slopes = (lines[:self.steps] for lines in self._lines[epic])
+            # The segment of every score; the outer segments extend beyond the outer quantiles
+            segment = np.zeros(scores.shape, dtype=np.int32)
+            for inner in grid[1:-1]:
+                segment += scores > inner
+            segment += np.arange(self.steps, dtype=np.int32) * (len(grid) - 1)
+            paths[epic] = np.maximum(np.take(intercepts, segment) + scores * np.take(slopes, segment), 0.0)
+        return paths
+
+
+class BootstrapSampler:
+    def __init__(self, histories, steps, block_size=1, start_prices=None):
+        """
+        Initialize the BootstrapSampler class.
+
+        Samples price paths by resampling historical log returns in blocks of block_size
+        bars (longer blocks keep volatility clustering). Histories are aligned on their
+        common timestamps and every epic draws the same bars, which keeps the historical
+        co-movement of a portfolio.
+
+        Parameters:
+        - histories (dict): Epic -> CANDLE_DTYPE candles or a get_historical_prices response.
+        - steps (int): Bars per path.
+        - block_size (int): Consecutive bars drawn together.
+        - start_prices (dict): Epic -> price paths start from (default: the last close).
+        """
+        arrays = {
+            epic: prices_to_array(history.get('prices') or []) if isinstance(history, dict) else history
+            for epic, history in histories.items()
+        }
+        common = None
+        for candles in arrays.values():
+            common = candles['timestamp'] if common is None else np.intersect1d(common, candles['timestamp'])
+        if common is None or len(common) <= block_size:
+            raise ValueError("Not enough common history to bootstrap from")
+        self.epics = list(arrays)
+        self.steps = steps
+        self.block_size = block_size
+        self._returns = {}
+        self._start = {}
+        for epic, candles in arrays.items():
+            closes = candles['close_bid'][np.isin(candles['timestamp'], common)]
+            self._returns[epic] = np.diff(np.log(closes)).astype(np.float32)
+            self._start[epic] = (start_prices or {}).get(epic, float(candles['close_bid'][-1]))
+
+    def sample(self, n, rng):
+        """Return {epic: (n, steps) price paths}."""
+        count = len(next(iter(self._returns.values())))
+        blocks = -(-self.steps // self.block_size)
+        starts = rng.integers(0, count - self.block_size + 1, (n, blocks))
+        rows = (starts[:, :, None] + np.arange(self.block_size)).reshape(n, -1)[:, :self.steps]
+        return {
+            epic: self._start[epic] * np.exp(np.cumsum(self._returns[epic][rows], axis=1))
+            for epic in self.epics
+        }
+
+
+class RiskEngine:
+    def __init__(self, n_paths=1_000_000, chunk_size=DEFAULT_CHUNK_SIZE, confidence=(0.95, 0.99), seed=None):
+        """
+        Initialize the RiskEngine class.
+
+        Simulates the PnL of open positions over sampled price paths, chunk by chunk so
+        memory stays bounded however many paths are drawn. A position is closed at the
+        first step its stop or profit level is crossed: at the level for a guaranteed stop,
+        else at that step's price, so gaps through the stop are felt. Only step prices are
+        sampled, so crossings between steps are missed. PnL is in the instruments' quote
+        currencies and ignores spread and funding.
+
+        Parameters:
+        - n_paths (int): The number of paths to simulate.
+        - chunk_size (int): Paths simulated at once.
+        - confidence (tuple): The VaR / expected shortfall confidence levels.
+        - seed (int): Seed for reproducible results.
+        """
+        self.n_paths = n_paths
+        self.chunk_size = chunk_size
+        self.confidence = confidence
+        self.seed = seed
+
+    def run(self, positions, sampler):
+        """
+        Simulate the positions over paths drawn from a sampler.
+
+        Parameters:
+        - positions (list): Position dicts as returned by positions_from_api.
+        - sampler (QuantileSampler or BootstrapSampler): Draws the price paths of the positions' epics.
+
+        Returns:
+        - report (dict): 'portfolio' (a dict of metrics) and 'positions' (a DataFrame with
+          one row of metrics per position): expected_pnl, loss_probability, VaR and
+          expected shortfall per confidence level, stop_hit_probability,
+          profit_hit_probability, and the worst loss relative to margin.
+        """
+        rng = np.random.default_rng(self.seed)
+        pnls = np.empty((len(positions), self.n_paths), dtype=np.float32)
+        stop_hits = np.zeros(len(positions), dtype=np.int64)
+        profit_hits = np.zeros(len(positions), dtype=np.int64)
+        for start in range(0, self.n_paths, self.chunk_size):
+            n = min(self.chunk_size, self.n_paths - start)
+            paths = sampler.sample(n, rng)
+            for i, position in enumerate(positions):
+                pnl, stopped, took_profit = position_pnl(paths[position['epic']], position)
+                pnls[i, start:start + n] = pnl
+                stop_hits[i] += stopped.sum()
+                profit_hits[i] += took_profit.sum()
+
+        rows = []
+        for i, position in enumerate(positions):
+            metrics = self._metrics(pnls[i])
+            metrics.update({
+                'deal_id': position.get('deal_id'),
+                'epic': position['epic'],
+                'leverage': position.get('leverage'),
+                'margin': position.get('margin'),
+                'stop_hit_probability': stop_hits[i] / self.n_paths,
+                'profit_hit_probability': profit_hits[i] / self.n_paths,
+                'worst_loss_of_margin': -pnls[i].min() / position['margin'] if position.get('margin') else np.nan
+            })
+            rows.append(metrics)
+        portfolio = self._metrics(pnls.sum(axis=0, dtype=np.float64)) if len(positions) else {}
+        return {'portfolio': portfolio, 'positions': pd.DataFrame(rows)}
+
+    def _metrics(self, pnl):
+        metrics = {'expected_pnl': float(pnl.mean(dtype=np.float64)), 'loss_probability': float((pnl < 0).mean())}
+        for level in self.confidence:
+            var = -float(np.quantile(pnl, 1 - level))
+            tail = pnl[pnl <= -var]
+            metrics[f'var_{level:g}'] = var
+            metrics[f'es_{level:g}'] = -float(tail.mean(dtype=np.float64)) if len(tail) else var
+        return metrics
+
+
+def position_pnl(paths, position):
+    """
+    Return (pnl, stop hit, profit hit) per path for one position.
+
+    Parameters:
+    - paths (np.ndarray): (paths, steps) prices.
+    - position (dict): A position dict as returned by positions_from_api.
+    """
+    direction, level = position['direction'], position['level']
+    steps = paths.shape[1]
+    stop, profit = position.get('stop_level'), position.get('profit_level')
+    stop_step = _first_step(paths <= stop if direction > 0 else paths >= stop) if stop else np.full(len(paths), steps)
+    profit_step = _first_step(paths >= profit if direction > 0 else paths <= profit) if profit else np.full(len(paths), steps)
+
+    exit_step = np.minimum(np.minimum(stop_step, profit_step), steps - 1)
+    exit_price = paths[np.arange(len(paths)), exit_step]
+    stopped = stop_step < np.minimum(profit_step, steps)
+    took_profit = profit_step < np.minimum(stop_step, steps)
+    if stop and position.get('guaranteed_stop'):
+        exit_price = np.where(stopped, stop, exit_price)
+    return direction * position['size'] * (exit_price - level), stopped, took_profit
+
+
+def _first_step(crossed):
+    """The first step each path crossed a level, or the number of steps if it never did."""
+    return np.where(crossed.any(axis=1), crossed.argmax(axis=1), crossed.shape[1])
+
+
+def _is_quantile(column):
+    try:
+        return 0 < float(column) < 1
+    except ValueError:
+        return False
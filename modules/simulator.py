@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from modules.candle_store import CANDLE_DTYPE, prices_to_array
+
+# Elements per intermediate (configurations x bars) array, to bound memory on large grids
+_CHUNK_ELEMENTS = 2 ** 24
+
+
+def price_series(candles, price='mid'):
+    """
+    Return (open, high, low, close) arrays of candles for the given side.
+
+    Parameters:
+    - candles (np.ndarray or dict): CANDLE_DTYPE candles, or a get_historical_prices response.
+    - price (str): 'mid', 'bid' or 'ask'.
+    """
+    if isinstance(candles, dict):
+        candles = prices_to_array(candles.get('prices') or [])
+    if price == 'mid':
+        return tuple((candles[f'{field}_bid'] + candles[f'{field}_ask']) / 2 for field in ('open', 'high', 'low', 'close'))
+    return tuple(candles[f'{field}_{price}'].astype(np.float64) for field in ('open', 'high', 'low', 'close'))
+
+
+class SimulationResult:
+    def __init__(self, timestamps, stats, growth, contribution_growth, pair_index):
+        """
+        Initialize the SimulationResult class.
+
+        The equity of configuration i at every bar is
+        initial_capital * growth[pair] + monthly_investment * contribution_growth[pair],
+        with pair = pair_index[i], so curves are only materialized on request.
+
+        Parameters:
+        - timestamps (np.ndarray): The bar times, epoch seconds.
+        - stats (pd.DataFrame): One row of parameters and summary statistics per configuration.
+        - growth (np.ndarray): (leverage x stop-loss pairs, bars) growth of one unit of initial capital, or None.
+        - contribution_growth (np.ndarray): The same for one unit of monthly investment, or None.
+        - pair_index (np.ndarray): The (leverage, stop-loss) pair of every configuration.
+        """
+        self.timestamps = timestamps
+        self.stats = stats
+        self.growth = growth
+        self.contribution_growth = contribution_growth
+        self.pair_index = pair_index
+
+    def equity_curves(self, indices):
+        """Return the equity curves of the given configurations as a (configurations, bars) array."""
+        if self.growth is None:
+            raise ValueError("Run simulate with keep_curves=True to get equity curves")
+        indices = np.atleast_1d(indices)
+        rows = self.stats.iloc[indices]
+        pairs = self.pair_index[indices]
+        return (rows['initial_capital'].to_numpy()[:, None] * self.growth[pairs]
+                + rows['monthly_investment'].to_numpy()[:, None] * self.contribution_growth[pairs])
+
+    def equity_curve(self, index):
+        """Return the equity curve of one configuration as a Series indexed by bar time."""
+        return pd.Series(self.equity_curves(index)[0], index=pd.to_datetime(self.timestamps, unit='s'), name='equity')
+
+
+def simulate(candles, initial_capital, monthly_investment=0, leverage=1, stop_loss=0, price='mid', keep_curves=True):
+    """
+    Simulate a leveraged long position for every combination of the given parameters at once.
+
+    The position is opened at the first close and kept at a constant leverage of the
+    current equity. Every new calendar month adds monthly_investment, which is invested
+    as well. The stop-loss trails the highest close so far: once a bar's low falls
+    stop_loss percent below it, the position is closed at the stop level (or at the open
+    if the bar gapped through it) and the account stays in cash, still receiving the
+    monthly investments. A bar whose low would wipe out the equity liquidates it.
+
+    Every configuration is evaluated with NumPy array operations; the only loop is over
+    chunks of the grid that bound memory use.
+
+    Parameters:
+    - candles (np.ndarray or dict): CANDLE_DTYPE candles sorted by time, or a get_historical_prices response.
+    - initial_capital, monthly_investment, leverage, stop_loss (float or array): The values to
+      sweep; the grid is their Cartesian product. stop_loss is in percent, 0 for none.
+    - price (str): The price side the position is valued at: 'mid', 'bid' or 'ask'.
+    - keep_curves (bool): Keep what is needed for equity_curves(); costs 16 bytes per bar
+      and (leverage, stop-loss) pair.
+
+    Returns:
+    - result (SimulationResult): The statistics per configuration and the equity curves.
+    """
+    if isinstance(candles, dict):
+        candles = prices_to_array(candles.get('prices') or [])
+    candles = np.asarray(candles, dtype=CANDLE_DTYPE)
+    if len(candles) < 2:
+        raise ValueError("At least two candles are needed to simulate")
+    open_, _, low, close = price_series(candles, price)
+    capitals, contributions, leverages, stops = (
+        np.atleast_1d(np.asarray(values, dtype=np.float64))
+        for values in (initial_capital, monthly_investment, leverage, stop_loss))
+    if np.any(leverages <= 0):
+        raise ValueError("Leverage must be positive")
+    if np.any((stops < 0) | (stops >= 100)):
+        raise ValueError("Stop-loss must be between 0 and 100 percent")
+
+    bars = len(close)
+    returns = np.concatenate(([0.0], close[1:] / close[:-1] - 1))
+    bar_times = candles['timestamp'].astype('datetime64[s]')
+    months = bar_times.astype('datetime64[M]')
+    month_starts = np.concatenate(([False], months[1:] != months[:-1])).astype(np.float64)
+    contributions_so_far = np.cumsum(month_starts)
+
+    # The first bar each stop-loss and each leverage's liquidation level is hit; running
+    # minima are monotone, so one searchsorted finds it for every parameter value
+    peak = np.maximum.accumulate(close)[:-1]
+    stop_ratio = np.minimum.accumulate(low[1:] / peak)
+    stop_times = np.where(stops > 0, np.searchsorted(-stop_ratio, stops / 100 - 1, side='left') + 1, bars)
+    worst_return = np.minimum.accumulate(low[1:] / close[:-1] - 1)
+    liquidation_times = np.searchsorted(-worst_return, 1 / leverages, side='left') + 1
+
+    pair_leverage = np.repeat(leverages, len(stops))
+    pair_stop = np.tile(stops, len(leverages))
+    pair_stop_time = np.tile(stop_times, len(leverages))
+    pair_liquidation_time = np.repeat(liquidation_times, len(stops))
+    exits = np.minimum(pair_stop_time, pair_liquidation_time)
+    pairs = len(exits)
+
+    # The return of the exit bar: filled at the stop level, or the whole margin on liquidation
+    exit_bar = np.minimum(exits, bars - 1)
+    stop_level = peak[exit_bar - 1] * (1 - pair_stop / 100)
+    fill_return = np.minimum(open_[exit_bar], stop_level) / close[exit_bar - 1] - 1
+    exit_growth = np.maximum(1 + pair_leverage * np.where(
+        pair_stop_time <= pair_liquidation_time, fill_return, -1 / pair_leverage), 0)
+
+    growth = np.empty((pairs, bars)) if keep_curves else None
+    contribution_growth = np.empty((pairs, bars)) if keep_curves else None
+    final_growth = np.empty(pairs)
+    final_contribution_growth = np.empty(pairs)
+    # Drawdowns only depend on the mix of capital and contributions, not on the amounts
+    grid_capital, grid_contribution = np.meshgrid(capitals, contributions, indexing='ij')
+    total = grid_capital + grid_contribution
+    mixes = np.stack([np.divide(grid_capital, total, out=np.ones_like(total), where=total > 0),
+                      np.divide(grid_contribution, total, out=np.zeros_like(total), where=total > 0)], axis=-1).reshape(-1, 2)
+    mixes, mix_index = np.unique(mixes, axis=0, return_inverse=True)
+    max_drawdowns = np.empty((len(mixes), pairs))
+
+    t = np.arange(bars)
+    chunk = max(1, _CHUNK_ELEMENTS // (bars * max(len(mixes), 1)))
+    for start in range(0, pairs, chunk):
+        stop = min(start + chunk, pairs)
+        exit = exits[start:stop, None]
+        bar_growth = 1 + pair_leverage[start:stop, None] * returns
+        bar_growth = np.where(t > exit, 1.0, np.where(t == exit, exit_growth[start:stop, None], bar_growth))
+        # E_t = g_t E_{t-1} + c_t solves to G_t * (E_0 + sum c_k / G_k) while invested; the
+        # sum is taken in log space so long losing runs cannot underflow G. After the exit
+        # the contributions are just added up in cash
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_growth = np.cumsum(np.log(bar_growth), axis=1)
+            log_invested = np.where(t < exit, np.log(month_starts) - log_growth, -np.inf)
+        unit_growth = np.exp(log_growth)
+        added = np.exp(np.logaddexp.accumulate(log_invested, axis=1) + log_growth)
+        cash_base = contributions_so_far[np.clip(exit - 1, 0, bars - 1)]
+        added += np.where(t >= exit, contributions_so_far - cash_base, 0.0)
+
+        final_growth[start:stop] = unit_growth[:, -1]
+        final_contribution_growth[start:stop] = added[:, -1]
+        if keep_curves:
+            growth[start:stop] = unit_growth
+            contribution_growth[start:stop] = added
+        equity = mixes[:, 0, None, None] * unit_growth + mixes[:, 1, None, None] * added
+        running_peak = np.maximum.accumulate(equity, axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            drawdown = np.where(running_peak > 0, 1 - equity / running_peak, 0.0)
+        max_drawdowns[:, start:stop] = drawdown.max(axis=2)
+
+    capital, contribution, pair_index = (
+        values.ravel() for values in np.meshgrid(capitals, contributions, np.arange(pairs), indexing='ij'))
+    mix = np.repeat(mix_index.ravel(), pairs)
+    final_equity = capital * final_growth[pair_index] + contribution * final_contribution_growth[pair_index]
+    invested_total = capital + contribution * contributions_so_far[-1]
+    exit_times = exits[pair_index]
+    stats = pd.DataFrame({
+        'initial_capital': capital,
+        'monthly_investment': contribution,
+        'leverage': pair_leverage[pair_index],
+        'stop_loss': pair_stop[pair_index],
+        'final_equity': final_equity,
+        'invested': invested_total,
+        'profit': final_equity - invested_total,
+        'total_return': np.divide(final_equity - invested_total, invested_total,
+                                  out=np.zeros_like(final_equity), where=invested_total > 0),
+        'max_drawdown': max_drawdowns[mix, pair_index],
+        'stopped_at': np.where(exit_times < bars, bar_times[np.minimum(exit_times, bars - 1)], np.datetime64('NaT')),
+        'liquidated': (exit_times < bars) & (exit_growth[pair_index] == 0)
+    })
+    return SimulationResult(candles['timestamp'].copy(), stats, growth, contribution_growth, pair_index)
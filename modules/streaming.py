@@ -0,0 +1,279 @@
+import asyncio
+import itertools
+import json
+import threading
+import aiohttp
+import numpy as np
+
+STREAMING_URL = 'wss://api-streaming-capital.backend-capital.com/connect'
+
+# The streaming API accepts at most 40 epics per subscription message
+MAX_EPICS_PER_SUBSCRIPTION = 40
+
+# Error codes meaning the CST/X-SECURITY-TOKEN pair is no longer valid
+SESSION_ERROR_CODES = {
+    'error.invalid.session.token',
+    'error.null.client.token',
+    'error.null.account.token',
+    'error.security.client-token-invalid',
+    'error.security.account-token-invalid'
+}
+
+TICK_DTYPE = np.dtype([
+    ('timestamp', 'i8'),  # epoch milliseconds
+    ('bid', 'f8'),
+    ('ask', 'f8'),
+    ('bid_qty', 'f8'),
+    ('ask_qty', 'f8')
+])
+
+
+class TickRingBuffer:
+    def __init__(self, capacity=10000):
+        """
+        Initialize the TickRingBuffer class.
+
+        Every tick is written twice, at i and i + capacity, so the newest `capacity`
+        ticks are always one contiguous slice and readers get views without copying.
+        A view keeps changing as new ticks arrive; copy it to keep a snapshot.
+
+        Parameters:
+        - capacity (int): The number of most recent ticks kept.
+        """
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=TICK_DTYPE)
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, timestamp, bid, ask, bid_qty=np.nan, ask_qty=np.nan):
+        """Add a tick in O(1), overwriting the oldest one when full."""
+        i = self._count % self.capacity
+        tick = (timestamp, bid, ask, bid_qty, ask_qty)
+        self._data[i] = tick
+        self._data[i + self.capacity] = tick
+        self._count += 1
+
+    def view(self, n=None):
+        """Return the newest n ticks (all kept ticks by default), oldest first, as a zero-copy view."""
+        count = self._count
+        size = min(count, self.capacity)
+        n = size if n is None else min(n, size)
+        end = count % self.capacity + (self.capacity if count >= self.capacity else 0)
+        return self._data[end - n:end]
+
+    def last(self):
+        """Return a copy of the newest tick, or None when empty."""
+        return self.view(1)[0].copy() if self._count else None
+
+
+class QuoteStream:
+    def __init__(self, api_client, url=STREAMING_URL, buffer_size=10000, max_pending=1000, ping_interval=300, min_reconnect_delay=1,
+                 max_reconnect_delay=30):
+        """
+        Initialize the QuoteStream class.
+
+        Subscribes to live quotes over the Capital.com streaming API and keeps the ticks of
+        every epic in a TickRingBuffer. Listeners are fed from a bounded queue: when they
+        fall behind, the oldest pending ticks are dropped (and counted) rather than slowing
+        the socket down. Drive it with `await stream.run()` or in a background thread with
+        `stream.start()`.
+
+        Parameters:
+        - api_client (CapitalComAPI): Supplies the session tokens and logs in again when they expire.
+        - url (str): The streaming endpoint; point it at a local stand-in for testing.
+        - buffer_size (int): Ticks kept per epic.
+        - max_pending (int): Ticks queued for listeners before the oldest are dropped.
+        - ping_interval (int): Seconds between keep-alive pings.
+        - min_reconnect_delay (float): The first wait before reconnecting; it doubles until quotes flow again.
+        - max_reconnect_delay (int): The longest wait between reconnection attempts.
+        """
+        self.api_client = api_client
+        self.url = url
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self.ping_interval = ping_interval
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.buffers = {}
+        self.dropped = 0
+        self._epics = set()
+        self._listeners = []
+        self._correlation = itertools.count(1)
+        self._ws = None
+        self._loop = None
+        self._thread = None
+        self._stopping = None
+        self._pending = None
+        self._session_expired = False
+        self._sent_token = None
+
+    def buffer(self, epic):
+        """Return the tick buffer of an epic, creating it if needed."""
+        if epic not in self.buffers:
+            self.buffers[epic] = TickRingBuffer(self.buffer_size)
+        return self.buffers[epic]
+
+    def add_listener(self, callback):
+        """Call callback(epic, tick) for every tick, outside the socket reader."""
+        self._listeners.append(callback)
+
+    def subscribe(self, epics):
+        """Start streaming quotes for the given epics."""
+        new = [epic for epic in epics if epic not in self._epics]
+        self._epics.update(new)
+        for epic in new:
+            self.buffer(epic)
+        self._send_threadsafe('marketData.subscribe', new)
+
+    def unsubscribe(self, epics):
+        """Stop streaming quotes for the given epics; their buffers are kept."""
+        removed = [epic for epic in epics if epic in self._epics]
+        self._epics.difference_update(removed)
+        self._send_threadsafe('marketData.unsubscribe', removed)
+
+    def _send_threadsafe(self, destination, epics):
+        if not epics or self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._send_epics(destination, epics), self._loop)
+        if not self._on_loop_thread():
+            future.result()
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def _send(self, destination, payload=None):
+        if self._ws is None or self._ws.closed:
+            return
+        message = {
+            'destination': destination,
+            'correlationId': str(next(self._correlation)),
+            'cst': self.api_client.session_token,
+            'securityToken': self.api_client.security_token
+        }
+        if payload is not None:
+            message['payload'] = payload
+        self._sent_token = message['cst']
+        await self._ws.send_str(json.dumps(message))
+
+    async def _send_epics(self, destination, epics):
+        for i in range(0, len(epics), MAX_EPICS_PER_SUBSCRIPTION):
+            await self._send(destination, {'epics': epics[i:i + MAX_EPICS_PER_SUBSCRIPTION]})
+
+    def _handle(self, message):
+        if message.get('destination') == 'quote':
+            quote = message['payload']
+            epic = quote['epic']
+            self.buffer(epic).append(
+                quote['timestamp'], quote['bid'], quote['ofr'], quote.get('bidQty', np.nan), quote.get('ofrQty', np.nan))
+            if self._listeners:
+                if self._pending.full():
+                    self._pending.get_nowait()
+                    self.dropped += 1
+                self._pending.put_nowait((epic, self.buffers[epic].last()))
+        elif message.get('status') not in (None, 'OK'):
+            payload = message.get('payload')
+            error_code = payload.get('errorCode') if isinstance(payload, dict) else None
+            if error_code in SESSION_ERROR_CODES:
+                self._session_expired = True
+            print(f"Streaming error: {json.dumps(payload if payload is not None else message)}")
+
+    async def _dispatch(self):
+        while True:
+            epic, tick = await self._pending.get()
+            for callback in self._listeners:
+                try:
+                    callback(epic, tick)
+                except Exception as e:
+                    print(f"Quote listener failed: {str(e)}")
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await self._send('ping')
+
+    async def _refresh_session(self):
+        # Through the client's lock, so a REST thread re-authenticating at the same time does not log in twice
+        if asyncio.iscoroutinefunction(self.api_client._refresh_session):
+            await self.api_client._refresh_session(self._sent_token)
+        else:
+            await asyncio.to_thread(self.api_client._refresh_session, self._sent_token)
+        self._session_expired = False
+
+    async def _connect(self, http, delay):
+        """Subscribe over one connection until it drops; return the backoff delay to use next."""
+        try:
+            async with http.ws_connect(self.url, heartbeat=30) as ws:
+                self._ws = ws
+                await self._send_epics('marketData.subscribe', sorted(self._epics))
+                pinger = asyncio.create_task(self._ping())
+                try:
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            data = json.loads(message.data)
+                            self._handle(data)
+                            if data.get('destination') == 'quote':
+                                # Only a working subscription resets the backoff, so a repeating error cannot spin
+                                delay = self.min_reconnect_delay
+                            elif self._session_expired:
+                                # The subscriptions died with the session: log in and resubscribe
+                                break
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                finally:
+                    pinger.cancel()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            print(f"Streaming connection failed: {str(e)}")
+        finally:
+            self._ws = None
+        return delay
+
+    async def run(self):
+        """Stream until stop() is called, reconnecting and re-subscribing after failures."""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._pending = asyncio.Queue(self.max_pending)
+        dispatcher = asyncio.create_task(self._dispatch())
+        delay = self.min_reconnect_delay
+        try:
+            async with aiohttp.ClientSession() as http:
+                while not self._stopping.is_set():
+                    if self._session_expired:
+                        try:
+                            await self._refresh_session()
+                        except Exception as e:
+                            # _session_expired stays set, so the login is retried after the backoff
+                            print(f"Streaming session refresh failed: {str(e)}")
+                    if not self._session_expired:
+                        delay = await self._connect(http, delay)
+                    if not self._stopping.is_set():
+                        try:
+                            await asyncio.wait_for(self._stopping.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            dispatcher.cancel()
+            self._loop = None
+
+    def start(self):
+        """Run the stream in a background thread."""
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run(),), name='quote-stream', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Close the connection and stop streaming."""
+        loop = self._loop
+        if loop is not None:
+            async def shutdown():
+                self._stopping.set()
+                if self._ws is not None:
+                    await self._ws.close()
+            asyncio.run_coroutine_threadsafe(shutdown(), loop)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,136 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from modules.candle_store import prices_to_array
+
+# Characters a tool output may use unless the caller sets its own budget
+DEFAULT_MAX_CHARS = 6000
+
+
+class TTLCache:
+    def __init__(self, ttl=60, max_entries=256):
+        """
+        Initialize the TTLCache class.
+
+        A thread-safe cache whose entries expire `ttl` seconds after they were stored; the
+        least recently used entries are dropped beyond max_entries.
+
+        Parameters:
+        - ttl (float): Seconds an entry stays valid.
+        - max_entries (int): The maximum number of entries kept.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return the cached value of key, or None when it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """Store a value for the next ttl seconds."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every Assistant, so identical questions reuse one API call
+tool_cache = TTLCache()
+
+
+def encode_prices(response, epic=None, resolution=None, max_chars=DEFAULT_MAX_CHARS):
+    """
+    Encode a historical prices response as compact JSON for the assistant.
+
+    Bars become mid-price columns (time, open, high, low, close, volume) rounded to the
+    precision of the prices, next to a summary of the whole series. When the columns do
+    not fit in max_chars, consecutive bars are merged into fewer, wider bars until they
+    do; the summary always covers every bar.
+
+    Parameters:
+    - response (dict): A get_historical_prices response.
+    - max_chars (int): The size budget of the output.
+
+    Returns:
+    - output (str): The JSON text.
+    """
+    if 'prices' not in response:
+        # An error response is short already; pass it on as is
+        return json.dumps(response, separators=(',', ':'))
+    candles = prices_to_array(response['prices'])
+    header = {'epic': epic, 'resolution': resolution, 'bars': len(candles)}
+    if not len(candles):
+        return json.dumps(header, separators=(',', ':'))
+
+    mid = {field: (candles[f'{field}_bid'] + candles[f'{field}_ask']) / 2 for field in ('open', 'high', 'low', 'close')}
+    decimals = _decimals(mid['close'])
+    header['summary'] = {
+        'first': format_time(candles['timestamp'][0]),
+        'last': format_time(candles['timestamp'][-1]),
+        'open': round(float(mid['open'][0]), decimals),
+        'close': round(float(mid['close'][-1]), decimals),
+        'high': round(float(np.nanmax(mid['high'])), decimals),
+        'low': round(float(np.nanmin(mid['low'])), decimals),
+        'change_pct': round(float((mid['close'][-1] / mid['open'][0] - 1) * 100), 2),
+        'avg_spread': round(float(np.nanmean(candles['close_ask'] - candles['close_bid'])), decimals),
+        'volume': float(np.nansum(candles['volume']))
+    }
+
+    groups = len(candles)
+    while True:
+        output = json.dumps(dict(header, **_columns(candles, mid, groups, decimals)), separators=(',', ':'))
+        if len(output) <= max_chars or groups == 1:
+            return output
+        # Shrink in proportion to the overshoot, and by at least one bar per group step
+        groups = max(1, min(groups - 1, int(groups * max_chars / len(output) * 0.95)))
+
+
+def _columns(candles, mid, groups, decimals):
+    """The bars merged into `groups` consecutive groups, as columns."""
+    starts = np.linspace(0, len(candles), groups, endpoint=False).astype(np.int64)
+    ends = np.concatenate((starts[1:], [len(candles)])) - 1
+    columns = {}
+    if groups < len(candles):
+        columns['bars_per_row'] = int(np.ceil(len(candles) / groups))
+    columns['columns'] = ['time', 'open', 'high', 'low', 'close', 'volume']
+    columns['rows'] = [list(row) for row in zip(
+        [format_time(timestamp) for timestamp in candles['timestamp'][starts]],
+        _values(mid['open'][starts], decimals),
+        _values(np.fmax.reduceat(mid['high'], starts), decimals),
+        _values(np.fmin.reduceat(mid['low'], starts), decimals),
+        _values(mid['close'][ends], decimals),
+        _values(np.add.reduceat(np.nan_to_num(candles['volume']), starts), 2)
+    )]
+    return columns
+
+
+def _values(values, decimals):
+    """Rounded values as a list, with None for missing ones (NaN is not valid JSON)."""
+    return [None if value != value else value for value in np.round(values, decimals).tolist()]
+
+
+def _decimals(prices):
+    """Decimals that keep about six significant digits of the largest price."""
+    largest = float(np.nanmax(np.abs(prices))) if len(prices) else 0.0
+    if not largest or not np.isfinite(largest):
+        return 2
+    return int(max(0, 5 - np.floor(np.log10(largest))))
+
+
+def format_time(timestamp):
+    """Epoch seconds as the minute-precision UTC time used in tool outputs."""
+    return time.strftime('%Y-%m-%dT%H:%M', time.gmtime(int(timestamp)))
@@ -0,0 +1,110 @@
+import json
+import os
+
+# The functions folder at the root of the repository
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'functions')
+
+# Parameter names that are Python keywords, and the handler argument each is passed as
+ARGUMENT_NAMES = {'from': 'from_date', 'to': 'to_date'}
+
+_TYPES = {'string': str, 'integer': int, 'number': float, 'boolean': bool}
+
+
+def load_definitions(directory=FUNCTIONS_DIR):
+    """Load the function definitions of a folder of .json files, by function name."""
+    definitions = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, file_name)) as file:
+            definition = json.load(file)
+        definitions[definition['name']] = definition
+    return definitions
+
+
+class ToolRegistry:
+    def __init__(self, handlers, directory=FUNCTIONS_DIR, argument_names=None):
+        """
+        Initialize the ToolRegistry class.
+
+        The tools are the function definitions in `directory`, the same files that are
+        added to the OpenAI assistant. Each one runs the method of `handlers` with the
+        function's name, so a new tool is a .json file plus a method of that name.
+        Arguments are checked and converted against the definition's parameters before
+        the method is called.
+
+        Parameters:
+        - handlers (object): The object whose methods implement the tools.
+        - directory (str): The folder of function definitions.
+        - argument_names (dict): Parameter name -> handler argument name (default: ARGUMENT_NAMES).
+        """
+        self.argument_names = ARGUMENT_NAMES if argument_names is None else argument_names
+        self.definitions = {}
+        self._handlers = {}
+        for name, definition in load_definitions(directory).items():
+            handler = getattr(handlers, name, None)
+            if not callable(handler):
+                print(f"No handler for tool {name}, skipping it")
+                continue
+            self.definitions[name] = definition
+            self._handlers[name] = handler
+
+    @property
+    def names(self):
+        return list(self.definitions)
+
+    def tools(self):
+        """Return the definitions in the form of the tools parameter of the Assistants API."""
+        return [{'type': 'function', 'function': definition} for definition in self.definitions.values()]
+
+    def call(self, name, args):
+        """
+        Run a tool with the arguments of a tool call.
+
+        Parameters:
+        - name (str): The tool name.
+        - args (dict): The decoded arguments.
+
+        Returns:
+        - output: Whatever the handler returns.
+        """
+        if name not in self._handlers:
+            raise KeyError(f"Unknown tool {name}")
+        return self._handlers[name](**self.arguments(name, args))
+
+    def arguments(self, name, args):
+        """Check the arguments of a tool call against its definition and return the handler's keyword arguments."""
+        parameters = self.definitions[name].get('parameters', {})
+        properties = parameters.get('properties', {})
+        missing = [parameter for parameter in parameters.get('required', []) if args.get(parameter) is None]
+        if missing:
+            raise ValueError(f"{name} is missing {', '.join(missing)}")
+        kwargs = {}
+        for parameter, schema in properties.items():
+            value = args.get(parameter, schema.get('default'))
+            if value is None:
+                continue
+            kwargs[self.argument_names.get(parameter, parameter)] = _convert(value, schema, f"{name}.{parameter}")
+        return kwargs
+
+
+def _convert(value, schema, label):
+    """Convert a value to the type of its JSON schema, raising ValueError when it does not fit."""
+    kind = schema.get('type')
+    if kind == 'array':
+        # Models sometimes pass a single item, or a comma separated string, for a list
+        if isinstance(value, str):
+            value = [item.strip() for item in value.split(',') if item.strip()]
+        elif not isinstance(value, list):
+            value = [value]
+        return [_convert(item, schema.get('items', {}), label) for item in value]
+    if kind in _TYPES:
+        if kind == 'boolean' and isinstance(value, str):
+            value = value.lower() == 'true'
+        try:
+            value = _TYPES[kind](value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{label} must be of type {kind}, got {value!r}")
+    if 'enum' in schema and value not in schema['enum']:
+        raise ValueError(f"{label} must be one of {', '.join(map(str, schema['enum']))}, got {value!r}")
+    return value
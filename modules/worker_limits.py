@@ -0,0 +1,29 @@
+import os
+import sys
+
+# Thread pool sizes read by the numeric libraries when they are first imported
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def limit_worker_cpus(cpus):
+    """
+    Keep a worker process's BLAS/OpenMP/torch threads to its share of cores.
+
+    Meant as the initializer of a spawned worker: this module imports nothing heavy, so
+    the environment variables are set before the worker's tasks import NumPy, torch or
+    AutoGluon, which size their thread pools once on import. Pools that already exist
+    (e.g. NumPy's BLAS when a task module was imported first) are limited through
+    threadpoolctl when it is installed, and torch's through torch.set_num_threads.
+
+    Parameters:
+    - cpus (int): The cores the worker may use.
+    """
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(cpus)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(cpus)
+    except ImportError:
+        pass
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(cpus)
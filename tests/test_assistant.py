@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai import OpenAI
+from modules.assistant import Assistant, ToolPool
+
+
+class FakeAssistantsAPI(BaseHTTPRequestHandler):
+    """A local fake of the streamed Assistants endpoints: one tool step, then the answer."""
+
+    submitted = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or '{}')
+        if self.path.endswith('/threads/runs'):
+            events = [('thread.run.requires_action', {
+                'id': 'run_1', 'object': 'thread.run', 'thread_id': 'thread_1', 'status': 'requires_action',
+                'required_action': {'type': 'submit_tool_outputs', 'submit_tool_outputs': {'tool_calls': [
+                    {'id': 'call_1', 'type': 'function', 'function': {'name': 'get_current_datetime', 'arguments': '{}'}},
+                    {'id': 'call_2', 'type': 'function', 'function': {'name': 'find_markets', 'arguments': '{"query": "gold"}'}}
+                ]}}})]
+        elif self.path.endswith('/threads/thread_1/runs/run_1/submit_tool_outputs'):
+            self.submitted.append(body['tool_outputs'])
+            events = [
+                ('thread.message.delta', {'id': 'msg_1', 'object': 'thread.message.delta', 'delta': {
+                    'content': [{'index': 0, 'type': 'text', 'text': {'value': 'It is noon.'}}]}}),
+                ('thread.message.completed', {'id': 'msg_1', 'object': 'thread.message', 'thread_id': 'thread_1', 'role': 'assistant',
+                                              'status': 'completed', 'content': [{'type': 'text', 'text': {'value': 'It is noon.', 'annotations': []}}]}),
+                ('thread.run.completed', {'id': 'run_1', 'object': 'thread.run', 'thread_id': 'thread_1', 'status': 'completed'})
+            ]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for event, data in events:
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAssistant(Assistant):
+    """An Assistant whose find_markets hangs until released, to time it out."""
+
+    release = threading.Event()
+
+    def get_current_datetime(self):
+        return '2026-10-17T12:00:00'
+
+    def find_markets(self, query, limit=5, market_type=None):
+        self.release.wait(5)
+        return {'query': query, 'matches': []}
+
+
+def test_run_answers_tool_calls_and_reports_a_timed_out_tool():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAssistantsAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = OpenAI(api_key='test', base_url=f'http://127.0.0.1:{server.server_address[1]}/v1')
+        assistant = StubAssistant(None, openai_client=client, tool_timeouts={'find_markets': 0.2}, market_catalog=object())
+        deltas = []
+
+        answer = assistant.chat_with_assistant('asst_1', 'What time is it?', on_delta=deltas.append)
+
+        assert answer == 'It is noon.'
+        assert deltas == ['It is noon.']
+        assert FakeAssistantsAPI.submitted == [[
+            {'tool_call_id': 'call_1', 'output': '2026-10-17T12:00:00'},
+            {'tool_call_id': 'call_2', 'output': 'find_markets timed out'}
+        ]]
+    finally:
+        StubAssistant.release.set()
+        server.shutdown()
+
+
+def test_abandoned_calls_do_not_hold_pool_slots():
+    pool = ToolPool(max_workers=2)
+    release = threading.Event()
+    hung = [pool.submit(release.wait, 5) for _ in range(2)]
+    queued = pool.submit(lambda: 'ran')
+    time.sleep(0.05)
+    assert not queued.done()
+
+    for future in hung:
+        pool.abandon(future)
+
+    assert queued.result(timeout=1) == 'ran'
+    release.set()
+    assert all(future.result(timeout=1) for future in hung)
+
+
+def test_abandoned_call_that_has_not_started_never_runs():
+    pool = ToolPool(max_workers=1)
+    release = threading.Event()
+    ran = []
+    busy = pool.submit(release.wait, 5)
+    waiting = pool.submit(ran.append, 'waiting')
+
+    pool.abandon(waiting)
+    release.set()
+
+    assert busy.result(timeout=1)
+    assert waiting.cancelled()
+    time.sleep(0.05)
+    assert ran == []
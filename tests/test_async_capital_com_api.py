@@ -0,0 +1,93 @@
+import asyncio
+import time
+import pytest
+from aiohttp import web
+from modules.async_capital_com_api import AsyncCapitalComAPI
+from modules.capital_com_api import ServerError
+from modules.rate_limiter import RateLimiter
+
+# Fast buckets so the tests run quickly; the default bucket is the one being measured
+TEST_LIMITS = {'default': (20.0, 1.0), 'session': (50.0, 1.0), 'trading': (50.0, 1.0)}
+
+
+class StubServer:
+    """A local stand-in for the REST API that logs every request and can expire the session."""
+
+    def __init__(self):
+        self.logins = 0
+        self.requests = []
+        self.expire_next = False
+
+    async def session(self, request):
+        self.logins += 1
+        self.requests.append(('POST', 'session', time.monotonic()))
+        return web.json_response({}, headers={'CST': f'cst-{self.logins}', 'X-SECURITY-TOKEN': f'x-{self.logins}'})
+
+    async def market(self, request):
+        self.requests.append(('GET', request.headers['CST'], time.monotonic()))
+        if self.expire_next or request.headers['CST'] != f'cst-{self.logins}':
+            self.expire_next = False
+            return web.json_response({'errorCode': 'error.invalid.session.token'}, status=401)
+        return web.json_response({'instrument': {'epic': request.match_info['epic']}})
+
+    async def positions(self, request):
+        self.requests.append(('POST', 'positions', time.monotonic()))
+        return web.json_response({'errorCode': 'error.gateway'}, status=502)
+
+
+async def run_with_server(scenario, directory):
+    stub = StubServer()
+    app = web.Application()
+    app.router.add_post('/api/v1/session', stub.session)
+    app.router.add_get('/api/v1/markets/{epic}', stub.market)
+    app.router.add_post('/api/v1/positions', stub.positions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base_url = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+
+    def client():
+        # Each client has its own limiter object over the same shared bucket files, as separate processes would
+        limiter = RateLimiter(TEST_LIMITS, directory=str(directory))
+        return AsyncCapitalComAPI('key', 'user', 'password', base_url=base_url, rate_limiter=limiter, backoff_factor=0.01)
+
+    try:
+        await scenario(stub, client)
+    finally:
+        await runner.cleanup()
+
+
+def test_clients_share_the_rate_limit(tmp_path):
+    async def scenario(stub, client):
+        async with client() as first, client() as second:
+            started = time.monotonic()
+            await asyncio.gather(*[api.get_market_details('GOLD') for api in (first, second) for _ in range(5)])
+            elapsed = time.monotonic() - started
+        # 10 requests from a bucket of 1 token refilled 20 times a second, whichever client sends them
+        assert elapsed >= 9 / 20.0 * 0.9
+
+    asyncio.run(run_with_server(scenario, tmp_path))
+
+
+def test_expired_session_logs_in_again_and_resends(tmp_path):
+    async def scenario(stub, client):
+        async with client() as api:
+            stub.expire_next = True
+            response = await api.get_market_details('GOLD')
+            assert response == {'instrument': {'epic': 'GOLD'}}
+            assert stub.logins == 2
+            assert [entry[:2] for entry in stub.requests if entry[0] == 'GET'] == [('GET', 'cst-1'), ('GET', 'cst-2')]
+
+    asyncio.run(run_with_server(scenario, tmp_path))
+
+
+def test_server_error_on_post_is_raised_and_not_resent(tmp_path):
+    async def scenario(stub, client):
+        async with client() as api:
+            with pytest.raises(ServerError) as error:
+                await api.create_position('GOLD', 'BUY', 1)
+            assert error.value.response.status == 502
+            assert len([entry for entry in stub.requests if entry[1] == 'positions']) == 1
+
+    asyncio.run(run_with_server(scenario, tmp_path))
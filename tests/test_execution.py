@@ -0,0 +1,93 @@
+import time
+import requests
+from modules.capital_com_api import ServerError
+from modules.execution import ExecutionEngine, net_basket, ACCEPTED
+from modules.paper_broker import PaperBroker
+
+
+class FlakyBroker(PaperBroker):
+    """A PaperBroker whose create_position fails as scripted, and that lists new positions only after `listing_delay`."""
+
+    def __init__(self, failures, listing_delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        # One entry per create_position call: None, 'before' (lost before it arrived) or an exception raised after executing
+        self.failures = list(failures)
+        self.listing_delay = listing_delay
+        self.sends = 0
+        self.created = {}
+
+    def create_position(self, *args, **kwargs):
+        self.sends += 1
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == 'before':
+            raise requests.ConnectionError("connection reset before the order arrived")
+        response = super().create_position(*args, **kwargs)
+        deal_id = self.confirmations[response['dealReference']]['dealId']
+        self.created[deal_id] = time.monotonic()
+        if failure is not None:
+            raise failure
+        return response
+
+    def get_open_positions(self, priority=None):
+        response = super().get_open_positions(priority)
+        now = time.monotonic()
+        response['positions'] = [item for item in response['positions']
+                                 if now - self.created.get(item['position']['dealId'], 0) >= self.listing_delay]
+        return response
+
+
+def open_order(epic='GOLD', size=1):
+    return {'action': 'open', 'epic': epic, 'direction': 'BUY', 'size': size}
+
+
+def engine(broker):
+    return ExecutionEngine(broker, poll_interval=0.01, reconcile_grace=0.3, reconcile_interval=0.02)
+
+
+def test_lost_order_is_sent_again_without_claiming_an_equal_orders_deal():
+    broker = FlakyBroker([None, 'before'])
+    results = engine(broker).execute([open_order(), open_order()])
+
+    assert [result['status'] for result in results] == [ACCEPTED, ACCEPTED]
+    assert results[0]['deal_id'] != results[1]['deal_id']
+    assert results[1]['attempts'] == 2
+    assert len(broker.get_open_positions()['positions']) == 2
+
+
+def test_executed_order_listed_late_is_not_sent_again():
+    broker = FlakyBroker([requests.ConnectionError("connection reset after the order arrived")], listing_delay=0.1)
+    results = engine(broker).execute([open_order()])
+
+    assert results[0]['status'] == ACCEPTED
+    assert results[0]['reason'] == 'reconciled'
+    assert broker.sends == 1
+    assert len(broker.positions) == 1
+
+
+def test_server_error_is_reconciled_rather_than_rejected():
+    broker = FlakyBroker([ServerError("502 from POST api/v1/positions")])
+    results = engine(broker).execute([open_order()])
+
+    assert results[0]['status'] == ACCEPTED
+    assert results[0]['reason'] == 'reconciled'
+    assert broker.sends == 1
+
+
+def test_rebalance_reaches_targets_in_netting_and_hedging_accounts():
+    for hedging in (True, False):
+        broker = PaperBroker(hedging=hedging)
+        broker.create_position('GOLD', 'BUY', 3)
+        broker.create_position('GOLD', 'SELL', 1)
+        broker.create_position('OIL', 'SELL', 2)
+        targets = {'GOLD': -1, 'OIL': 0, 'US100': 2}
+
+        results = engine(broker).rebalance(targets)
+
+        assert all(result['status'] == ACCEPTED for result in results)
+        net = {}
+        for item in broker.get_open_positions()['positions']:
+            position = item['position']
+            size = position['size'] if position['direction'] == 'BUY' else -position['size']
+            net[item['market']['epic']] = net.get(item['market']['epic'], 0) + size
+        assert {epic: net.get(epic, 0) for epic in targets} == targets
+        assert net_basket(targets, broker.get_open_positions()) == []
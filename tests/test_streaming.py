@@ -0,0 +1,120 @@
+import asyncio
+import json
+from aiohttp import web
+from modules.streaming import QuoteStream
+
+
+class FakeSessionClient:
+    """Supplies streaming tokens; a refresh issues the next token unless the first `failures` logins fail."""
+
+    def __init__(self, failures=0):
+        self.session_token = 'cst-1'
+        self.security_token = 'x-1'
+        self.failures = failures
+        self.logins = 0
+
+    def _refresh_session(self, expired_token):
+        if self.session_token != expired_token:
+            return
+        self.logins += 1
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Failed to start session: 503")
+        self.session_token = f'cst-{self.logins + 1}'
+        self.security_token = f'x-{self.logins + 1}'
+
+
+class StandIn:
+    """A local stand-in for the streaming endpoint that records every connection's subscribe messages."""
+
+    def __init__(self):
+        self.connections = []
+        self.sockets = []
+        self.expired_tokens = set()
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscribed = []
+        self.connections.append(subscribed)
+        self.sockets.append(ws)
+        async for message in ws:
+            data = json.loads(message.data)
+            if data['destination'] != 'marketData.subscribe':
+                continue
+            if data['cst'] in self.expired_tokens:
+                await ws.send_str(json.dumps({'status': 'FAILED', 'destination': data['destination'],
+                                              'payload': {'errorCode': 'error.invalid.session.token'}}))
+                continue
+            subscribed.append((data['cst'], data['payload']['epics']))
+            await ws.send_str(json.dumps({'status': 'OK', 'destination': data['destination'], 'payload': {}}))
+            for epic in data['payload']['epics']:
+                await ws.send_str(json.dumps({'status': 'OK', 'destination': 'quote', 'payload': {
+                    'epic': epic, 'timestamp': 1000 * len(self.connections), 'bid': 1.0, 'ofr': 1.1}}))
+        return ws
+
+
+async def wait_until(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+async def run_scenario(scenario, client):
+    stand_in = StandIn()
+    app = web.Application()
+    app.router.add_get('/connect', stand_in.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    stream = QuoteStream(client, url=f'http://127.0.0.1:{port}/connect', min_reconnect_delay=0.05, max_reconnect_delay=0.2)
+    stream.subscribe(['GOLD', 'OIL'])
+    task = asyncio.create_task(stream.run())
+    try:
+        await scenario(stream, stand_in)
+    finally:
+        stream.stop()
+        await asyncio.wait_for(task, 5)
+        await runner.cleanup()
+
+
+def test_subscribes_and_buffers_quotes():
+    async def scenario(stream, stand_in):
+        await wait_until(lambda: len(stream.buffer('OIL')) == 1)
+        assert stand_in.connections == [[('cst-1', ['GOLD', 'OIL'])]]
+        assert stream.buffer('GOLD').last()['ask'] == 1.1
+
+    asyncio.run(run_scenario(scenario, FakeSessionClient()))
+
+
+def test_dropped_connection_resubscribes():
+    async def scenario(stream, stand_in):
+        await wait_until(lambda: len(stand_in.connections) == 1 and stand_in.connections[0])
+        stream.subscribe(['US100'])
+        await wait_until(lambda: len(stream.buffer('US100')) == 1)
+        await stand_in.sockets[0].close()
+        await wait_until(lambda: len(stand_in.connections) == 2 and stand_in.connections[1])
+        assert stand_in.connections[1] == [('cst-1', ['GOLD', 'OIL', 'US100'])]
+        await wait_until(lambda: len(stream.buffer('US100')) == 2)
+
+    asyncio.run(run_scenario(scenario, FakeSessionClient()))
+
+
+def test_session_expiry_logs_in_again_and_resubscribes():
+    client = FakeSessionClient(failures=1)
+
+    async def scenario(stream, stand_in):
+        await wait_until(lambda: len(stream.buffer('GOLD')) == 1)
+        stand_in.expired_tokens.add('cst-1')
+        stream.subscribe(['US100'])
+        # The first login fails; the stream backs off and tries again instead of stopping
+        await wait_until(lambda: any(subscribed and subscribed[0][0] == 'cst-3' for subscribed in stand_in.connections))
+        assert client.logins == 2
+        assert stand_in.connections[-1] == [('cst-3', ['GOLD', 'OIL', 'US100'])]
+        await wait_until(lambda: len(stream.buffer('US100')) == 1)
+
+    asyncio.run(run_scenario(scenario, client))